@@ -1,19 +1,16 @@
 import sys
 import os
+import signal
 sys.path.append(os.environ['AUTOPROF'])
-from autoprofutils.Background import Background_Mode
-from autoprofutils.PSF import PSF_2DGaussFit, PSF_GaussFit, PSF_StarFind
-from autoprofutils.Center import Center_Null, Center_HillClimb, Center_Forced
-from autoprofutils.Isophote_Initialize import Isophote_Initialize_CircFit
-from autoprofutils.Isophote_Fit import Isophote_Fit_FFT_Robust, Isophote_Fit_Forced, Photutils_Fit
-from autoprofutils.Mask import Star_Mask_IRAF, NoMask, Star_Mask_Given
-from autoprofutils.Isophote_Extract import Isophote_Extract, Isophote_Extract_Forced
-from autoprofutils.Check_Fit import Check_Fit_IQR, Check_Fit_Simple
-from autoprofutils.SharedFunctions import GetKwargs, Read_Image
+from autoprofutils.Settings import Read_Settings
+from autoprofutils.Catalogue import Read_Catalogue
+from autoprofutils.SharedFunctions import Read_Image, Read_Cutout, Header_Values, Image_Pixels
+from autoprofutils.Diagnostic_Plots import Submit_Plots, Flush_Plots
+from autoprofutils.Log_Handling import Start_Logging, Configure_Logging, Set_Log_Stage, Log_To_Pipe, Handle_Log_Record, Log_Settings, Log_To_Queue
+from autoprofutils.Work_Queue import Queue_Create, Queue_Check_Images, Queue_Meta, Queue_Claim, Queue_Heartbeat, Queue_Finish, Queue_Status, Queue_Journal, Queue_Worker_ID
 from multiprocessing import Pool, current_process
+from threading import Thread, Event
 from astropy.io import fits
-from scipy.stats import iqr
-from itertools import starmap
 import importlib
 import numpy as np
 from time import time, sleep
@@ -23,59 +20,370 @@ import traceback
 from astropy.io.fits.verify import VerifyWarning
 warnings.simplefilter('ignore', category=VerifyWarning)
 
+def _Import_Function(func):
+    """
+    Import a function given by name as a "module.function" string, other values are returned unchanged.
+    """
+    if type(func) == str:
+        module, funcname = func.rsplit('.', 1)
+        func = getattr(importlib.import_module(module), funcname)
+    return func
+
+# Arguments shared by all images in a batch, set once in each worker process, see Isophote_Pipeline._Format_List
+_batch_kwargs = {}
+
+def _Set_Batch_Kwargs(kwargs):
+    """
+    Internal, set the arguments shared by all images in a batch for this process.
+    """
+    global _batch_kwargs
+    _batch_kwargs = kwargs
+
+def _Init_Batch_Worker(kwargs, log_settings):
+    """
+    Internal, Pool initializer for batch workers. Sets the shared arguments and sends
+    the log messages to the main process, also when the workers are not forked.
+    """
+    _Set_Batch_Kwargs(kwargs)
+    Log_To_Queue(log_settings)
+
+_background = ['background', 'background noise']
+_init = ['init ellip', 'init pa', 'init R']
+_fit = ['fit R', 'fit ellip', 'fit pa']
+_prof = ['prof header', 'prof units', 'prof data', 'prof format']
+# results keys read ("requires", or "uses" when optional) and written ("provides") by the built in pipeline functions
+_step_io = {'autoprofutils.Background.Background_Global': {'provides': _background},
+            'autoprofutils.Background.Background_Mode': {'provides': _background},
+            'autoprofutils.Background.Background_ByPatches': {'provides': _background},
+            'autoprofutils.Background.Background_ByIsophote': {'provides': _background},
+            'autoprofutils.Background.Background_All': {'provides': _background},
+            'autoprofutils.PSF.PSF_StarFind': {'requires': _background, 'provides': ['psf fwhm']},
+            'autoprofutils.PSF.PSF_GaussFit': {'requires': _background, 'provides': ['psf fwhm']},
+            'autoprofutils.PSF.PSF_2DGaussFit': {'requires': _background, 'provides': ['psf fwhm']},
+            'autoprofutils.PSF.Calculate_PSF': {'requires': _background, 'provides': ['psf fwhm']},
+            'autoprofutils.PSF.Given_PSF': {'requires': _background, 'provides': ['psf fwhm']},
+            'autoprofutils.Center.Center_Null': {'provides': ['center']},
+            'autoprofutils.Center.Center_Given': {'provides': ['center']},
+            'autoprofutils.Center.Center_Forced': {'provides': ['center']},
+            'autoprofutils.Center.Center_Bright': {'requires': ['psf fwhm'], 'provides': ['center']},
+            'autoprofutils.Center.Center_Centroid': {'requires': ['background', 'psf fwhm'], 'provides': ['center']},
+            'autoprofutils.Center.Center_1DGaussian': {'requires': ['background', 'psf fwhm'], 'provides': ['center']},
+            'autoprofutils.Center.Center_OfMass': {'requires': ['background', 'psf fwhm'], 'provides': ['center']},
+            'autoprofutils.Center.Center_Multi_Method': {'requires': ['background', 'psf fwhm'], 'provides': ['center']},
+            'autoprofutils.Center.Center_HillClimb': {'requires': _background + ['psf fwhm'], 'provides': ['center']},
+            'autoprofutils.Polar.Polar_Resample': {'requires': ['background', 'center'], 'provides': ['polar image']},
+            'autoprofutils.Isophote_Initialize.Isophote_Initialize_GridSearch': {'requires': _background + ['center', 'psf fwhm'], 'provides': _init},
+            'autoprofutils.Isophote_Initialize.Isophote_Initialize_CircFit': {'requires': _background + ['center', 'psf fwhm'], 'uses': ['polar image'],
+                                                                              'provides': _init + ['init ellip_err', 'init pa_err']},
+            'autoprofutils.Isophote_Initialize.Isophote_Initialize_All': {'requires': _background + ['center', 'psf fwhm'], 'uses': ['polar image'],
+                                                                          'provides': _init + ['init ellip_err', 'init pa_err']},
+            'autoprofutils.Isophote_Fit.Isophote_Fit_FFT_Robust': {'requires': _background + ['center', 'psf fwhm', 'init ellip', 'init pa'], 'uses': ['polar image'],
+                                                                   'provides': _fit + ['fit ellip_err', 'fit pa_err', 'fit trace', 'fit samples']},
+            'autoprofutils.Isophote_Fit.Isophote_Fit_Forced': {'uses': ['background', 'center'], 'provides': _fit + ['fit ellip_err', 'fit pa_err']},
+            'autoprofutils.Isophote_Fit.Photutils_Fit': {'requires': ['background', 'center'] + _init, 'provides': _fit + ['fit ellip_err', 'fit pa_err']},
+            'autoprofutils.Mask.Star_Mask_IRAF': {'requires': _background + ['center', 'psf fwhm', 'fit R'], 'provides': ['mask', 'overflow mask']},
+            'autoprofutils.Mask.Star_Mask_DAO': {'requires': _background + ['psf fwhm'], 'provides': ['mask', 'overflow mask']},
+            'autoprofutils.Mask.Star_Mask_Given': {'provides': ['mask', 'overflow mask']},
+            'autoprofutils.Mask.NoMask': {'provides': ['mask', 'overflow mask']},
+            'autoprofutils.Isophote_Extract.Isophote_Extract': {'requires': _background + ['center', 'psf fwhm', 'init ellip', 'init pa', 'mask', 'overflow mask'] + _fit,
+                                                                'uses': ['fit ellip_err', 'fit pa_err', 'polar image'], 'provides': _prof},
+            'autoprofutils.Isophote_Extract.Isophote_Extract_Forced': {'requires': _background + ['center', 'init ellip', 'init pa', 'mask', 'overflow mask'] + _fit,
+                                                                       'uses': ['fit ellip_err', 'fit pa_err', 'polar image'], 'provides': _prof},
+            'autoprofutils.Check_Fit.Check_Fit_IQR': {'requires': _background + ['center', 'init ellip', 'init pa'] + _fit,
+                                                      'uses': ['fit samples', 'polar image', 'prof data'], 'provides': ['checkfit']},
+            'autoprofutils.Check_Fit.Check_Fit_Simple': {'uses': ['background', 'prof data'], 'provides': ['checkfit']}}
+
 class Isophote_Pipeline(object):
 
     def __init__(self, loggername = None):
         """
         Initialize pipeline object, user can replace functions with their own if they want, otherwise defaults are used.
+        The default functions are given by name and only imported when their step is run, see Get_Function.
 
         loggername: String to use for logging messages
         """
         
-        self.pipeline_functions = {'background': Background_Mode,
-                                   'psf': PSF_StarFind, 
-                                   'center': Center_HillClimb,
-                                   'center forced': Center_Forced,
-                                   'isophoteinit': Isophote_Initialize_CircFit,
-                                   'isophotefit': Isophote_Fit_FFT_Robust,
-                                   'isophotefit forced': Isophote_Fit_Forced,
-                                   'isophotefit photutils': Photutils_Fit,
-                                   'starmask': Star_Mask_IRAF,
-                                   'starmask forced': Star_Mask_Given,
-                                   'isophoteextract': Isophote_Extract,
-                                   'isophoteextract forced': Isophote_Extract_Forced,
-                                   'checkfit': Check_Fit_IQR}
+        self.pipeline_functions = {'background': 'autoprofutils.Background.Background_Global',
+                                   'background mode': 'autoprofutils.Background.Background_Mode',
+                                   'psf': 'autoprofutils.PSF.PSF_StarFind', 
+                                   'center': 'autoprofutils.Center.Center_HillClimb',
+                                   'center forced': 'autoprofutils.Center.Center_Forced',
+                                   'polar': 'autoprofutils.Polar.Polar_Resample',
+                                   'isophoteinit': 'autoprofutils.Isophote_Initialize.Isophote_Initialize_CircFit',
+                                   'isophoteinit grid': 'autoprofutils.Isophote_Initialize.Isophote_Initialize_GridSearch',
+                                   'isophoteinit compare': 'autoprofutils.Isophote_Initialize.Isophote_Initialize_All',
+                                   'isophotefit': 'autoprofutils.Isophote_Fit.Isophote_Fit_FFT_Robust',
+                                   'isophotefit forced': 'autoprofutils.Isophote_Fit.Isophote_Fit_Forced',
+                                   'isophotefit photutils': 'autoprofutils.Isophote_Fit.Photutils_Fit',
+                                   'starmask': 'autoprofutils.Mask.Star_Mask_IRAF',
+                                   'starmask forced': 'autoprofutils.Mask.Star_Mask_Given',
+                                   'isophoteextract': 'autoprofutils.Isophote_Extract.Isophote_Extract',
+                                   'isophoteextract forced': 'autoprofutils.Isophote_Extract.Isophote_Extract_Forced',
+                                   'checkfit': 'autoprofutils.Check_Fit.Check_Fit_IQR'}
         self.pipeline_steps = ['background', 'psf', 'center', 'isophoteinit', 'isophotefit', 'starmask', 'isophoteextract', 'checkfit']
+        # Cheap checks run after a step, these can stop processing a bad image before the expensive steps
+        self.quality_gates = {'background': ['autoprofutils.Quality_Gates.Gate_Overflow_Fraction'],
+                              'center': ['autoprofutils.Quality_Gates.Gate_Center_Offset'],
+                              'isophoteinit': ['autoprofutils.Quality_Gates.Gate_Init_Size']}
+
+        # results keys read and written by user pipeline functions, see Step_IO
+        self.pipeline_io = {}
 
         self.preprocess = None
 
-        # Start the logger
-        logging.basicConfig(level=logging.INFO, filename = 'AutoProf.log' if loggername is None else loggername, filemode = 'w')
+        # Start the logger, messages from all processes are written by one listener thread
+        Start_Logging('AutoProf.log' if loggername is None else loggername)
+
+    def Get_Function(self, step):
+        """
+        Return the function for a pipeline step. Functions given as a "module.function" string are imported
+        the first time they are requested and stored in pipeline_functions, so modules (and their dependencies)
+        for steps that are not run are never imported.
+
+        step: key in pipeline_functions
+        """
+        self.pipeline_functions[step] = _Import_Function(self.pipeline_functions[step])
+        return self.pipeline_functions[step]
+
+    def Check_Quality_Gates(self, step, IMG, pixscale, name, results, **kwargs):
+        """
+        Run the quality gates registered for a pipeline step. A gate has the same arguments as a pipeline
+        function and returns None if the image passes. Otherwise it returns a dictionary with either a
+        'fail' entry giving the reason to stop processing the image, or a 'reroute' entry with a new list
+        of pipeline steps to run in place of the remaining ones (and optionally a 'reason').
+
+        step: pipeline step label which has just completed
+
+        returns: None if all gates pass, else the output of the first gate that did not
+        """
+        if not step in self.quality_gates:
+            return None
+        self.quality_gates[step] = list(_Import_Function(gate) for gate in self.quality_gates[step])
+        for gate in self.quality_gates[step]:
+            outcome = gate(IMG, pixscale, name, results, **kwargs)
+            if outcome:
+                return outcome
+        return None
+
+    def Step_IO(self, step):
+        """
+        The results keys a pipeline step reads and writes. These are taken from pipeline_io for the step label
+        if given there, otherwise from the declarations for the built in functions. Each is a dictionary with
+        lists for: 'requires' keys that must be in the results, 'uses' keys that are read if present, and
+        'provides' keys that the step adds to the results.
+
+        step: key in pipeline_functions
+
+        returns: dictionary of results keys, or None if the step has not been declared
+        """
+        if step in self.pipeline_io:
+            io = self.pipeline_io[step]
+        else:
+            func = self.pipeline_functions[step]
+            if type(func) != str:
+                func = '%s.%s' % (getattr(func, '__module__', ''), getattr(func, '__name__', ''))
+            if not func in _step_io:
+                return None
+            io = _step_io[func]
+        return dict((k, list(io[k]) if k in io else []) for k in ['requires', 'uses', 'provides'])
+
+    def Step_Graph(self, steps):
+        """
+        Dependency graph for a list of pipeline steps, from the results keys each step reads and writes (see
+        Step_IO). A step depends on the earlier steps that write a key it reads, that read or write a key it
+        writes, and on any earlier step that has not been declared. Steps that do not depend on each other
+        may run at the same time.
+
+        steps: list of pipeline step labels
 
-    def UpdatePipeline(self, new_pipeline_functions = None, new_pipeline_steps = None, preprocess = None):
+        returns: list with the set of earlier step indices that each step depends on
+        """
+        io = list(self.Step_IO(step) for step in steps)
+        depends = []
+        for j in range(len(steps)):
+            if io[j] is None:
+                depends.append(set(range(j)))
+                continue
+            reads = set(io[j]['requires'] + io[j]['uses'])
+            writes = set(io[j]['provides'])
+            depends.append(set(i for i in range(j) if io[i] is None or \
+                               (reads | writes) & set(io[i]['provides']) or writes & set(io[i]['requires'] + io[i]['uses'])))
+        return depends
+
+    def Validate_Pipeline(self, steps = None):
+        """
+        Check that every pipeline step has a function and that the results each declared step requires are
+        provided by an earlier step. Requirements that could come from an earlier undeclared step are only
+        noted in the log.
+
+        steps: list of pipeline step labels, by default the current pipeline_steps
+        """
+        steps = self.pipeline_steps if steps is None else steps
+        problems = []
+        available = set()
+        undeclared = []
+        for step in steps:
+            if not step in self.pipeline_functions:
+                problems.append('step "%s" has no pipeline function' % step)
+                continue
+            io = self.Step_IO(step)
+            if io is None:
+                undeclared.append(step)
+                continue
+            missing = set(io['requires']) - available
+            if missing and len(undeclared) > 0:
+                logging.info('PIPELINE step "%s" expects %s from one of: %s' % (step, str(sorted(missing)), str(undeclared)))
+            elif missing:
+                problems.append('step "%s" requires %s which no earlier step provides' % (step, str(sorted(missing))))
+            available.update(io['provides'])
+        if len(problems) > 0:
+            raise ValueError('Invalid pipeline steps %s: %s' % (str(steps), '; '.join(problems)))
+
+    def UpdatePipeline(self, new_pipeline_functions = None, new_pipeline_steps = None, preprocess = None, new_quality_gates = None, new_pipeline_io = None):
         """
         modify steps in the AutoProf pipeline.
 
         new_pipeline_functions: update the dictionary of functions used by the pipeline. This can either add
-                                new functions or replace existing ones.
+                                new functions or replace existing ones. Functions may also be given by name as
+                                a "module.function" string.
         new_pipeline_steps: update the list of pipeline step strings. These strings refer to keys in
                             pipeline_functions. It is posible to add/remove/rearrange steps here. Alternatively
                             one can supply a dictionary with current pipeline steps as keys and new pipeline
                             steps as values, the corresponding steps will be replaced.
+        new_quality_gates: dictionary with pipeline steps as keys and lists of quality gate functions (or
+                           "module.function" strings) as values, see Check_Quality_Gates. The gates for
+                           each given step are replaced, an empty list removes them.
+        new_pipeline_io: dictionary with pipeline steps as keys and dictionaries of the results keys they
+                         read and write as values, see Step_IO.
+
+        New pipeline steps are checked with Validate_Pipeline before they replace the current ones.
         """
         if new_pipeline_functions:
             logging.info('PIPELINE updating these pipeline functions: %s' % str(new_pipeline_functions.keys()))
             self.pipeline_functions.update(new_pipeline_functions)
+        if new_pipeline_io:
+            self.pipeline_io.update(new_pipeline_io)
         if new_pipeline_steps:
             if type(new_pipeline_steps) == list:
                 logging.info('PIPELINE new steps: %s' % str(new_pipeline_steps))
-                self.pipeline_steps = new_pipeline_steps
+                steps = new_pipeline_steps
             elif type(new_pipeline_steps) == dict:
+                steps = list(self.pipeline_steps)
                 for k in new_pipeline_steps.keys():
                     logging.info('PIPELINE replacing "%s" pipeline step with "%s"' % (k, new_pipeline_steps[k]))
-                    self.pipeline_steps[self.pipeline_steps.index(k)] = new_pipeline_steps[k]
+                    steps[steps.index(k)] = new_pipeline_steps[k]
+            self.Validate_Pipeline(steps)
+            self.pipeline_steps = steps
         if preprocess:
-            self.preprocess = preprocess
+            self.preprocess = _Import_Function(preprocess)
+        if new_quality_gates:
+            logging.info('PIPELINE updating quality gates for steps: %s' % str(new_quality_gates.keys()))
+            self.quality_gates.update(new_quality_gates)
+
+    def _Run_Step(self, step, IMG, pixscale, name, results, **kwargs):
+        """
+        Internal, run one pipeline step and its quality gates. A warning is logged if the step
+        takes longer than its time budget in "step_budgets".
+
+        returns: step results, diagnostic plots, quality gate outcome, time taken
+        """
+        step_start = time()
+        Set_Log_Stage(step)
+        try:
+            step_results = self.Get_Function(step)(IMG, pixscale, name, results, **kwargs)
+            step_plots = step_results.pop('diagnostic plots') if 'diagnostic plots' in step_results else []
+            gate = self.Check_Quality_Gates(step, IMG, pixscale, name, dict(results, **step_results), **kwargs)
+        finally:
+            Set_Log_Stage(None)
+        elapsed = time() - step_start
+        if 'step_budgets' in kwargs and step in kwargs['step_budgets'] and elapsed > kwargs['step_budgets'][step]:
+            logging.warning('%s: step %s took %.1f sec, over its budget of %.1f sec' % (name, step, elapsed, kwargs['step_budgets'][step]))
+        return step_results, step_plots, gate, elapsed
+
+    def _Run_Steps_Serial(self, steps, IMG, pixscale, name, results, timers, plots, start, **kwargs):
+        """
+        Internal, run the pipeline steps one after another.
+
+        returns: True if all steps completed, False otherwise
+        """
+        step = 0
+        while step < len(steps):
+            logging.info('%s: %s at: %.1f sec' % (name, steps[step], time() - start))
+            if 'verbose' in kwargs and kwargs['verbose']:
+                print('%s: %s at: %.1f sec' % (name, steps[step], time() - start))
+            try:
+                step_results, step_plots, gate, timers[steps[step]] = self._Run_Step(steps[step], IMG, pixscale, name, results, **kwargs)
+            except Exception as e:
+                logging.error('%s: on step %s got error: %s' % (name, steps[step], str(e)))
+                logging.error('%s: with full trace: %s' % (name, traceback.format_exc()))
+                return False
+            plots += step_plots
+            results.update(step_results)
+            if gate and 'fail' in gate:
+                logging.warning('%s: failed quality gate after step %s: %s' % (name, steps[step], gate['fail']))
+                return False
+            elif gate and 'reroute' in gate:
+                logging.info('%s: rerouted after step %s to steps %s%s' % (name, steps[step], str(gate['reroute']),
+                                                                       (': ' + gate['reason']) if 'reason' in gate else ''))
+                steps = steps[:step+1] + list(gate['reroute'])
+            step += 1
+        return True
+
+    def _Run_Steps_Concurrent(self, steps, IMG, pixscale, name, results, timers, plots, start, **kwargs):
+        """
+        Internal, run the pipeline steps on a pool of "step_threads" threads, each step starts as soon as
+        the steps it depends on have finished (see Step_Graph). A step sees a copy of the results as they
+        were when it started. If a quality gate reroutes the image, the running steps are allowed to finish
+        and the new steps are run after them.
+
+        returns: True if all steps completed, False otherwise
+        """
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        depends = self.Step_Graph(steps)
+        done = set()
+        running = {}
+        failed = False
+        reroute = None
+        with ThreadPoolExecutor(kwargs['step_threads']) as executor:
+            while len(running) > 0 or (not failed and len(done) < len(steps)):
+                # Start every step whose dependencies are done
+                if not failed and reroute is None:
+                    for j in range(len(steps)):
+                        if not j in done and not j in running.values() and depends[j] <= done:
+                            logging.info('%s: %s at: %.1f sec' % (name, steps[j], time() - start))
+                            if 'verbose' in kwargs and kwargs['verbose']:
+                                print('%s: %s at: %.1f sec' % (name, steps[j], time() - start))
+                            running[executor.submit(self._Run_Step, steps[j], IMG, pixscale, name, dict(results), **kwargs)] = j
+                if len(running) > 0:
+                    finished, _ = wait(list(running.keys()), return_when = FIRST_COMPLETED)
+                else:
+                    finished = []
+                for future in finished:
+                    j = running.pop(future)
+                    try:
+                        step_results, step_plots, gate, timers[steps[j]] = future.result()
+                    except Exception as e:
+                        logging.error('%s: on step %s got error: %s' % (name, steps[j], str(e)))
+                        logging.error('%s: with full trace: %s' % (name, ''.join(traceback.format_exception(type(e), e, e.__traceback__))))
+                        failed = True
+                        continue
+                    plots += step_plots
+                    results.update(step_results)
+                    done.add(j)
+                    if gate and 'fail' in gate:
+                        logging.warning('%s: failed quality gate after step %s: %s' % (name, steps[j], gate['fail']))
+                        failed = True
+                    elif gate and 'reroute' in gate and reroute is None:
+                        logging.info('%s: rerouted after step %s to steps %s%s' % (name, steps[j], str(gate['reroute']),
+                                                                               (': ' + gate['reason']) if 'reason' in gate else ''))
+                        reroute = list(gate['reroute'])
+                # Once the running steps are done, replace the remaining steps with the rerouted ones
+                if not reroute is None and len(running) == 0 and not failed:
+                    steps = list(steps[i] for i in sorted(done)) + reroute
+                    done = set(range(len(done)))
+                    depends = self.Step_Graph(steps)
+                    reroute = None
+        return not failed
 
     def WriteProf(self, results, saveto, pixscale, name = None, **kwargs):
         """
@@ -134,21 +442,24 @@ class Isophote_Pipeline(object):
             # is very easy to compress
             os.system('gzip -fq '+ saveto + name + '_mask.fits')
             
-    def Process_Image(self, IMG, pixscale, saveto = None, name = None, kwargs_internal = {}, **kwargs):
+    def Process_Image(self, IMG, pixscale, saveto = None, name = None, kwargs_internal = {}, index = 0, **kwargs):
         """
         Function which runs the pipeline for a single image. Each sub-function of the pipeline is run
         in order and the outputs are passed along. If multiple images are given, the pipeline is
         excecuted on the first image and the isophotes are applied to the others.
         
-        IMG: string or list of strings providing the path to an image file
-        pixscale: angular size of the pixels in arcsec/pixel
+        IMG: string path to an image file, or a 2d ndarray with the image itself. With "cutout_center"
+             and "cutout_size" this is a mosaic file and the image is a stamp cut out of it (see Read_Cutout)
+        pixscale: angular size of the pixels in arcsec/pixel, None to read it from the image header (see "header_keys")
         saveto: string or list of strings indicating where to save profiles
         name: string name of galaxy in image, used for log files to make searching easier
+        index: position of the image in a list of images, used to select galaxies for "plot_every"
 
         returns list of times for each pipeline step if successful. else returns 1
         """
 
         kwargs.update(kwargs_internal)
+        Configure_Logging(**kwargs)
 
         try:
             sleep(0.01)
@@ -157,12 +468,22 @@ class Isophote_Pipeline(object):
             pass
         
         # use filename if no name is given
-        if name is None:
+        if name is None and type(IMG) == np.ndarray:
+            name = 'image%i' % index
+        elif name is None:
             name = IMG[(IMG.rfind('/') if '/' in IMG else 0):IMG.find('.', (IMG.rfind('/') if '/' in IMG else 0))]
+            if 'cutout_center' in kwargs:
+                name += '_%i_%i' % (int(np.round(kwargs['cutout_center']['x'])), int(np.round(kwargs['cutout_center']['y'])))
 
         # Read the primary image
+        valid = None
         try:
-            dat = Read_Image(IMG, **kwargs)
+            if type(IMG) == np.ndarray:
+                dat, header = IMG, {}
+            elif 'cutout_center' in kwargs:
+                dat, header, valid = Read_Cutout(IMG, kwargs['cutout_center'], kwargs['cutout_size'], return_header = True, return_valid = True, **kwargs)
+            else:
+                dat, header = Read_Image(IMG, return_header = True, **kwargs)
         except:
             logging.error('%s: could not read image %s' % (name, str(IMG)))
             return 1
@@ -172,60 +493,237 @@ class Isophote_Pipeline(object):
             logging.error('%s Large chunk of data missing, impossible to process image' % name)
             return 1
         
+        # Use trusted values from the image header, user set values take precedence
+        if 'header_keys' in kwargs:
+            header_values = Header_Values(header, kwargs['header_keys'])
+            logging.info('%s: values from header: %s' % (name, str(header_values)))
+            if 'pixscale' in header_values:
+                if pixscale is None:
+                    pixscale = header_values['pixscale']
+                elif abs(header_values['pixscale'] - pixscale) > 1e-3*pixscale:
+                    logging.warning('%s: header pixscale %f differs from the given pixscale %f, using the given value' % (name, header_values['pixscale'], pixscale))
+            for quantity, setting in [('psf fwhm', 'psf_set'), ('background', 'background_set'), ('background noise', 'background_noise_set')]:
+                if quantity in header_values and not setting in kwargs:
+                    kwargs[setting] = header_values[quantity]
+                    
+        if pixscale is None:
+            logging.error('%s: no pixscale given and none found in the image header' % name)
+            return 1
+
+        # Identify the exposure for the psf cache from the image header
+        if 'psf_cache_header' in kwargs and not 'psf_cache_key' in kwargs:
+            try:
+                kwargs['psf_cache_key'] = str(header[kwargs['psf_cache_header']])
+            except:
+                logging.warning('%s: could not read psf cache keyword %s from header' % (name, kwargs['psf_cache_header']))
+        
         # Save profile to the same folder as the image if no path is provided
         if saveto is None:
             saveto = './'
             
+        # Decide which galaxies get diagnostic plots, the plots are rendered in the background
+        # once the pipeline is done. With "plot_failed" the decision waits for the checkfit results
+        plot_selected = True
+        if 'doplot' in kwargs and kwargs['doplot']:
+            if 'plot_every' in kwargs:
+                plot_selected = index % kwargs['plot_every'] == 0
+            elif 'plot_failed' in kwargs and kwargs['plot_failed']:
+                plot_selected = False
+            if not plot_selected and not ('plot_failed' in kwargs and kwargs['plot_failed']):
+                kwargs['doplot'] = False
+        plots = []
+            
         # Track time to run analysis
         start = time()
         
         # Run the Pipeline
         timers = {}
         results = {}
+        # Stamps which run off the edge of a mosaic are zero padded, steps mask the padding
+        if not valid is None and not np.all(valid):
+            logging.info('%s: cutout runs off the mosaic edge, masking %i padded pixels' % (name, np.sum(np.logical_not(valid))))
+            results['cutout mask'] = np.logical_not(valid)
 
         # Preprocess the image if needed
         if self.preprocess:
             logging.info('%s: Preprocessing Image' % name)
-            print('%s: Preprocessing Image' % name)
+            if 'verbose' in kwargs and kwargs['verbose']:
+                print('%s: Preprocessing Image' % name)
             dat = self.preprocess(dat)
             timers['preprocess'] = time() - start
             
-        for step in range(len(self.pipeline_steps)):
-            try:
-                step_start = time()
-                logging.info('%s: %s at: %.1f sec' % (name, self.pipeline_steps[step], time() - start))
-                print('%s: %s at: %.1f sec' % (name, self.pipeline_steps[step], time() - start))
-                results.update(self.pipeline_functions[self.pipeline_steps[step]](dat, pixscale, name, results, **kwargs))
-                timers[self.pipeline_steps[step]] = time() - step_start
-            except Exception as e:
-                logging.error('%s: on step %s got error: %s' % (name, self.pipeline_steps[step], str(e)))
-                logging.error('%s: with full trace: %s' % (name, traceback.format_exc()))
-                return 1
+        if 'step_threads' in kwargs and kwargs['step_threads'] > 1:
+            success = self._Run_Steps_Concurrent(list(self.pipeline_steps), dat, pixscale, name, results, timers, plots, start, **kwargs)
+        else:
+            success = self._Run_Steps_Serial(list(self.pipeline_steps), dat, pixscale, name, results, timers, plots, start, **kwargs)
+        if not success:
+            # Plots from the completed steps help diagnose the failure
+            Submit_Plots(plots)
+            return 1
 
         # Save the profile
         logging.info('%s: saving at: %.1f sec' % (name, time() - start))
         self.WriteProf(results, saveto, pixscale, name = name, **kwargs)
+
+        if plot_selected or ('checkfit' in results and not all(results['checkfit'].values())):
+            Submit_Plots(plots)
                 
         logging.info('%s: Processing Complete! (at %.1f sec)' % (name, time() - start))
         return timers
     
-    def Process_List(self, IMG, pixscale, n_procs = 4, saveto = None, name = None, **kwargs):
+    def _Process_Indexed(self, imagedata):
         """
-        Wrapper function to run "Process_Image" in parallel for many images.
-        
-        IMG: list of strings containing image file paths
-        pixscale: angular pixel size in arcsec/pixel
-        n_procs: number of processors to use
-        saveto: list of strings containing file paths to save profiles
-        name: names of the galaxies, used for logging
+        Internal, run Process_Image for one entry of the Process_List image data and return it with its index.
         """
+        return imagedata[5], self.Process_Image(*imagedata, **_batch_kwargs)
 
-        assert type(IMG) == list
-        
-        # Format the inputs so that they can be zipped with the images files
-        # and passed to the Process_Image function.
-        if type(pixscale) in [float, int]:
-            use_pixscale = [float(pixscale)]*len(IMG)
+    def _Parallel_Fit(self, imagedata, shared):
+        """
+        Internal, True if the isophote fit of any image is set to use several processes ("fit_chains" or "fit_procs").
+        """
+        return any(('fit_chains' in kw and not kw['fit_chains'] is None and kw['fit_chains'] > 1) or
+                   ('fit_procs' in kw and not kw['fit_procs'] is None and kw['fit_procs'] > 1) for kw in [shared] + list(data[4] for data in imagedata))
+
+    def _Supervised_Image(self, conn, imagedata, shared):
+        """
+        Internal, run Process_Image in a supervised worker process and send the result back. Log
+        messages are sent over the same connection, since the worker may be killed at any time.
+        The shared arguments are passed in rather than inherited, so this also works when worker
+        processes are spawned instead of forked.
+        """
+        _Set_Batch_Kwargs(shared)
+        # Stopping the worker runs the normal exit, which closes any pool started for the isophote fit
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        handler = Log_To_Pipe(conn)
+        res = self.Process_Image(*imagedata, **_batch_kwargs)
+        with handler.lock:
+            conn.send(('result', res))
+        Flush_Plots()
+
+    def _Receive_Supervised(self, task):
+        """
+        Internal, read the messages waiting from a supervised worker, log records are written to the
+        log file and the result is stored in the task.
+        """
+        try:
+            while task['conn'].poll():
+                message = task['conn'].recv()
+                if message[0] == 'log':
+                    Handle_Log_Record(message[1])
+                else:
+                    task['result'] = message[1]
+        except (EOFError, OSError):
+            task['closed'] = True
+
+    def _Process_Supervised(self, imagedata, shared, n_procs):
+        """
+        Internal, run Process_Image for each entry of the Process_List image data, each in a new worker
+        process with at most n_procs running at once. A worker which is still running "image_timeout"
+        seconds after it started (if set) is killed and replaced, so one stuck image cannot hold up the batch.
+        The workers are not daemonic, so unlike Pool workers they can start processes of their own for
+        "fit_chains" and "fit_procs".
+        A worker which has returned its result is left to finish rendering its diagnostic plots until
+        its timeout, without taking up one of the n_procs places.
+
+        imagedata: Process_Image arguments for each image, any iterable, read as workers become free
+        shared: arguments shared by all images, from _Format_List
+
+        returns: dictionary of results with the image index as key, 'timeout' for the images that ran out of time
+        """
+        from multiprocessing import Process, Pipe
+        from multiprocessing.connection import wait
+        res = {}
+        pending = iter(imagedata)
+        data = next(pending, None)
+        active = {}
+        while not data is None or len(active) > 0:
+            while not data is None and sum(1 for task in active.values() if not 'draining' in task) < n_procs:
+                receive, send = Pipe(duplex = False)
+                # not daemonic, so the worker can start processes for a parallel isophote fit
+                worker = Process(target = self._Supervised_Image, args = (send, data, shared), daemon = False)
+                worker.start()
+                send.close()
+                timeout = data[4]['image_timeout'] if 'image_timeout' in data[4] else (shared['image_timeout'] if 'image_timeout' in shared else np.inf)
+                active[worker] = {'index': data[5], 'name': data[3] if not data[3] is None else (data[0] if type(data[0]) == str else 'image%i' % data[5]),
+                                  'start': time(), 'deadline': time() + timeout, 'conn': receive}
+                data = next(pending, None)
+            # Sleep until a worker sends something, finishes, or the next timeout is due
+            deadline = min(task['deadline'] for task in active.values())
+            wait(list(task['conn'] for task in active.values()) + list(worker.sentinel for worker in active.keys()),
+                 timeout = None if deadline == np.inf else max(0., deadline - time()))
+            for worker in list(active.keys()):
+                task = active[worker]
+                self._Receive_Supervised(task)
+                if not 'result' in task and ('closed' in task or not worker.is_alive()):
+                    # read anything sent just before the worker stopped
+                    self._Receive_Supervised(task)
+                running = worker.is_alive() and not 'closed' in task and time() < task['deadline']
+                if 'draining' in task:
+                    # result already stored, waiting for the diagnostic plots
+                    if running:
+                        continue
+                elif 'result' in task:
+                    res[task['index']] = task['result']
+                    if running:
+                        task['draining'] = True
+                        continue
+                elif 'closed' in task or not worker.is_alive():
+                    logging.error('%s: worker stopped without returning a result' % task['name'])
+                    res[task['index']] = 1
+                elif time() > task['deadline']:
+                    logging.error('%s: timed out after %.1f sec, worker stopped' % (task['name'], time() - task['start']))
+                    res[task['index']] = 'timeout'
+                else:
+                    continue
+                if worker.is_alive():
+                    worker.terminate()
+                    # the worker closes any fit processes it started on the way out, unless it is stuck
+                    worker.join(5)
+                    if worker.is_alive():
+                        worker.kill()
+                        worker.join()
+                task['conn'].close()
+                del active[worker]
+        return res
+
+    def Estimate_Cost(self, IMG, **kwargs):
+        """
+        Rough relative cost of processing an image, used by Process_List to start the most expensive
+        images first. Set by "batch_cost": 'pixels' (default) the number of pixels from the image
+        header, 'filesize' the size of the image file, or a number given by the user.
+
+        IMG: string path to an image file, or the image as a 2d ndarray
+
+        returns: estimated cost, larger is slower
+        """
+        method = kwargs['batch_cost'] if 'batch_cost' in kwargs else 'pixels'
+        if type(method) in [int, float]:
+            return float(method)
+        if type(IMG) == np.ndarray:
+            return float(IMG.size)
+        if 'cutout_size' in kwargs:
+            return float(kwargs['cutout_size'])**2
+        try:
+            if method == 'pixels':
+                pixels = Image_Pixels(IMG, **kwargs)
+                if not pixels is None:
+                    return float(pixels)
+            return float(os.path.getsize(IMG))
+        except:
+            logging.warning('could not estimate the processing cost of %s' % str(IMG))
+            return 0.
+
+    def _Format_List(self, IMG, pixscale, saveto = None, name = None, **kwargs):
+        """
+        Internal, format the Process_List inputs so that they can be zipped with the image files
+        and passed to the Process_Image function. Arguments given as a list (one value per image)
+        are split out, so each image only carries the values which differ from the other images.
+        A None in one of these lists means the argument is not given for that image.
+
+        returns: list of Process_Image arguments for each image, dictionary of arguments shared by all images
+        """
+        if pixscale is None or type(pixscale) in [float, int]:
+            use_pixscale = [None if pixscale is None else float(pixscale)]*len(IMG)
         else:
             use_pixscale = pixscale
         if saveto is None:
@@ -241,101 +739,332 @@ class Isophote_Pipeline(object):
         else:
             use_name = name
 
-        if all(type(v) != list for v in kwargs.values()):
-            use_kwargs = [kwargs]*len(IMG)
+        per_image = list(k for k in kwargs.keys() if type(kwargs[k]) == list)
+        shared = dict((k, kwargs[k]) for k in kwargs.keys() if not k in per_image)
+        use_kwargs = list(dict((k, kwargs[k][i]) for k in per_image if not kwargs[k][i] is None) for i in range(len(IMG)))
+        return list(zip(IMG, use_pixscale, use_saveto, use_name, use_kwargs, range(len(IMG)))), shared
+
+    def _Run_List(self, imagedata, shared, n_procs):
+        """
+        Internal, run Process_Image for each entry of formatted image data, see Process_List.
+
+        imagedata: Process_Image arguments for each image, from _Format_List
+        shared: arguments shared by all images, from _Format_List
+
+        returns: dictionary of results with the image index as key
+        """
+        # The worker processes are forked from here, or get the shared arguments once from the pool initializer
+        _Set_Batch_Kwargs(shared)
+        timeout = 'image_timeout' in shared or any('image_timeout' in data[4] for data in imagedata)
+        # Pool workers are daemonic and cannot start the processes for a parallel isophote fit, supervised workers can
+        timeout = timeout or (n_procs > 1 and self._Parallel_Fit(imagedata, shared))
+        if n_procs > 1 or timeout:
+            # Longest first, so a few large galaxies do not hold up the end of the run
+            costs = np.array(list(self.Estimate_Cost(data[0], **dict(shared, **data[4])) for data in imagedata))
+            order = np.argsort(-costs, kind = 'stable')
+        if timeout:
+            res = self._Process_Supervised(list(imagedata[i] for i in order), shared, max(1, n_procs))
+        elif n_procs > 1:
+            heavy = list(imagedata[i] for i in order if costs[i] > np.mean(costs))
+            light = list(imagedata[i] for i in order if costs[i] <= np.mean(costs))
+            logging.info('Processing %i images above average cost one at a time, %i in chunks' % (len(heavy), len(light)))
+            res = {}
+            with Pool(n_procs, initializer = _Init_Batch_Worker, initargs = (shared, Log_Settings())) as pool:
+                # The tasks share one queue, idle processes take the next task as soon as they are free
+                batches = [pool.imap_unordered(self._Process_Indexed, heavy, chunksize = 1),
+                           pool.imap_unordered(self._Process_Indexed, light, chunksize = int(np.clip(len(light) / (4*n_procs), a_min = 1, a_max = 5)))]
+                for batch in batches:
+                    for i, r in batch:
+                        res[i] = r
+                # Let the workers exit normally so they finish rendering their diagnostic plots
+                pool.close()
+                pool.join()
         else:
-            use_kwargs = []
-            for i in range(len(IMG)):
-                tmp_kwargs = {}
-                for k in kwargs.keys():
-                    if type(kwargs[k]) == list:
-                        tmp_kwargs[k] = kwargs[k][i]
-                    else:
-                        tmp_kwargs[k] = kwargs[k]
-                use_kwargs.append(tmp_kwargs)
+            res = dict(map(self._Process_Indexed, imagedata))
+            Flush_Plots()
+        return res
+        
+    def Process_List(self, IMG, pixscale, n_procs = 4, saveto = None, name = None, **kwargs):
+        """
+        Wrapper function to run "Process_Image" in parallel for many images.
+        
+        IMG: list of strings containing image file paths
+        pixscale: angular pixel size in arcsec/pixel
+        n_procs: number of processors to use
+        saveto: list of strings containing file paths to save profiles
+        name: names of the galaxies, used for logging
+
+        When running in parallel the images are started in order of their estimated cost (see Estimate_Cost),
+        most expensive first. Images costing more than average are handed out to the processes one at a time,
+        the rest in small chunks. If "image_timeout" is given, every image runs in its own worker process
+        which is stopped once the timeout (seconds) has passed. The results are returned in the same order
+        as IMG, with the timers for each image, 1 for a failed image, or 'timeout'.
+        """
+
+        assert type(IMG) == list
+        Configure_Logging(**kwargs)
+        
         # Track how long it takes to run the analysis
         start = time()
         
-        # Create a multiprocessing pool to parallelize image processing
-        imagedata = list(zip(IMG, use_pixscale, use_saveto,
-                             use_name, use_kwargs))
-        if n_procs > 1:
-            with Pool(n_procs) as pool:
-                res = pool.starmap(self.Process_Image,
-                                   imagedata,
-                                   chunksize = 5 if len(IMG) > 100 else 1)
-        else:
-            res = list(starmap(self.Process_Image, imagedata))
-            
-        # Report completed processing, and track time used
+        imagedata, shared = self._Format_List(IMG, pixscale, saveto, name, **kwargs)
+        res = self._Run_List(imagedata, shared, n_procs)
+        res = list(res[i] for i in range(len(IMG)))
+        self._Report_Timers(res, start)
+        
+        # Return the success/fail indicators for every Process_Image excecution
+        return res
+
+    def _Report_Timers(self, res, start):
+        """
+        Internal, log the number of images completed and the average time taken by each pipeline step.
+        """
         logging.info('All Images Finished Processing at %.1f' % (time() - start))
         timers = dict((s,0) for s in self.pipeline_steps)
         count_success = 0.
         for r in res:
-            if r == 1:
+            if type(r) != dict:
                 continue
             count_success += 1.
             for s in self.pipeline_steps:
-                timers[s] += r[s]
+                # steps can be skipped when a quality gate reroutes an image
+                timers[s] += r[s] if s in r else 0.
+        logging.info('%i of %i images completed, %i timed out' % (count_success, len(res), sum(r == 'timeout' for r in res)))
         for s in self.pipeline_steps:
-            timers[s] /= count_success
+            timers[s] /= max(1., count_success)
             logging.info('%s took %.3f seconds on average' % (s, timers[s]))
+
+    def _Catalogue_Tasks(self, rows, pixscale, saveto, mosaic_file = None, cutout_size = None, header_pixscale = False):
+        """
+        Internal, turn catalogue rows into Process_Image arguments as they are read. Values for the
+        pixel scale and save location from the catalogue take precedence over the given ones. Rows
+        without an image file are cut out of the mosaic. With "header_pixscale" rows may have no
+        pixel scale, it is then read from the image header.
+        """
+        for index, row in enumerate(rows):
+            if 'image_file' in row:
+                IMG = row.pop('image_file')
+            elif 'mosaic_file' in row or not mosaic_file is None:
+                IMG = row['mosaic_file'] if 'mosaic_file' in row else mosaic_file
+                if not 'cutout_center' in row or not all(c in row['cutout_center'] for c in ['x', 'y']):
+                    raise ValueError('catalogue row %i has no image_file or cutout_center.x and cutout_center.y for the mosaic' % index)
+                if not 'cutout_size' in row and cutout_size is None:
+                    raise ValueError('no cutout_size given for catalogue row %i' % index)
+            else:
+                raise ValueError('catalogue row %i has no image_file' % index)
+            use_pixscale = row.pop('pixscale') if 'pixscale' in row else pixscale
+            use_saveto = row.pop('saveto') if 'saveto' in row else saveto
+            use_name = row.pop('name') if 'name' in row else None
+            if use_pixscale is None and not header_pixscale:
+                raise ValueError('no pixscale given for catalogue row %i (%s)' % (index, IMG))
+            yield (IMG, None if use_pixscale is None else float(use_pixscale), use_saveto, None if use_name is None else str(use_name), row, index)
+
+    def _Tile_Order(self, imagedata, tile, group):
+        """
+        Internal, reorder image data for cutouts from a mosaic so that stamps from the same tile of the
+        mosaic ("tile" pixels on a side) are processed together, which keeps the pages of the mosaic
+        being read in the page cache. Only "group" entries are read ahead and reordered at a time, and
+        the tiles are visited in the order they are stored in the file.
+        """
+        def tile_key(data):
+            if not 'cutout_center' in data[4]:
+                return (-1, -1)
+            return (int(data[4]['cutout_center']['y'] // tile), int(data[4]['cutout_center']['x'] // tile))
+        buffer = []
+        for data in imagedata:
+            buffer.append(data)
+            if len(buffer) >= group:
+                buffer.sort(key = tile_key)
+                for data in buffer:
+                    yield data
+                buffer = []
+        buffer.sort(key = tile_key)
+        for data in buffer:
+            yield data
+
+    def _Run_Stream(self, imagedata, shared, n_procs, **kwargs):
+        """
+        Internal, run Process_Image for image data read from an iterator. Only a limited number of images
+        ("catalogue_buffer", default 20 per process) are read ahead of the ones being processed, so the
+        full list is never held in memory. Since the images are not known in advance they are processed in
+        the order they are read, see Process_List for the version which orders them by cost.
+
+        returns: dictionary of results with the image index as key
+        """
+        _Set_Batch_Kwargs(shared)
+        if 'image_timeout' in shared or (n_procs > 1 and self._Parallel_Fit([], shared)):
+            res = self._Process_Supervised(imagedata, shared, max(1, n_procs))
+        elif n_procs > 1:
+            from threading import BoundedSemaphore
+            slots = BoundedSemaphore(int(kwargs['catalogue_buffer']) if 'catalogue_buffer' in kwargs else 20*n_procs)
+            def throttled():
+                # runs in the pool task thread, waits here while the buffer is full
+                for data in imagedata:
+                    slots.acquire()
+                    yield data
+            res = {}
+            with Pool(n_procs, initializer = _Init_Batch_Worker, initargs = (shared, Log_Settings())) as pool:
+                for i, r in pool.imap_unordered(self._Process_Indexed, throttled()):
+                    res[i] = r
+                    slots.release()
+                # Let the workers exit normally so they finish rendering their diagnostic plots
+                pool.close()
+                pool.join()
+        else:
+            res = dict(map(self._Process_Indexed, imagedata))
+            Flush_Plots()
+        return res
         
-        # Return the success/fail indicators for every Process_Image excecution
+    def Process_Catalogue(self, catalogue_file, pixscale = None, n_procs = 4, saveto = None, name = None, **kwargs):
+        """
+        Run "Process_Image" for every row of a catalogue file, see Catalogue.Read_Catalogue for the
+        formats. The catalogue columns give the image file and the arguments which differ between
+        galaxies (ie: name, pixscale, given_center.x, given_center.y, psf_set, forcing_profile), the
+        arguments given here are used for all rows. Rows are read as the images are processed, so very
+        large catalogues can be run without building per galaxy lists in memory.
+
+        With "mosaic_file", rows without an image file give the position ("cutout_center.x" and
+        "cutout_center.y" columns) and width ("cutout_size") of a stamp in the mosaic. The stamps are cut
+        out by the worker processes from a memory mapped mosaic, and rows are grouped by mosaic tile
+        ("mosaic_tile" pixels, "mosaic_group" rows at a time) so nearby galaxies are processed together.
+
+        catalogue_file: string path to the catalogue
+        pixscale: angular pixel size in arcsec/pixel, used for rows without a pixscale value
+        n_procs: number of processors to use
+        saveto: path to save profiles, used for rows without a saveto value
+        name: not used, galaxy names come from the "name" column (or the image file names)
+
+        returns: list of results in catalogue order, as for Process_List
+        """
+        Configure_Logging(**kwargs)
+        start = time()
+        tasks = self._Catalogue_Tasks(Read_Catalogue(catalogue_file, **kwargs), pixscale, saveto, kwargs['mosaic_file'] if 'mosaic_file' in kwargs else None,
+                                      kwargs['cutout_size'] if 'cutout_size' in kwargs else None,
+                                      'header_keys' in kwargs and 'pixscale' in kwargs['header_keys'])
+        if 'mosaic_file' in kwargs and not kwargs['mosaic_file'] is None:
+            tasks = self._Tile_Order(tasks, kwargs['mosaic_tile'] if 'mosaic_tile' in kwargs else 2048, kwargs['mosaic_group'] if 'mosaic_group' in kwargs else 1000)
+        res = self._Run_Stream(tasks, kwargs, n_procs, **kwargs)
+        res = list(res[i] for i in range(len(res)))
+        self._Report_Timers(res, start)
         return res
         
+    def _Queue_Heartbeat(self, queue_file, claim, interval, stop):
+        """
+        Internal, send a heartbeat for the claimed tasks every "interval" seconds until "stop" is set.
+        """
+        while not stop.wait(interval):
+            try:
+                owned = Queue_Heartbeat(queue_file, claim)
+            except Exception as e:
+                logging.warning('could not send queue heartbeat: %s' % str(e))
+                continue
+            if len(owned) < len(claim):
+                logging.warning('Images %s were reclaimed by another worker, their results will be discarded' % str(list(i for i in claim if not i in owned)))
+
+    def Process_Queue(self, queue_file, settings = None):
+        """
+        Work on the images in a queue file until none are left, see Work_Queue. The config file and
+        working directory are read from the queue, so many workers, on any machines which share the
+        filesystem, can run from the one queue. Tasks are claimed "queue_batch" at a time (default n_procs)
+        and processed as in Process_List, the results are written back to the queue. While they run, a
+        thread sends a heartbeat for the claimed tasks every quarter of "queue_stale" (at most every minute),
+        so only tasks of a worker which has died are reclaimed.
+
+        queue_file: string path to a queue file made by Process_ConfigFile with "queue_file"
+        settings: Settings already loaded from the queue config file, if None the config file is read
+                  from the queue and processing runs in the queue working directory
+
+        returns: dictionary with the number of tasks in each state once this worker is done
+        """
+        queue_file = os.path.abspath(queue_file)
+        if settings is None:
+            meta = Queue_Meta(queue_file)
+            # relative paths in the config file are relative to where the queue was created
+            cwd = os.getcwd()
+            os.chdir(meta['working directory'])
+            try:
+                return self.Process_Queue(queue_file, self._Load_Config(meta['config file']))
+            finally:
+                os.chdir(cwd)
+        use_kwargs = dict(settings.kwargs)
+        n_procs = use_kwargs.pop('n_procs')
+        Configure_Logging(**use_kwargs)
+        imagedata, shared = self._Format_List(settings.image_file, settings.pixscale, **use_kwargs)
+        
+        stale = use_kwargs['queue_stale'] if 'queue_stale' in use_kwargs else 3600.
+        # Tasks are identified by their index, the image list must come out the same for every worker
+        mismatch = Queue_Check_Images(queue_file, settings.image_file)
+        if not mismatch is None:
+            logging.error('Worker %s image list does not match the queue, not starting: %s' % (Queue_Worker_ID(), mismatch))
+            Queue_Journal(queue_file, 'refused', message = mismatch)
+            return Queue_Status(queue_file)
+        Queue_Journal(queue_file, 'start', message = 'n_procs %i' % n_procs)
+        logging.info('Worker %s started on queue %s' % (Queue_Worker_ID(), queue_file))
+        while True:
+            claim = Queue_Claim(queue_file, batch = use_kwargs['queue_batch'] if 'queue_batch' in use_kwargs else max(1, n_procs),
+                                stale = stale, retries = use_kwargs['queue_retries'] if 'queue_retries' in use_kwargs else 2)
+            if len(claim) == 0:
+                break
+            logging.info('Claimed images: %s' % str(claim))
+            stop = Event()
+            heartbeat = Thread(target = self._Queue_Heartbeat, args = (queue_file, claim, min(60., stale/4.), stop), daemon = True)
+            heartbeat.start()
+            try:
+                res = self._Run_List(list(imagedata[i] for i in claim), shared, n_procs)
+            finally:
+                stop.set()
+                heartbeat.join()
+            Queue_Finish(queue_file, res)
+        status = Queue_Status(queue_file)
+        Queue_Journal(queue_file, 'stop', message = str(status))
+        logging.info('No tasks left to claim, queue status: %s' % str(status))
+        return status
+        
+    def _Load_Config(self, config_file):
+        """
+        Internal, read a configuration file (see Settings.Read_Settings) and update the pipeline with
+        the steps and functions it sets.
+
+        returns: Settings for the run
+        """
+        settings = Read_Settings(config_file)
+
+        if 'forced' in settings.process_mode:
+            self.UpdatePipeline(new_pipeline_steps = ['background', 'psf', 'center forced', 'isophoteinit',
+                                                      'isophotefit forced', 'starmask forced', 'isophoteextract forced'])
+        # An invalid list of steps should stop AutoProf here, rather than fail on every image
+        self.UpdatePipeline(**settings.pipeline)
+        return settings
+    
     def Process_ConfigFile(self, config_file):
         """
         Reads in a configuration file and sets parameters for the pipeline. The configuration
-        file should have variables corresponding to the desired parameters to be set.
+        file should have variables corresponding to the desired parameters to be set. It can
+        be a python, YAML or TOML file, see Settings.Read_Settings.
 
         congif_file: string path to configuration file
 
         returns: timing of each pipeline step if successful. Else returns 1
         """
 
-        
-        # Import the config file regardless of where it is from
-        if '/' in config_file:
-            startat = config_file.rfind('/')+1
-        else:
-            startat = 0
-        if '.' in config_file:
-            use_config = config_file[startat:config_file.find('.', startat)]
-        else:
-            use_config = config_file[startat:] # config_file[:-3] if config_file[-3:] == '.py' else config_file
-        if '/' in config_file:
-            sys.path.append(config_file[:config_file.rfind('/')])
-        try:
-            c = importlib.import_module(use_config)
-        except:
-            sys.path.append(os.getcwd())
-            c = importlib.import_module(use_config)
+        settings = self._Load_Config(config_file)
+        use_kwargs = dict(settings.kwargs)
 
-        if 'forced' in c.process_mode:
-            self.UpdatePipeline(new_pipeline_steps = ['background', 'psf', 'center forced', 'isophoteinit',
-                                                      'isophotefit forced', 'starmask forced', 'isophoteextract forced'])
-            
-        try:
-            self.UpdatePipeline(new_pipeline_functions = c.new_pipeline_functions)
-        except:
-            pass
-        try:
-            self.UpdatePipeline(new_pipeline_steps = c.new_pipeline_steps)
-        except:
-            pass
-        try:
-            self.UpdatePipeline(preprocess = c.preprocess)
-        except:
-            pass
-            
-        use_kwargs = GetKwargs(c)
+        if 'psf_cache_reset' in use_kwargs and use_kwargs['psf_cache_reset']:
+            from autoprofutils.PSF import Clear_PSF_Cache
+            Clear_PSF_Cache(use_kwargs['psf_cache_file'] if 'psf_cache_file' in use_kwargs else 'AutoProf_PSF.cache')
             
-        if c.process_mode in ['image', 'forced image']:
-            return self.Process_Image(IMG = c.image_file, pixscale = c.pixscale, **use_kwargs)
-        elif c.process_mode in ['image list', 'forced image list']:
-            return self.Process_List(IMG = c.image_file, pixscale = c.pixscale, **use_kwargs)
+        if settings.process_mode in ['image', 'forced image']:
+            return self.Process_Image(IMG = settings.image_file, pixscale = settings.pixscale, **use_kwargs)
+        elif settings.process_mode in ['image list', 'forced image list'] and 'queue_file' in use_kwargs:
+            # Put the images in a shared queue, this process then works on it like any other worker
+            Queue_Create(use_kwargs['queue_file'], config_file, settings.image_file)
+            return self.Process_Queue(use_kwargs['queue_file'], settings)
+        elif settings.process_mode in ['image list', 'forced image list']:
+            return self.Process_List(IMG = settings.image_file, pixscale = settings.pixscale, **use_kwargs)
+        elif settings.process_mode in ['catalogue', 'forced catalogue']:
+            return self.Process_Catalogue(use_kwargs.pop('catalogue_file'), pixscale = settings.pixscale, **use_kwargs)
         else:
-            logging.error('Unrecognized process_mode! Should be in: [image, image list, forced image, forced image list]')
+            logging.error('Unrecognized process_mode! Should be in: [image, image list, forced image, forced image list, catalogue, forced catalogue]')
             return 1
         
@@ -7,16 +7,29 @@ from Pipeline import Isophote_Pipeline
 
 assert len(sys.argv) >= 2
 
-config_file = sys.argv[1]
+# Worker mode: autoprof.py --worker queue_file [logfile.log]
+if sys.argv[1] == '--worker':
+    assert len(sys.argv) >= 3
+    queue_file = sys.argv[2]
+    argstart = 3
+else:
+    config_file = sys.argv[1]
+    argstart = 2
 
 try:
-    if '.log' == sys.argv[2][-4:]:
-        logfile = sys.argv[2]
+    if '.log' == sys.argv[argstart][-4:]:
+        logfile = sys.argv[argstart]
     else:
         logfile = None
 except:
     logfile = None
 
-PIPELINE = Isophote_Pipeline(loggername = logfile)
-
-PIPELINE.Process_ConfigFile(config_file)
+if sys.argv[1] == '--worker':
+    # Workers in the same directory should not overwrite each others log files
+    if logfile is None:
+        logfile = 'AutoProf_worker_%i.log' % os.getpid()
+    PIPELINE = Isophote_Pipeline(loggername = logfile)
+    PIPELINE.Process_Queue(queue_file)
+else:
+    PIPELINE = Isophote_Pipeline(loggername = logfile)
+    PIPELINE.Process_ConfigFile(config_file)
@@ -1,16 +1,51 @@
-from photutils import make_source_mask
-from photutils.isophote import EllipseSample, Ellipse, EllipseGeometry, Isophote, IsophoteList
-from astropy.stats import sigma_clipped_stats
 from scipy.stats import iqr
 from scipy.optimize import minimize
+from scipy.ndimage import gaussian_filter, maximum_filter, label
 from time import time
 import logging
 import numpy as np
-import matplotlib.pyplot as plt
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
 
 
+def _Background_Cutout(IMG, results):
+    """
+    Internal, stamps cut from near the edge of a mosaic are zero padded.
+    Returns the image with the padding set to NaN so it is left out of
+    the background statistics.
+    """
+    if not 'cutout mask' in results:
+        return IMG
+    IMG = np.array(IMG, dtype = float)
+    IMG[results['cutout mask']] = np.nan
+    return IMG
+
+def _Background_Set(IMG, name, **kwargs):
+    """
+    Internal, use background values given by the user (or read from the
+    image header). If only the background level is given, the noise is
+    estimated from the pixels below that level near the edge of the image.
+
+    returns: dictionary with background and background noise, or None if no
+             background level is set
+    """
+    if not 'background_set' in kwargs:
+        return None
+    if 'background_noise_set' in kwargs:
+        noise = kwargs['background_noise_set']
+    else:
+        edge_mask = np.ones(IMG.shape, dtype = bool)
+        edge_mask[int(IMG.shape[0]/5.):int(4.*IMG.shape[0]/5.),
+                  int(IMG.shape[1]/5.):int(4.*IMG.shape[1]/5.)] = False
+        values = IMG[edge_mask].flatten()[::2]
+        values = values[np.isfinite(values)]
+        noise = iqr(values[(values-kwargs['background_set']) < 0], rng = [100 - 68.2689492137,100])
+    logging.info('%s: using set background %.3e with noise %.3e' % (name, kwargs['background_set'], noise))
+    return {'background': kwargs['background_set'],
+            'background noise': noise}
+
 def Background_Mode(IMG, pixscale, name, results, **kwargs):
     """
     Compute background by finding the peak in a smoothed histogram of flux values.
@@ -22,6 +57,9 @@ def Background_Mode(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    IMG = _Background_Cutout(IMG, results)
+    if 'background_set' in kwargs:
+        return _Background_Set(IMG, name, **kwargs)
     # Mask main body of image so only outer 1/5th is used
     # for background calculation.
     edge_mask = np.ones(IMG.shape, dtype = bool)
@@ -41,20 +79,84 @@ def Background_Mode(IMG, pixscale, name, results, **kwargs):
     noise = iqr(values[(values-res.x[0]) < 0], rng = [100 - 68.2689492137,100])
     # print('noise: ', noise)
     # paper plot
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
+        plot = Plot_Spec('%sBackground_hist_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
         hist, bins = np.histogram(values[np.logical_and((values-res.x[0]) < 20*noise, (values-res.x[0]) > -3*noise)], bins = 1000)
-        plt.bar(bins[:-1], np.log10(hist), width = bins[1] - bins[0], color = 'k', label = 'pixel values')
-        plt.axvline(res.x[0], color = 'r', label = 'sky level: %.5e' % res.x[0])
-        plt.axvline(res.x[0] - noise, color = 'r', linestyle = '--', label = '1$\\sigma$ noise/pix: %.5e' % noise)
-        plt.axvline(res.x[0] + noise, color = 'r', linestyle = '--')
-        plt.legend()
-        plt.xlabel('flux')
-        plt.ylabel('log$_{10}$(count)')
-        plt.savefig('%sBackground_hist_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        Plot_Add(plot, 'bar', bins[:-1], np.log10(hist), width = bins[1] - bins[0], color = 'k', label = 'pixel values')
+        Plot_Add(plot, 'axvline', res.x[0], color = 'r', label = 'sky level: %.5e' % res.x[0])
+        Plot_Add(plot, 'axvline', res.x[0] - noise, color = 'r', linestyle = '--', label = '1$\\sigma$ noise/pix: %.5e' % noise)
+        Plot_Add(plot, 'axvline', res.x[0] + noise, color = 'r', linestyle = '--')
+        Plot_Add(plot, 'legend')
+        Plot_Add(plot, 'xlabel', 'flux')
+        Plot_Add(plot, 'ylabel', 'log$_{10}$(count)')
+        plots.append(plot)
         
     return {'background': res.x[0],
-            'background noise': noise}
+            'background noise': kwargs['background_noise_set'] if 'background_noise_set' in kwargs else noise,
+            'diagnostic plots': plots}
+
+def _Background_SourceMask(IMG, pixscale, nsigma = 3., dilate_size = 40, sigclip_iters = 5, block = None):
+    """
+    Internal, identify pixels belonging to sources (stars, galaxies) in
+    an image. The image is block averaged down to roughly 512 pixels on a
+    side, smoothed, sigma clipped and thresholded. Detected regions
+    with fewer than 1/pixscale pixels are discarded and the rest are dilated with a
+    separable square maximum filter, then the mask is expanded back to the
+    full image resolution. This mimics photutils make_source_mask at a
+    small fraction of the cost.
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    nsigma: detection threshold in units of the clipped standard deviation
+    dilate_size: width (in full resolution pixels) of the square used to grow the source regions,
+                 each region grows by about dilate_size/2 pixels on every side
+    sigclip_iters: number of sigma clipping rounds used to estimate the threshold
+    block: downsampling factor, by default chosen from the image size
+
+    returns: boolean 2d ndarray, True for source pixels
+    """
+    if block is None:
+        block = max(1, int(min(IMG.shape)/512))
+    # Block average the image, padding to a multiple of the block size
+    pad = [(0, (-IMG.shape[0]) % block), (0, (-IMG.shape[1]) % block)]
+    small = np.pad(IMG, pad, mode = 'edge')
+    small = small.reshape(small.shape[0]//block, block, small.shape[1]//block, block).mean(axis = (1,3))
+    finite = np.isfinite(small)
+    if not np.any(finite):
+        # Nothing to detect sources in
+        return np.zeros(IMG.shape, dtype = bool)
+    small[np.logical_not(finite)] = np.median(small[finite])
+
+    # Smooth on the scale of ~1 arcsec, block averaging already does some of this:
+    # a top-hat of width "block" has a standard deviation of block/sqrt(12)
+    smooth_sigma = np.sqrt(max(0., (1./(2.355*pixscale))**2 - block**2/12.)) / block
+    if smooth_sigma > 0.1:
+        small = gaussian_filter(small, smooth_sigma)
+
+    # Sigma clipped threshold for detection
+    values = small.flatten()
+    for i in range(sigclip_iters):
+        med = np.median(values)
+        std = np.std(values)
+        values = values[np.abs(values - med) < 3*std]
+    detect = small > (np.median(values) + nsigma*np.std(values))
+
+    # Remove detections which are too small to be real sources
+    regions, nregions = label(detect)
+    if nregions > 0:
+        sizes = np.bincount(regions.flatten())
+        sizes[0] = 0
+        detect = (sizes >= max(1, int(1./(pixscale*block**2))))[regions]
+
+    # Grow the source regions, size of filter is in downsampled pixels
+    dilate = int(np.ceil(dilate_size / block))
+    if dilate > 1:
+        detect = maximum_filter(detect, size = dilate)
+
+    # Return to full resolution
+    detect = np.repeat(np.repeat(detect, block, axis = 0), block, axis = 1)
+    return detect[:IMG.shape[0], :IMG.shape[1]]
 
 def Background_Global(IMG, pixscale, name, results, **kwargs):
     """
@@ -63,6 +165,9 @@ def Background_Global(IMG, pixscale, name, results, **kwargs):
     signal and masking them, also further masking a boarder
     of 20 pixels around the initial masked pixels. Returns a
     dictionary of parameters describing the background level.
+    Source detection is done on a downsampled version of the
+    image so this is cheap enough to run on large frames, the
+    downsampling factor can be set with "background_block".
 
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -70,28 +175,30 @@ def Background_Global(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    IMG = _Background_Cutout(IMG, results)
+    if 'background_set' in kwargs:
+        return _Background_Set(IMG, name, **kwargs)
 
+    # Run source mask to remove pixels with sources
+    # such as stars and galaxies, including a boarder
+    # around each source.
+    mask = _Background_SourceMask(IMG, pixscale, nsigma = 3, dilate_size = 40, sigclip_iters = 5,
+                                  block = kwargs['background_block'] if 'background_block' in kwargs else None)
     # Mask main body of image so only outer 1/5th is used
     # for background calculation.
-    edge_mask = np.zeros(IMG.shape)
-    edge_mask[int(IMG.shape[0]/5.):int(4.*IMG.shape[0]/5.),
-              int(IMG.shape[1]/5.):int(4.*IMG.shape[1]/5.)] = 1
+    mask[int(IMG.shape[0]/5.):int(4.*IMG.shape[0]/5.),
+         int(IMG.shape[1]/5.):int(4.*IMG.shape[1]/5.)] = True
+    values = IMG[np.logical_not(mask)]
+    values = values[np.isfinite(values)]
+    if len(values) < 100:
+        logging.warning('%s: global background masked nearly all pixels, using mode instead' % name)
+        return Background_Mode(IMG, pixscale, name, results, **kwargs)
 
-    # Run photutils source mask to remove pixels with sources
-    # such as stars and galaxies, including a boarder
-    # around each source.
-    mask = make_source_mask(IMG,
-                            nsigma = 3,
-                            npixels = int(1./pixscale),
-                            dilate_size = 40,
-                            filter_fwhm = 1./pixscale,
-                            filter_size = int(3./pixscale),
-                            sigclip_iters = 5)
-    mask = np.logical_or(mask, edge_mask)
-
-    # Return statistics from background sky
-    return {'background': np.median(IMG[np.logical_not(mask)]),
-            'background noise': iqr(IMG[np.logical_not(mask)],rng = [16,84])/2}
+    # Return statistics from background sky, all quantiles in a single pass
+    p16, p50, p84 = np.percentile(values, [16, 50, 84])
+    logging.info('%s: global background %.3e from %i pixels' % (name, p50, len(values)))
+    return {'background': p50,
+            'background noise': kwargs['background_noise_set'] if 'background_noise_set' in kwargs else (p84 - p16)/2}
 
 def Background_ByPatches(IMG, pixscale, name, results, **kwargs):
     """
@@ -106,6 +213,7 @@ def Background_ByPatches(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    IMG = _Background_Cutout(IMG, results)
 
     # Make the slicing commands to grab patches
     patches = [[[None,int(IMG.shape[0]/5.)],[int(IMG.shape[1]/5.),int(4*IMG.shape[1]/5.)]],
@@ -116,13 +224,16 @@ def Background_ByPatches(IMG, pixscale, name, results, **kwargs):
                [[int(3*IMG.shape[0]/4.),None],[None,int(IMG.shape[1]/4.)]],
                [[None,int(IMG.shape[0]/4.)],[int(3*IMG.shape[1]/4.),None]],
                [[int(3*IMG.shape[0]/4.), None],[int(3*IMG.shape[1]/4.),None]]]
-    clip_at = 4 * iqr(IMG)
+    clip_at = 4 * iqr(IMG, nan_policy = 'omit')
 
     # Loop through the patches and compute statistics on each
     stats = {'mean':[], 'median': [], 'std': [], 'iqr': []}
     for p in patches:
         vals = IMG[p[0][0]:p[0][1],
                    p[1][0]:p[1][1]]
+        if not np.any(vals < clip_at):
+            # patch is all padding beyond the edge of a mosaic
+            continue
         stats['mean'].append(np.mean(vals[vals < clip_at]))
         stats['median'].append(np.median(vals[vals < clip_at]))
         stats['std'].append(np.std(vals[vals < clip_at]))
@@ -149,6 +260,7 @@ def Background_ByIsophote(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils.isophote import EllipseSample, EllipseGeometry
     isophote_SBs = []
 
     R = [1./pixscale]
@@ -0,0 +1,147 @@
+import numpy as np
+import csv
+import logging
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+from autoprofutils.Settings import _argument_types, _number, _count, _flag, _text, _any
+
+# Columns read from a catalogue besides the AutoProf arguments
+_catalogue_types = dict(_argument_types, image_file = _text, pixscale = _number)
+# Types of the values in dictionary arguments filled from dotted columns (ie "given_center.x"), numbers unless given here
+_catalogue_member_types = {'header_keys': _text, 'log_levels': _text + _number}
+
+def _Convert_Text(column, value):
+    """
+    Internal, convert a value read from a text catalogue to the type of its
+    argument. Empty values are None, meaning the argument is not given.
+    Arguments which may be of any type (ie psf_cache_key) are kept as text.
+    """
+    value = value.strip()
+    if value == '' or value.lower() in ['none', 'null', 'nan']:
+        return None
+    if '.' in column:
+        parent = column.split('.')[0]
+        allowed = _catalogue_member_types[parent] if parent in _catalogue_member_types else _number
+    else:
+        allowed = _catalogue_types[column]
+    if allowed is _flag:
+        if value.lower() in ['true', 't', 'yes', 'y', '1']:
+            return True
+        if value.lower() in ['false', 'f', 'no', 'n', '0']:
+            return False
+        raise ValueError('catalogue column %s should be true or false, got %s' % (column, value))
+    if allowed is _text or allowed is _any:
+        return value
+    if allowed is _count:
+        try:
+            return int(value)
+        except ValueError:
+            raise ValueError('catalogue column %s should be an integer, got %s' % (column, value))
+    try:
+        return int(value)
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        # arguments which are text or a number (ie batch_cost)
+        if str in allowed:
+            return value
+        raise ValueError('catalogue column %s should be a number, got %s' % (column, value))
+
+def _Convert_Table(value, null = None):
+    """
+    Internal, convert a value from a FITS or Parquet table to a python value.
+    Blank values (NaN, masked, empty text, or the column "null" value for
+    FITS integer columns) are None, meaning the argument is not given.
+    """
+    if not null is None and value == null:
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, bytes):
+        value = value.decode()
+    if isinstance(value, str):
+        value = value.strip()
+        return None if value == '' else value
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    if value is np.ma.masked:
+        return None
+    return value
+
+def _Catalogue_Columns(names, **kwargs):
+    """
+    Internal, match catalogue columns to AutoProf arguments. "catalogue_columns" can rename
+    columns, ie: {'FILENAME': 'image_file'}. Columns with a "." fill a dictionary argument,
+    ie: "given_center.x" and "given_center.y". Other columns are ignored.
+
+    returns: dictionary of catalogue column names with the argument each one fills
+    """
+    rename = kwargs['catalogue_columns'] if 'catalogue_columns' in kwargs and not kwargs['catalogue_columns'] is None else {}
+    columns = {}
+    for name in names:
+        argument = rename[name] if name in rename else name
+        if argument.split('.')[0] in _catalogue_types:
+            columns[name] = argument
+    if not 'image_file' in columns.values() and not 'cutout_center.x' in columns.values():
+        raise ValueError('catalogue needs an image_file column, or cutout_center.x and cutout_center.y columns for a mosaic, found: %s' % str(list(names)))
+    logging.info('catalogue columns used: %s' % str(columns))
+    return columns
+
+def _Catalogue_Row(columns, values):
+    """
+    Internal, build the arguments for one catalogue row. None values are left out.
+    """
+    row = {}
+    for name in columns:
+        if values[name] is None:
+            continue
+        if '.' in columns[name]:
+            argument, key = columns[name].split('.', 1)
+            row.setdefault(argument, {})[key] = values[name]
+        else:
+            row[columns[name]] = values[name]
+    return row
+
+def Read_Catalogue(catalogue_file, **kwargs):
+    """
+    Read the rows of a catalogue one at a time, without loading the whole
+    table into memory. The catalogue may be a text file with a header row
+    (.csv, or any other extension, values separated by commas or by
+    "catalogue_delimiter"), a FITS table (.fits, in HDU "catalogue_hdu",
+    default 1), or a Parquet file (.parquet, requires pyarrow). Each row
+    should give an "image_file" and any other AutoProf arguments which
+    differ between galaxies, see _Catalogue_Columns.
+
+    catalogue_file: path to the catalogue
+
+    returns: generator of dictionaries with the arguments for each row
+    """
+    extension = os.path.splitext(catalogue_file)[1].lower()
+    if extension in ['.fits', '.fit']:
+        from astropy.io import fits
+        with fits.open(catalogue_file, memmap = True) as hdul:
+            table = hdul[kwargs['catalogue_hdu'] if 'catalogue_hdu' in kwargs else 1].data
+            columns = _Catalogue_Columns(table.columns.names, **kwargs)
+            nulls = dict((name, table.columns[name].null) for name in columns)
+            for i in range(len(table)):
+                yield _Catalogue_Row(columns, dict((name, _Convert_Table(table.field(name)[i], nulls[name])) for name in columns))
+    elif extension == '.parquet':
+        import pyarrow.parquet as pq
+        table = pq.ParquetFile(catalogue_file)
+        columns = _Catalogue_Columns(table.schema_arrow.names, **kwargs)
+        for batch in table.iter_batches(batch_size = 1024, columns = list(columns.keys())):
+            for values in batch.to_pylist():
+                yield _Catalogue_Row(columns, dict((name, _Convert_Table(values[name])) for name in columns))
+    else:
+        with open(catalogue_file, 'r', newline = '') as f:
+            reader = csv.reader(f, delimiter = kwargs['catalogue_delimiter'] if 'catalogue_delimiter' in kwargs else ',')
+            names = list(name.strip() for name in next(reader))
+            columns = _Catalogue_Columns(names, **kwargs)
+            use = list((names.index(name), name) for name in columns)
+            for line in reader:
+                if len(line) == 0:
+                    continue
+                yield _Catalogue_Row(columns, dict((name, _Convert_Text(columns[name], line[i])) for i, name in use))
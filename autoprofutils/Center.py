@@ -3,11 +3,8 @@ import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
 from autoprofutils.SharedFunctions import _iso_extract
-from photutils.centroids import centroid_2dg, centroid_com, centroid_1dg
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
 from scipy.fftpack import fft, ifft
-import matplotlib.pyplot as plt
 import logging
 from copy import copy
 
@@ -90,6 +87,7 @@ def Center_Centroid(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils.centroids import centroid_2dg
     
     current_center = {'x': IMG.shape[0]/2, 'y': IMG.shape[1]/2}
     if 'given_center' in kwargs:
@@ -108,15 +106,17 @@ def Center_Centroid(IMG, pixscale, name, results, **kwargs):
     x, y = centroid_2dg(IMG - results['background'])
 
     # Plot center value for diagnostic purposes
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(IMG - results['background'],a_min = 0, a_max = None),
-                   origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
-        plt.plot([y],[x], marker = 'x', markersize = 10, color = 'y')
-        plt.savefig('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        plot = Plot_Spec('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'],a_min = 0, a_max = None),
+                                 origin = 'lower', cmap = 'Greys_r', norm = 'log')
+        Plot_Add(plot, 'plot', [y],[x], marker = 'x', markersize = 10, color = 'y')
+        plots.append(plot)
     logging.info('%s Center found: x %.1f, y %.1f' % (name, x, y))    
     return {'center': {'x': x,
-                       'y': y}}
+                       'y': y},
+            'diagnostic plots': plots}
 
 def Center_1DGaussian(IMG, pixscale, name, results, **kwargs):
     """
@@ -131,6 +131,7 @@ def Center_1DGaussian(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils.centroids import centroid_1dg
     
     current_center = {'x': IMG.shape[0]/2, 'y': IMG.shape[1]/2}
     if 'given_center' in kwargs:
@@ -147,15 +148,17 @@ def Center_1DGaussian(IMG, pixscale, name, results, **kwargs):
                         mask = centralize_mask) # np.logical_or(mask['mask'], centralize_mask)
     
     # Plot center value for diagnostic purposes
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(IMG - results['background'],a_min = 0, a_max = None),
-                   origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
-        plt.plot([y],[x], marker = 'x', markersize = 10, color = 'y')
-        plt.savefig('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        plot = Plot_Spec('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'],a_min = 0, a_max = None),
+                                 origin = 'lower', cmap = 'Greys_r', norm = 'log')
+        Plot_Add(plot, 'plot', [y],[x], marker = 'x', markersize = 10, color = 'y')
+        plots.append(plot)
     logging.info('%s Center found: x %.1f, y %.1f' % (name, x, y))    
     return {'center': {'x': x,
-                       'y': y}}
+                       'y': y},
+            'diagnostic plots': plots}
 
 def Center_OfMass(IMG, pixscale, name, results, **kwargs):
     """
@@ -170,6 +173,7 @@ def Center_OfMass(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils.centroids import centroid_com
     
     current_center = {'x': IMG.shape[0]/2, 'y': IMG.shape[1]/2}
     if 'given_center' in kwargs:
@@ -186,15 +190,17 @@ def Center_OfMass(IMG, pixscale, name, results, **kwargs):
                         mask = centralize_mask) # np.logical_or(mask['mask'], centralize_mask)
     
     # Plot center value for diagnostic purposes
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(IMG - results['background'],a_min = 0, a_max = None),
-                   origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
-        plt.plot([y],[x], marker = 'x', markersize = 10, color = 'y')
-        plt.savefig('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        plot = Plot_Spec('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'],a_min = 0, a_max = None),
+                                 origin = 'lower', cmap = 'Greys_r', norm = 'log')
+        Plot_Add(plot, 'plot', [y],[x], marker = 'x', markersize = 10, color = 'y')
+        plots.append(plot)
     logging.info('%s Center found: x %.1f, y %.1f' % (name, x, y))    
     return {'center': {'x': x,
-                       'y': y}}
+                       'y': y},
+            'diagnostic plots': plots}
 
 def Center_Bright(IMG, pixscale, name, results, **kwargs):
     """
@@ -285,9 +291,11 @@ def Center_HillClimb(IMG, pixscale, name, results, **kwargs):
             small_update_count = 0
         track_centers.append([current_center['x'], current_center['y']])
 
-    # refine center
+    # refine center, capped in case the random updates keep finding small improvements
     nochange_count = 0
-    while nochange_count < 5:
+    refine_count = 0
+    while nochange_count < 5 and refine_count < 100:
+        refine_count += 1
         center_update = []
         center_loss = []
         for i in range(10):
@@ -309,6 +317,8 @@ def Center_HillClimb(IMG, pixscale, name, results, **kwargs):
             nochange_count = 0
             current_center = copy(center_update[ci])
             track_centers.append([current_center['x'], current_center['y']])
+    if nochange_count < 5:
+        logging.warning('%s: center refinement did not settle after %i iterations' % (name, refine_count))
     track_centers = np.array(track_centers)
 
     # paper plot
@@ -366,15 +376,16 @@ def Center_Multi_Method(IMG, pixscale, name, results, **kwargs):
         # Check how the algorithm center brightness compares to the image center brightness
         if np.sqrt((cent['x'] - IMG.shape[0]/2)**2 + (cent['y'] - IMG.shape[1]/2)**2) < 50*results['psf fwhm']:
             # Plot center for diagnostic purposes
+            plots = []
             if 'doplot' in kwargs and kwargs['doplot']:    
-                plt.imshow(np.clip(IMG,a_min = 0, a_max = None), origin = 'lower',
-                           cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+                plot = Plot_Spec('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+                Plot_Add(plot, 'imshow', np.clip(IMG,a_min = 0, a_max = None), origin = 'lower',
+                                         cmap = 'Greys_r', norm = 'log')
                 for vi,v in enumerate(cent_vals):
-                    plt.plot([v['x']],[v['y']], marker = 'x', markersize = 10, color = x_colours[vi], label = cents[vi])
-                plt.legend()
-                plt.savefig('%scenter_vis_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-                plt.close()
-            return {'center': cent}
+                    Plot_Add(plot, 'plot', [v['x']],[v['y']], marker = 'x', markersize = 10, color = x_colours[vi], label = cents[vi])
+                Plot_Add(plot, 'legend')
+                plots.append(plot)
+            return {'center': cent, 'diagnostic plots': plots}
     
     logging.warning('%s Centering failed, using center of image' % name)
     return {'center': {'x':int(IMG.shape[0]/2.),
@@ -1,11 +1,10 @@
 import numpy as np
-from scipy.stats import iqr
-from scipy.fftpack import fft, ifft
+from scipy.fftpack import fft
 import logging
 import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
-from autoprofutils.SharedFunctions import _iso_extract, _x_to_pa, _x_to_eps, _inv_x_to_eps, _inv_x_to_pa
+from autoprofutils.SharedFunctions import _iso_extract_multi
 
 
 def Check_Fit_Simple(IMG, pixscale, name, results, **kwargs):
@@ -39,6 +38,48 @@ def Check_Fit_Simple(IMG, pixscale, name, results, **kwargs):
         logging.info('%s: Check fit could not check SB profile consistency')
     return {'checkfit': tests}
 
+def _Check_Fit_Stats(dat, R, E, PA, C, polar = None, isovals = None, coefs = None):
+    """
+    Internal, median, interquartile range and first, second and fourth FFT coefficient
+    amplitudes of the flux along each isophote. Flux samples (and coefficients) which
+    are already available, for example from the isophote fit, are used directly. All
+    other isophotes are sampled in one batch (one for the spline interpolated isophotes
+    below 30 pixels and one for the larger ones) with the statistics computed along
+    the sample axis.
+
+    returns: median, iqr, |c1|/|c0|, (|c2|+|c4|)/|c0| arrays for each radius
+    """
+    R = np.array(R)
+    E, PA = np.broadcast_to(E, R.shape), np.broadcast_to(PA, R.shape)
+    if isovals is None:
+        isovals = [None]*len(R)
+    if coefs is None:
+        coefs = [None]*len(R)
+    median, IQR, f1, f2 = np.zeros(len(R)), np.zeros(len(R)), np.zeros(len(R)), np.zeros(len(R))
+
+    # Isophotes with existing flux samples
+    for i in range(len(R)):
+        if isovals[i] is None:
+            continue
+        q = np.quantile(isovals[i], [0.25, 0.5, 0.75, 0.85])
+        c = fft(np.clip(isovals[i], a_max = q[3], a_min = None)) if coefs[i] is None else coefs[i]
+        median[i], IQR[i] = q[1], q[2] - q[0]
+        f1[i] = np.abs(c[1])/np.abs(c[0])
+        f2[i] = np.sum(np.abs(c[[2,4]]))/np.abs(c[0])
+
+    # Batched sampling for the rest
+    missing = np.array(list(v is None for v in isovals))
+    for batch in [np.logical_and(missing, R < 30), np.logical_and(missing, R >= 30)]:
+        if not np.any(batch):
+            continue
+        flux, _ = _iso_extract_multi(dat, R[batch], E[batch], PA[batch], C, polar = polar)
+        q = np.quantile(flux, [0.25, 0.5, 0.75, 0.85], axis = 1)
+        c = fft(np.clip(flux, a_max = q[3][:,None], a_min = None), axis = 1)
+        median[batch], IQR[batch] = q[1], q[2] - q[0]
+        f1[batch] = np.abs(c[:,1])/np.abs(c[:,0])
+        f2[batch] = np.sum(np.abs(c[:,[2,4]]), axis = 1)/np.abs(c[:,0])
+    return median, IQR, f1, f2
+
 def Check_Fit_IQR(IMG, pixscale, name, results, **kwargs):
     """
     Check for failed fit with various measures.
@@ -47,6 +88,7 @@ def Check_Fit_IQR(IMG, pixscale, name, results, **kwargs):
     3) measure signal in 2nd and 4th FFT coefficient which should be minimal
     4) measure signal in 1st FFT coefficient which should be minimal
     5) Compare integrated SB profile with simple flux summing for total magnitude
+    The isophote flux samples from the fit ("fit samples") are reused where available.
     
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -57,30 +99,24 @@ def Check_Fit_IQR(IMG, pixscale, name, results, **kwargs):
     tests = {}
     # subtract background from image during processing
     dat = IMG - results['background']
+    polar = results['polar image'] if 'polar image' in results else None
 
     # Compare variability of flux values along isophotes
     ######################################################################
     use_center = results['center']
-    count_variable = 0
-    count_initrelative = 0
-    f2_compare = []
-    f1_compare = []
-    for i in range(len(results['fit R'])):
-        init_isovals = _iso_extract(dat,results['fit R'][i],results['init ellip'],
-                                    results['init pa'],use_center)
-        isovals = _iso_extract(dat,results['fit R'][i],results['fit ellip'][i],
-                               results['fit pa'][i],use_center)
-        coefs = fft(np.clip(isovals, a_max = np.quantile(isovals,0.85), a_min = None))
-
-        if np.median(isovals) < (iqr(isovals)-results['background noise']):
-            count_variable += 1
-        if ((iqr(isovals) - results['background noise'])/(np.median(isovals)+results['background noise'])) > (iqr(init_isovals)/(np.median(init_isovals)+results['background noise'])):
-            count_initrelative += 1
-        f2_compare.append(np.sum(np.abs(coefs[[2,4]]))/np.abs(coefs[0]))
-        f1_compare.append(np.abs(coefs[1])/np.abs(coefs[0]))
-        
-    f1_compare = np.array(f1_compare)
-    f2_compare = np.array(f2_compare)
+    samples = results['fit samples'] if 'fit samples' in results else None
+    # samples are only valid for the same isophotes at the same center
+    if samples is not None and (len(samples['isovals']) != len(results['fit R']) or \
+                                samples['center']['x'] != use_center['x'] or samples['center']['y'] != use_center['y']):
+        samples = None
+    median, IQR, f1_compare, f2_compare = _Check_Fit_Stats(dat, results['fit R'], results['fit ellip'], results['fit pa'], use_center, polar = polar,
+                                                           isovals = None if samples is None else samples['isovals'],
+                                                           coefs = None if samples is None else samples['coefs'])
+    init_median, init_IQR, _, _ = _Check_Fit_Stats(dat, results['fit R'], results['init ellip'], results['init pa'], use_center, polar = polar,
+                                                   isovals = None if samples is None else samples['init isovals'])
+    noise = results['background noise']
+    count_variable = np.sum(median < (IQR - noise))
+    count_initrelative = np.sum(((IQR - noise)/(median + noise)) > (init_IQR/(init_median + noise)))
     if count_variable > (0.2*len(results['fit R'])):
         logging.warning('%s: Possible failed fit! flux values highly variable along isophotes' % name)
         tests['isophote variability'] = False
@@ -0,0 +1,124 @@
+import numpy as np
+import logging
+import os
+import threading
+import queue
+from multiprocessing.util import Finalize
+
+def Plot_Spec(filename, dpi = None):
+    """
+    Create a lightweight description of a diagnostic plot. Pipeline steps build
+    these instead of drawing with matplotlib, the plots are then rendered by
+    Render_Plot, usually on a background thread (see Submit_Plots) so that
+    plotting stays off the critical path of the fit.
+
+    filename: full path where the plot will be saved
+    dpi: resolution of the saved plot, None uses the matplotlib default
+
+    returns: plot specification dictionary
+    """
+    return {'file': filename, 'dpi': dpi, 'calls': []}
+
+def Plot_Add(spec, method, *args, **kwargs):
+    """
+    Record a drawing call on a plot specification. The method is the name of a
+    matplotlib Axes method (ie: 'imshow', 'plot', 'scatter', 'errorbar',
+    'axvline', 'legend', 'invert_yaxis'), the arguments are passed on unchanged
+    with these additions:
+
+    'xlabel', 'ylabel': set the axis labels
+    'ellipse': add a matplotlib Ellipse patch with the given arguments
+    norm = 'log': show an image with a log stretch
+
+    Lists are copied so later changes by the pipeline do not alter the plot.
+    """
+    spec['calls'].append((method, tuple(np.array(a) if type(a) == list else a for a in args), kwargs))
+
+def Render_Plot(spec):
+    """
+    Draw and save a plot specification. This uses the matplotlib object
+    interface with its own figure and canvas, so it is safe to call from
+    a thread other than the one running the pipeline.
+
+    spec: plot specification from Plot_Spec
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.patches import Ellipse
+    from astropy.visualization import LogStretch, ImageNormalize
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1,1,1)
+    for method, args, kwargs in spec['calls']:
+        if 'norm' in kwargs and kwargs['norm'] == 'log':
+            kwargs = dict(kwargs, norm = ImageNormalize(stretch=LogStretch()))
+        if method == 'ellipse':
+            ax.add_patch(Ellipse(*args, **kwargs))
+        elif method in ['xlabel', 'ylabel', 'xscale', 'yscale']:
+            getattr(ax, 'set_' + method)(*args, **kwargs)
+        else:
+            getattr(ax, method)(*args, **kwargs)
+    if spec['dpi'] is None:
+        fig.savefig(spec['file'])
+    else:
+        fig.savefig(spec['file'], dpi = spec['dpi'])
+
+class _Plot_Renderer(object):
+    """
+    Internal, background thread which renders plot specifications in the order they are submitted.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            spec = self.queue.get()
+            if spec is None:
+                break
+            try:
+                Render_Plot(spec)
+            except Exception as e:
+                logging.warning('could not render diagnostic plot %s: %s' % (spec['file'], str(e)))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+_renderer = None
+
+def Submit_Plots(specs, asynchronous = True):
+    """
+    Render a list of plot specifications. By default they are passed to a
+    background thread (one per process) and this returns immediately. All
+    submitted plots are finished before the process exits, or when
+    Flush_Plots is called.
+
+    specs: list of plot specifications
+    asynchronous: if False, render the plots before returning
+    """
+    global _renderer
+    if not asynchronous:
+        for spec in specs:
+            Render_Plot(spec)
+        return
+    # A renderer inherited from a parent process has no running thread, a new one is needed
+    if _renderer is None or _renderer.pid != os.getpid():
+        _renderer = _Plot_Renderer()
+        # Runs at exit of the main process and of multiprocessing workers
+        Finalize(None, Flush_Plots, exitpriority = 10)
+    for spec in specs:
+        _renderer.queue.put(spec)
+
+def Flush_Plots():
+    """
+    Wait for all submitted plots to be rendered.
+    """
+    global _renderer
+    if _renderer is None or _renderer.pid != os.getpid():
+        return
+    _renderer.close()
+    _renderer = None
@@ -1,25 +1,18 @@
 import numpy as np
-from photutils.isophote import EllipseSample, Ellipse, EllipseGeometry, Isophote, IsophoteList
-from scipy.optimize import minimize
 from scipy.stats import iqr
-from scipy.fftpack import fft, ifft
-from time import time
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
-from copy import copy
 import logging
 import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
-from autoprofutils.SharedFunctions import _x_to_pa, _x_to_eps, _inv_x_to_eps, _inv_x_to_pa, SBprof_to_COG_errorprop, _iso_extract, _iso_within, _iso_between
+from autoprofutils.SharedFunctions import _x_to_pa, _x_to_eps, _inv_x_to_eps, SBprof_to_COG_errorprop, _iso_extract, _iso_within, _iso_between
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
 
 def Simple_Isophote_Extract(IMG, mask, background_level, center, R, E, PA, name = ''):
     """
     Extracts the specified isophotes using photutils ellipsesample function.
     Applies mask and backgorund level to image.    
     """
+    from photutils.isophote import EllipseSample, EllipseGeometry, Isophote, IsophoteList
 
     # Create image array with background and mask applied
     if np.any(mask):
@@ -124,21 +117,23 @@ def Generate_Profile(IMG, pixscale, mask, background, background_noise, center,
         SBprof_data['totmag_fix'].append(cogglob[i])
         SBprof_data['totmag_fix_e'].append(cogglobE[i])
 
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
         CHOOSE = np.logical_and(np.array(SBprof_data['SB']) < 99, np.array(SBprof_data['SB_e']) < 1)
-        plt.errorbar(np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['SB'])[CHOOSE], yerr = np.array(SBprof_data['SB_e'])[CHOOSE],
-                     elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'purple', label = 'SB')
-        plt.errorbar(np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['totmag'])[CHOOSE], yerr = np.array(SBprof_data['totmag_e'])[CHOOSE],
-                     elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'orange', label = 'COG')
-        plt.xlabel('Radius [arcsec]')
-        plt.ylabel('Brightness [mag, mag/arcsec^2]')
-        plt.axhline(-2.5*np.log10(background_noise) + zeropoint + 2.5*np.log10(pixscale**2), color = 'purple', linewidth = 0.5, linestyle = '--', label = 'Sky noise')
-        plt.gca().invert_yaxis()
-        plt.legend()
-        plt.savefig('%sphotometry_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()                
+        plot = Plot_Spec('%sphotometry_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'errorbar', np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['SB'])[CHOOSE], yerr = np.array(SBprof_data['SB_e'])[CHOOSE],
+                                   elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'purple', label = 'SB')
+        Plot_Add(plot, 'errorbar', np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['totmag'])[CHOOSE], yerr = np.array(SBprof_data['totmag_e'])[CHOOSE],
+                                   elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'orange', label = 'COG')
+        Plot_Add(plot, 'xlabel', 'Radius [arcsec]')
+        Plot_Add(plot, 'ylabel', 'Brightness [mag, mag/arcsec^2]')
+        Plot_Add(plot, 'axhline', -2.5*np.log10(background_noise) + zeropoint + 2.5*np.log10(pixscale**2), color = 'purple', linewidth = 0.5, linestyle = '--', label = 'Sky noise')
+        Plot_Add(plot, 'invert_yaxis')
+        Plot_Add(plot, 'legend')
+        plots.append(plot)
         
-    return {'prof header': params, 'prof units': SBprof_units, 'prof data': SBprof_data, 'prof format': SBprof_format}
+    return {'prof header': params, 'prof units': SBprof_units, 'prof data': SBprof_data, 'prof format': SBprof_format,
+            'diagnostic plots': plots}
 
 def _Generate_Profile(IMG, pixscale, name, results, R, E, Ee, PA, PAe, **kwargs):
     
@@ -153,6 +148,8 @@ def _Generate_Profile(IMG, pixscale, name, results, R, E, Ee, PA, PAe, **kwargs)
     else:
         logging.info('%s: is not masked' % (name))
         dat = IMG - results['background']
+    # The polar resampling does not know about the mask
+    polar = results['polar image'] if ('polar image' in results and not np.any(mask)) else None
     zeropoint = kwargs['zeropoint'] if 'zeropoint' in kwargs else 22.5
 
     sb = []
@@ -163,11 +160,11 @@ def _Generate_Profile(IMG, pixscale, name, results, R, E, Ee, PA, PAe, **kwargs)
 
     for i in range(len(R)):
         if R[i] < (kwargs['isoband_start'] if 'isoband_start' in kwargs else 150):
-            isovals = _iso_extract(dat, R[i], E[i], PA[i], results['center'])
+            isovals = _iso_extract(dat, R[i], E[i], PA[i], results['center'], polar = polar)
         else:
             isobandwidth = R[i]*(kwargs['isoband_width'] if 'isoband_width' in kwargs else 0.025)
             isovals = _iso_between(dat, R[i] - isobandwidth, R[i] + isobandwidth, E[i], PA[i], results['center'])
-        isovalsfix = _iso_extract(dat, R[i], results['init ellip'], results['init pa'], results['center'])
+        isovalsfix = _iso_extract(dat, R[i], results['init ellip'], results['init pa'], results['center'], polar = polar)
         isotot = _iso_within(dat, R[i], E[i], PA[i], results['center'])
         medflux = np.median(isovals)
         medfluxfix = np.median(isovalsfix)
@@ -211,21 +208,23 @@ def _Generate_Profile(IMG, pixscale, name, results, R, E, Ee, PA, PAe, **kwargs)
     SBprof_data['totmag_fix'] = list(cogfix)
     SBprof_data['totmag_fix_e'] = list(cogfixE)
 
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
         CHOOSE = np.logical_and(np.array(SBprof_data['SB']) < 99, np.array(SBprof_data['SB_e']) < 1)
-        plt.errorbar(np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['SB'])[CHOOSE], yerr = np.array(SBprof_data['SB_e'])[CHOOSE],
-                     elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'purple', label = 'SB')
-        plt.errorbar(np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['totmag'])[CHOOSE], yerr = np.array(SBprof_data['totmag_e'])[CHOOSE],
-                     elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'orange', label = 'COG')
-        plt.xlabel('Radius [arcsec]')
-        plt.ylabel('Brightness [mag, mag/arcsec^2]')
-        plt.axhline(-2.5*np.log10(results['background noise']) + zeropoint + 2.5*np.log10(pixscale**2), color = 'purple', linewidth = 0.5, linestyle = '--', label = '1$\\sigma$ noise / pixel')
-        plt.gca().invert_yaxis()
-        plt.legend()
-        plt.savefig('%sphotometry_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()                
+        plot = Plot_Spec('%sphotometry_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'errorbar', np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['SB'])[CHOOSE], yerr = np.array(SBprof_data['SB_e'])[CHOOSE],
+                                   elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'purple', label = 'SB')
+        Plot_Add(plot, 'errorbar', np.array(SBprof_data['R'])[CHOOSE], np.array(SBprof_data['totmag'])[CHOOSE], yerr = np.array(SBprof_data['totmag_e'])[CHOOSE],
+                                   elinewidth = 1, linewidth = 0, marker = '.', markersize = 5, color = 'orange', label = 'COG')
+        Plot_Add(plot, 'xlabel', 'Radius [arcsec]')
+        Plot_Add(plot, 'ylabel', 'Brightness [mag, mag/arcsec^2]')
+        Plot_Add(plot, 'axhline', -2.5*np.log10(results['background noise']) + zeropoint + 2.5*np.log10(pixscale**2), color = 'purple', linewidth = 0.5, linestyle = '--', label = '1$\\sigma$ noise / pixel')
+        Plot_Add(plot, 'invert_yaxis')
+        Plot_Add(plot, 'legend')
+        plots.append(plot)
     
-    return {'prof header': params, 'prof units': SBprof_units, 'prof data': SBprof_data, 'prof format': SBprof_format}
+    return {'prof header': params, 'prof units': SBprof_units, 'prof data': SBprof_data, 'prof format': SBprof_format,
+            'diagnostic plots': plots}
     
 
 def Isophote_Extract_Forced(IMG, pixscale, name, results, **kwargs):
@@ -1,25 +1,15 @@
 import numpy as np
-from scipy.stats import iqr
-from scipy.fftpack import fft, ifft
+from scipy.fftpack import fft
 from scipy.optimize import minimize
-from sklearn.preprocessing import PolynomialFeatures
-from sklearn.pipeline import make_pipeline
-from sklearn.linear_model import RANSACRegressor, HuberRegressor
 from time import time
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-from photutils.isophote import EllipseSample, EllipseGeometry, Isophote, IsophoteList
-from photutils.isophote import Ellipse as Photutils_Ellipse
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
+from multiprocessing import Pool, current_process
 from copy import copy
 import logging
 import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
-from autoprofutils.SharedFunctions import _iso_extract, _x_to_pa, _x_to_eps, _inv_x_to_eps, _inv_x_to_pa, Angle_TwoAngles
-from autoprofutils.Isophote_Initialize import Isophote_Initialize_CircFit
-from autoprofutils.Check_Fit import Check_Fit_IQR
+from autoprofutils.SharedFunctions import _iso_extract, _x_to_eps, _inv_x_to_eps, Angle_TwoAngles, _huber_polyfit
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
 
 def Photutils_Fit(IMG, pixscale, name, results, **kwargs):
     """
@@ -31,6 +21,7 @@ def Photutils_Fit(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """    
+    from photutils.isophote import EllipseGeometry, Ellipse as Photutils_Ellipse
 
     dat = IMG - results['background']
     geo = EllipseGeometry(x0 = results['center']['x'],
@@ -43,63 +34,466 @@ def Photutils_Fit(IMG, pixscale, name, results, **kwargs):
     isolist = ellipse.fit_image(fix_center = True, linear = False)
     res = {'fit R': isolist.sma[1:], 'fit ellip': isolist.eps[1:], 'fit ellip_err': isolist.ellip_err[1:], 'fit pa': isolist.pa[1:], 'fit pa_err': isolist.pa_err[1:]}
     
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(dat[max(0,int(results['center']['y']-res['fit R'][-1]*1.2)): min(dat.shape[0],int(results['center']['y']+res['fit R'][-1]*1.2)),
-                               max(0,int(results['center']['x']-res['fit R'][-1]*1.2)): min(dat.shape[1],int(results['center']['x']+res['fit R'][-1]*1.2))],
-                           a_min = 0,a_max = None), origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch())) 
+        plot = Plot_Spec('%sloss_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 300)
+        Plot_Add(plot, 'imshow', np.clip(dat[max(0,int(results['center']['y']-res['fit R'][-1]*1.2)): min(dat.shape[0],int(results['center']['y']+res['fit R'][-1]*1.2)),
+                                             max(0,int(results['center']['x']-res['fit R'][-1]*1.2)): min(dat.shape[1],int(results['center']['x']+res['fit R'][-1]*1.2))],
+                                         a_min = 0,a_max = None), origin = 'lower', cmap = 'Greys_r', norm = 'log') 
         for i in range(len(res['fit R'])):
-            plt.gca().add_patch(Ellipse((int(res['fit R'][-1]*1.2),int(res['fit R'][-1]*1.2)), 2*res['fit R'][i], 2*res['fit R'][i]*(1. - res['fit ellip'][i]),
-                                        res['fit pa'][i]*180/np.pi, fill = False, linewidth = 0.5, color = 'r'))
-        plt.savefig('%sloss_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 300)
-        plt.close()                
+            Plot_Add(plot, 'ellipse', (int(res['fit R'][-1]*1.2),int(res['fit R'][-1]*1.2)), 2*res['fit R'][i], 2*res['fit R'][i]*(1. - res['fit ellip'][i]),
+                                      res['fit pa'][i]*180/np.pi, fill = False, linewidth = 0.5, color = 'r')
+        plots.append(plot)
+    res['diagnostic plots'] = plots
     
     return res
 
 
 def _ellip_smooth(R, E, deg):
-    model = make_pipeline(PolynomialFeatures(deg), HuberRegressor(epsilon=2.))
-    model.fit(np.log10(R).reshape(-1,1), _inv_x_to_eps(E))
-    return _x_to_eps(model.predict(np.log10(R).reshape(-1,1)))
+    x = np.log10(R)
+    return _x_to_eps(np.polyval(_huber_polyfit(x, _inv_x_to_eps(E), deg, epsilon = 2.), x))
     
 def _pa_smooth(R, PA, deg):
 
-    model_s = make_pipeline(PolynomialFeatures(deg), HuberRegressor())
-    model_c = make_pipeline(PolynomialFeatures(deg), HuberRegressor())
-    model_c.fit(np.log10(R).reshape(-1,1), np.cos(2*PA))
-    model_s.fit(np.log10(R).reshape(-1,1), np.sin(2*PA))
-    pred_pa_s = np.clip(model_s.predict(np.log10(R).reshape(-1,1)), a_min = -1, a_max = 1)
-    pred_pa_c = np.clip(model_c.predict(np.log10(R).reshape(-1,1)), a_min = -1, a_max = 1)
+    x = np.log10(R)
+    pred_pa_s = np.clip(np.polyval(_huber_polyfit(x, np.sin(2*PA), deg), x), a_min = -1, a_max = 1)
+    pred_pa_c = np.clip(np.polyval(_huber_polyfit(x, np.cos(2*PA), deg), x), a_min = -1, a_max = 1)
 
     return ((np.arctan(pred_pa_s/pred_pa_c) + (np.pi*(pred_pa_c < 0))) % (2*np.pi))/2
     
 
-def _FFT_Robust_loss(dat, R, E, PA, i, C, noise, reg_scale = 1., name = ''):
-
-    isovals = _iso_extract(dat,R[i],E[i],PA[i],C)
+def _FFT_Robust_f2(dat, R, E, PA, i, C, noise, polar = None, more = False):
+    """
+    Internal, amplitude of the second FFT coefficient for isophote i relative to its median flux.
+    If more is True, the flux samples and FFT coefficients are also returned.
+    """
+    isovals = _iso_extract(dat,R[i],E[i],PA[i],C, polar = polar)
     
     if not np.all(np.isfinite(isovals)):
         logging.warning('Failed to evaluate isophotal flux values, skipping this ellip/pa combination')
-        return np.inf
+        return (np.inf, isovals, None) if more else np.inf
     
     coefs = fft(np.clip(isovals, a_max = np.quantile(isovals,0.85), a_min = None))
-    
-    f2_loss = np.abs(coefs[2]) / (len(isovals)*(abs(np.median(isovals)) + noise))
+    f2 = np.abs(coefs[2]) / (len(isovals)*(abs(np.median(isovals)) + noise))
+    return (f2, isovals, coefs) if more else f2
 
+def _FFT_Robust_reg(E, PA, i):
+    """
+    Internal, regularization term for isophote i, penalizes differences with the neighbouring isophotes.
+    """
     reg_loss = 0
-    if i < (len(R)-1):
+    if i < (len(E)-1):
         reg_loss += abs((E[i] - E[i+1])/E[i+1]) #abs((_inv_x_to_eps(E[i]) - _inv_x_to_eps(E[i+1]))/0.1)
         reg_loss += abs(Angle_TwoAngles(2*PA[i], 2*PA[i+1])/(2*0.3))
     if i > 0:
         reg_loss += abs((E[i] - E[i-1])/E[i-1]) #abs((_inv_x_to_eps(E[i]) - _inv_x_to_eps(E[i-1]))/0.1)
         reg_loss += abs(Angle_TwoAngles(2*PA[i], 2*PA[i-1])/(2*0.3))
+    return reg_loss
+    
+def _FFT_Robust_loss(dat, R, E, PA, i, C, noise, reg_scale = 1., name = '', polar = None):
+
+    return _FFT_Robust_f2(dat, R, E, PA, i, C, noise, polar = polar)*(1 + _FFT_Robust_reg(E, PA, i)*reg_scale)
+
+def _FFT_Robust_Cache(N):
+    """
+    Internal, per-radius cache for the FFT_Robust optimizers. The second FFT coefficient
+    (f2) at radius i only depends on the ellipse at i, while the loss also depends on
+    the neighbouring radii through the regularization term. So an accepted move at i
+    replaces the cached f2, flux samples and coefficients at i, and only invalidates
+    the losses at i-1, i and i+1. The cache also counts the number of isophotes sampled.
+    """
+    return {'f2': np.full(N, np.nan), 'isovals': [None]*N, 'coefs': [None]*N, 'loss': np.full(N, np.nan), 'evaluations': 0}
+
+def _FFT_Robust_Cache_f2(cache, dat, R, E, PA, i, C, noise, polar = None):
+    """
+    Internal, sample isophote i for a trial ellipse and count the evaluation.
+
+    returns: f2, flux samples, FFT coefficients
+    """
+    cache['evaluations'] += 1
+    return _FFT_Robust_f2(dat, R, E, PA, i, C, noise, polar = polar, more = True)
+
+def _FFT_Robust_Cache_Loss(cache, dat, R, E, PA, i, C, noise, polar = None):
+    """
+    Internal, loss at radius i for the current ellip/pa, only recomputed if it was invalidated.
+    """
+    if np.isnan(cache['loss'][i]):
+        if np.isnan(cache['f2'][i]):
+            cache['f2'][i], cache['isovals'][i], cache['coefs'][i] = _FFT_Robust_Cache_f2(cache, dat, R, E, PA, i, C, noise, polar = polar)
+        cache['loss'][i] = cache['f2'][i]*(1 + _FFT_Robust_reg(E, PA, i))
+    return cache['loss'][i]
+
+def _FFT_Robust_Cache_Accept(cache, i, f2, isovals, coefs):
+    """
+    Internal, store the values for an accepted move at radius i and invalidate the affected losses.
+    """
+    cache['f2'][i] = f2
+    cache['isovals'][i] = isovals
+    cache['coefs'][i] = coefs
+    cache['loss'][max(0, i-1):i+2] = np.nan
+
+def _FFT_Robust_Cache_Total(cache, dat, R, E, PA, C, noise, polar = None):
+    """
+    Internal, sum of the FFT_Robust loss over all radii using the cached values.
+    """
+    return sum(_FFT_Robust_Cache_Loss(cache, dat, R, E, PA, i, C, noise, polar = polar) for i in range(len(R)))
+
+def _FFT_Robust_Cache_Samples(cache):
+    """
+    Internal, the flux samples and FFT coefficients at the current ellip/pa of each radius.
+    """
+    return {'isovals': cache['isovals'], 'coefs': cache['coefs']}
+
+def _Fit_Trace_Update(trace, loss, accepted, ellip, pa, prev_ellip, prev_pa, start):
+    """
+    Internal, record the state of the fit after a sweep. The trace holds one entry per
+    sweep for: total loss, number of accepted moves, largest change in ellipticity and
+    position angle, and the time since the fit started.
+    """
+    trace['sweep'].append(len(trace['sweep']) + 1)
+    trace['loss'].append(loss)
+    trace['accepted'].append(accepted)
+    trace['max ellip change'].append(np.max(np.abs(np.array(ellip) - np.array(prev_ellip))))
+    trace['max pa change'].append(np.max(Angle_TwoAngles(2*np.array(pa), 2*np.array(prev_pa))/2))
+    trace['time'].append(time() - start)
+
+def _Fit_Converged(trace, rtol = None, timelimit = None, window = 1):
+    """
+    Internal, check the user convergence criteria against the fit trace. The fit has
+    converged if the total loss improved by less than rtol (relative) over the last
+    window sweeps, or if the time limit (seconds) has been used up.
+
+    returns: reason for stopping the fit, or None to continue
+    """
+    if not timelimit is None and trace['time'][-1] > timelimit:
+        return 'time limit'
+    if not rtol is None and len(trace['loss']) > window and \
+       (trace['loss'][-1-window] - trace['loss'][-1]) <= rtol*abs(trace['loss'][-1-window]):
+        return 'relative tolerance'
+    return None
+
+def _FFT_Robust_Random(dat, R, ellip, pa, C, noise, name = '', polar = None, rtol = None, timelimit = None):
+    """
+    Internal, random perturbation hill climb for the FFT_Robust loss. Each sweep visits
+    the radii in random order and tries 5 gaussian perturbations of the ellipticity
+    and/or position angle, keeping the best. Stops after 300 sweeps or when 3 times the
+    number of radii have been visited without a change. Since the sweeps cycle between
+    ellipticity, both, and position angle, rtol is checked over 3 sweeps.
 
-    return f2_loss*(1 + reg_loss*reg_scale) #(np.abs(coefs[2])/(len(isovals)*(abs(np.median(isovals)))))*reg_loss*reg_scale
+    returns: ellip, pa, number of sweeps, number of loss evaluations, fit trace, samples at each radius
+    """
+    start = time()
+    trace = {'sweep': [], 'loss': [], 'accepted': [], 'max ellip change': [], 'max pa change': [], 'time': [], 'stop': 'converged'}
+    perturb_scale = np.array([0.03, 0.06])
+
+    N_perturb = 5
+
+    count = 0
+    cache = _FFT_Robust_Cache(len(R))
+
+    count_nochange = 0
+    I = np.array(range(len(R)))
+    while count < 300 and count_nochange < (3*len(R)):
+        # Periodically include logging message
+        if count % 10 == 0:
+            logging.debug('%s: count: %i' % (name,count))
+        count += 1
+        
+        prev_ellip, prev_pa = copy(ellip), copy(pa)
+        accepted = 0
+        np.random.shuffle(I)
+        for i in I:
+            # The unperturbed loss comes from the cache, only the perturbations sample the image
+            perturbations = []
+            perturbations.append({'ellip': ellip, 'pa': pa, 'loss': _FFT_Robust_Cache_Loss(cache, dat, R, ellip, pa, i, C, noise, polar = polar)})
+            for n in range(N_perturb):
+                perturbations.append({'ellip': copy(ellip), 'pa': copy(pa)})
+                if count % 3 in [0,1]:
+                    perturbations[-1]['ellip'][i] = _x_to_eps(_inv_x_to_eps(perturbations[-1]['ellip'][i]) + np.random.normal(loc = 0, scale = perturb_scale[0]))
+                if count % 3 in [1,2]:
+                    perturbations[-1]['pa'][i] = (perturbations[-1]['pa'][i] + np.random.normal(loc = 0, scale = perturb_scale[1])) % np.pi
+                perturbations[-1]['f2'], perturbations[-1]['isovals'], perturbations[-1]['coefs'] = _FFT_Robust_Cache_f2(cache, dat, R, perturbations[-1]['ellip'],
+                                                                                                                         perturbations[-1]['pa'], i, C, noise, polar = polar)
+                perturbations[-1]['loss'] = perturbations[-1]['f2']*(1 + _FFT_Robust_reg(perturbations[-1]['ellip'], perturbations[-1]['pa'], i))
+            
+            best = np.argmin(list(p['loss'] for p in perturbations))
+            if best > 0:
+                ellip = copy(perturbations[best]['ellip'])
+                pa = copy(perturbations[best]['pa'])
+                _FFT_Robust_Cache_Accept(cache, i, perturbations[best]['f2'], perturbations[best]['isovals'], perturbations[best]['coefs'])
+                count_nochange = 0
+                accepted += 1
+            else:
+                count_nochange += 1
+                
+        _Fit_Trace_Update(trace, _FFT_Robust_Cache_Total(cache, dat, R, ellip, pa, C, noise, polar = polar), accepted, ellip, pa, prev_ellip, prev_pa, start)
+        stop = _Fit_Converged(trace, rtol, timelimit, window = 3)
+        if not stop is None:
+            trace['stop'] = stop
+            break
+    if count >= 300 and trace['stop'] == 'converged':
+        trace['stop'] = 'iteration limit'
+    return ellip, pa, count, cache['evaluations'], trace, _FFT_Robust_Cache_Samples(cache)
+
+def _Golden_Section(f, a, b, tol):
+    """
+    Internal, golden-section search for the minimum of f on the interval [a, b].
+
+    returns: location of the minimum, value of f there, number of evaluations of f
+    """
+    gr = (np.sqrt(5) - 1)/2
+    c = b - gr*(b - a)
+    d = a + gr*(b - a)
+    fc, fd = f(c), f(d)
+    evaluations = 2
+    while abs(b - a) > tol:
+        if fc < fd:
+            b, d, fd = d, c, fc
+            c = b - gr*(b - a)
+            fc = f(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + gr*(b - a)
+            fd = f(d)
+        evaluations += 1
+    return (c, fc, evaluations) if fc < fd else (d, fd, evaluations)
+
+def _FFT_Robust_Coordinate_Radius(cache, dat, R, ellip, pa, i, C, noise, polar, width):
+    """
+    Internal, one coordinate descent step at radius i: a golden-section line search on
+    the ellipticity (in the unbounded fit space) and then the position angle, with the
+    other radii held fixed. A move is only accepted if it lowers the loss. ellip and pa
+    are updated in place.
+
+    returns: number of accepted moves, change in ellipticity (fit space) and position angle
+    """
+    change = np.zeros(2)
+    accepted = 0
+    base = _FFT_Robust_Cache_Loss(cache, dat, R, ellip, pa, i, C, noise, polar = polar)
+    # ellipticity line search, the samples are kept so an accepted move needs no extra evaluation
+    samples = {}
+    x0 = _inv_x_to_eps(ellip[i])
+    def f_ellip(x):
+        E = copy(ellip)
+        E[i] = _x_to_eps(x)
+        samples[x] = _FFT_Robust_Cache_f2(cache, dat, R, E, pa, i, C, noise, polar = polar)
+        return samples[x][0]*(1 + _FFT_Robust_reg(E, pa, i))
+    x, fx, n = _Golden_Section(f_ellip, x0 - width[0], x0 + width[0], width[0]/20)
+    if fx < base:
+        change[0] = abs(x - x0)
+        ellip[i] = _x_to_eps(x)
+        _FFT_Robust_Cache_Accept(cache, i, *samples[x])
+        base = fx
+        accepted += 1
+    # position angle line search
+    samples = {}
+    p0 = pa[i]
+    def f_pa(p):
+        PA = copy(pa)
+        PA[i] = p % np.pi
+        samples[p] = _FFT_Robust_Cache_f2(cache, dat, R, ellip, PA, i, C, noise, polar = polar)
+        return samples[p][0]*(1 + _FFT_Robust_reg(ellip, PA, i))
+    p, fp, n = _Golden_Section(f_pa, p0 - width[1], p0 + width[1], width[1]/20)
+    if fp < base:
+        change[1] = abs(p - p0)
+        pa[i] = p % np.pi
+        _FFT_Robust_Cache_Accept(cache, i, *samples[p])
+        accepted += 1
+    return accepted, change
+
+# Image and radii for the red-black worker processes, set once per process by _Set_Fit_Data
+_fit_data = {}
+
+def _Set_Fit_Data(dat, R, C, noise, polar):
+    """
+    Internal, Pool initializer for the red-black coordinate descent workers.
+    """
+    _fit_data.update(dat = dat, R = R, C = C, noise = noise, polar = polar)
+
+def _FFT_Robust_Coordinate_Chunk(radii, ellip, pa, f2, width):
+    """
+    Internal, coordinate descent steps in a red-black worker process for a set of radii
+    of one colour (none of them neighbours), see _FFT_Robust_Coordinate. "f2" is the
+    cached f2 at each radius, NaN if the parent has not sampled it yet.
+
+    returns: list of (radius, ellip, pa, accepted, change, samples) where samples is
+             (f2, isovals, coefs) at the new ellipse or None if the parent already has them,
+             and the number of loss evaluations
+    """
+    d = _fit_data
+    ellip, pa = copy(ellip), copy(pa)
+    cache = _FFT_Robust_Cache(len(d['R']))
+    cache['f2'][radii] = f2
+    steps = []
+    for i in radii:
+        accepted, change = _FFT_Robust_Coordinate_Radius(cache, d['dat'], d['R'], ellip, pa, i, d['C'], d['noise'], d['polar'], width)
+        steps.append((i, ellip[i], pa[i], accepted, change,
+                      None if cache['isovals'][i] is None else (cache['f2'][i], cache['isovals'][i], cache['coefs'][i])))
+    return steps, cache['evaluations']
+
+def _FFT_Robust_Coordinate(dat, R, ellip, pa, C, noise, name = '', polar = None, rtol = None, timelimit = None, pool = None, procs = 1):
+    """
+    Internal, deterministic coordinate descent for the FFT_Robust loss. Each sweep
+    visits the radii in order and runs a golden-section line search on the
+    ellipticity (in the unbounded fit space) and then the position angle, with
+    the other radii held fixed. A move is only accepted if it lowers the loss.
+    The search interval shrinks every sweep, the fit stops once a sweep makes
+    no significant change.
+
+    With a pool (initialized with _Set_Fit_Data) each sweep is red-black: the
+    regularization only couples neighbouring radii, so all even radii are
+    updated at once split over "procs" processes, then all odd radii.
+
+    returns: ellip, pa, number of sweeps, number of loss evaluations, fit trace, samples at each radius
+    """
+    start = time()
+    trace = {'sweep': [], 'loss': [], 'accepted': [], 'max ellip change': [], 'max pa change': [], 'time': [], 'stop': 'iteration limit'}
+    ellip = copy(ellip)
+    pa = copy(pa)
+    width = np.array([0.3, 0.3])
+    cache = _FFT_Robust_Cache(len(R))
+    for count in range(1, 51):
+        prev_ellip, prev_pa = copy(ellip), copy(pa)
+        accepted = 0
+        max_change = np.zeros(2)
+        if pool is None:
+            for i in range(len(R)):
+                a, change = _FFT_Robust_Coordinate_Radius(cache, dat, R, ellip, pa, i, C, noise, polar, width)
+                accepted += a
+                max_change = np.maximum(max_change, change)
+        else:
+            for colour in range(2):
+                I = np.arange(colour, len(R), 2)
+                chunks = list(I[k::procs] for k in range(procs) if len(I[k::procs]) > 0)
+                for steps, evaluations in pool.starmap(_FFT_Robust_Coordinate_Chunk, list((J, ellip, pa, cache['f2'][J], width) for J in chunks)):
+                    cache['evaluations'] += evaluations
+                    for i, e, p, a, change, samples in steps:
+                        ellip[i], pa[i] = e, p
+                        accepted += a
+                        max_change = np.maximum(max_change, change)
+                        if not samples is None:
+                            _FFT_Robust_Cache_Accept(cache, i, *samples)
+        _Fit_Trace_Update(trace, _FFT_Robust_Cache_Total(cache, dat, R, ellip, pa, C, noise, polar = polar), accepted, ellip, pa, prev_ellip, prev_pa, start)
+        logging.debug('%s: sweep: %i, max change: %s' % (name, count, str(max_change)))
+        if count > 1 and np.all(max_change < 5e-3):
+            trace['stop'] = 'converged'
+            break
+        stop = _Fit_Converged(trace, rtol, timelimit)
+        if not stop is None:
+            trace['stop'] = stop
+            break
+        width = np.clip(width*0.6, a_min = 0.02, a_max = None)
+    return ellip, pa, count, cache['evaluations'], trace, _FFT_Robust_Cache_Samples(cache)
+
+def _FFT_Robust_LBFGS(dat, R, ellip, pa, C, noise, name = '', polar = None, rtol = None, timelimit = None):
+    """
+    Internal, joint L-BFGS fit of all radii for the FFT_Robust loss, the total loss
+    is the sum of the loss at each radius. Gradients are computed with forward
+    finite differences. Since the regularization only couples neighbouring radii,
+    every third radius can be perturbed at once and the change in loss attributed
+    to each of them separately, so a gradient takes 6 batched passes rather than
+    one per parameter. The step for each radius moves the isophote by about a
+    pixel, large isophotes are sampled at the nearest pixel so smaller steps
+    would see a flat loss. Note the loss is not smooth (quantile clipping, pixel
+    sampling, absolute values in the regularization) so this can stop short of
+    the minimum found by the other optimizers. Each L-BFGS iteration is one
+    sweep in the fit trace.
+
+    returns: ellip, pa, number of iterations, number of loss evaluations, fit trace, samples at each radius (not kept)
+    """
+    start = time()
+    trace = {'sweep': [], 'loss': [], 'accepted': [], 'max ellip change': [], 'max pa change': [], 'time': [], 'stop': 'converged'}
+    N = len(R)
+    h = np.clip(1./np.array(R), a_min = 1e-2, a_max = 0.3)
+    evaluations = [0]
+    state = {'z': np.concatenate((_inv_x_to_eps(np.array(ellip)), np.array(pa))), 'loss': np.inf, 'stop': False}
+    def _losses(z, f2 = None, update = None):
+        E = _x_to_eps(z[:N])
+        PA = z[N:]
+        if f2 is None:
+            f2 = np.array(list(_FFT_Robust_f2(dat, R, E, PA, i, C, noise, polar = polar) for i in range(N)))
+            evaluations[0] += N
+        else:
+            f2 = copy(f2)
+            for i in update:
+                f2[i] = _FFT_Robust_f2(dat, R, E, PA, i, C, noise, polar = polar)
+            evaluations[0] += len(update)
+        reg = np.array(list(_FFT_Robust_reg(E, PA, i) for i in range(N)))
+        return f2, f2*(1 + reg)
+        
+    def _total_and_grad(z):
+        f2, L = _losses(z)
+        state['last'] = (z, np.sum(L))
+        grad = np.zeros(2*N)
+        # A zero gradient makes L-BFGS stop once a convergence criteria is met
+        if state['stop']:
+            return np.sum(L), grad
+        for param in range(2):
+            for colour in range(3):
+                J = np.arange(colour, N, 3)
+                zp = copy(z)
+                zp[param*N + J] += h[J]
+                dL = _losses(zp, f2, J)[1] - L
+                # each perturbed radius changes only its own loss and its neighbours
+                window = copy(dL)
+                window[1:] += dL[:-1]
+                window[:-1] += dL[1:]
+                grad[param*N + J] = window[J] / h[J]
+        grad[np.logical_not(np.isfinite(grad))] = 0.
+        return np.sum(L), grad
+
+    def _callback(z):
+        if np.array_equal(state['last'][0], z):
+            loss = state['last'][1]
+        else:
+            loss = np.sum(_losses(z)[1])
+        accepted = int(np.sum(z != state['z']))
+        _Fit_Trace_Update(trace, loss, accepted, _x_to_eps(z[:N]), z[N:], _x_to_eps(state['z'][:N]), state['z'][N:], start)
+        state['z'] = copy(z)
+        stop = _Fit_Converged(trace, rtol, timelimit)
+        if not stop is None:
+            trace['stop'] = stop
+            state['stop'] = True
+        
+    res = minimize(_total_and_grad, x0 = state['z'], jac = True, method = 'L-BFGS-B', options = {'maxiter': 100}, callback = _callback)
+    logging.debug('%s: L-BFGS fit message: %s' % (name, str(res.message)))
+    if res.nit >= 100:
+        trace['stop'] = 'iteration limit'
+    return _x_to_eps(res.x[:N]), res.x[N:] % np.pi, res.nit, evaluations[0], trace, {'isovals': [None]*N, 'coefs': [None]*N}
+
+def _FFT_Robust_Chain(optimizer, dat, R, ellip, pa, C, noise, name, polar, rtol, timelimit, seed, jitter):
+    """
+    Internal, run one chain of the FFT_Robust fit. A chain with jitter starts from the initial
+    ellipticity and position angle shifted by a random offset (the same at all radii). The
+    total loss of the final fit is returned so that chains can be compared.
+
+    returns: ellip, pa, number of sweeps, number of loss evaluations, fit trace, samples at each radius, total loss
+    """
+    np.random.seed(seed)
+    if jitter:
+        ellip = _x_to_eps(_inv_x_to_eps(np.array(ellip)) + np.random.normal(loc = 0, scale = 0.2))
+        pa = (np.array(pa) + np.random.normal(loc = 0, scale = 0.2)) % np.pi
+    ellip, pa, count, evaluations, trace, samples = optimizer(dat, R, ellip, pa, C, noise, name = name, polar = polar, rtol = rtol, timelimit = timelimit)
+    total = sum(_FFT_Robust_loss(dat, R, ellip, pa, i, C, noise, polar = polar) for i in range(len(R)))
+    return ellip, pa, count, evaluations + len(R), trace, samples, total
 
 def Isophote_Fit_FFT_Robust(IMG, pixscale, name, results, **kwargs):
     """
     Fit isophotes by minimizing the amplitude of the second FFT coefficient, relative to the local median flux.
     Included is a regularization term which penalizes isophotes for having large differences between parameters
-    of adjacent isophotes.
+    of adjacent isophotes. The optimizer is chosen with "fit_optimizer", either 'random' (default) for a random
+    perturbation hill climb, 'coordinate' for a deterministic coordinate descent with golden-section line searches,
+    or 'lbfgs' to fit all radii jointly with L-BFGS. The total loss, number of accepted moves and largest parameter
+    change after each sweep are recorded in the "fit trace" result. The fit can be stopped early once the total loss
+    improves by less than "fit_rtol" (relative) or after "fit_timelimit" seconds, the best fit so far is used.
+    Setting "fit_chains" above 1 runs that many independent fits (spread over "fit_procs" processes) from
+    jittered starting points and keeps the one with the lowest total loss. With one chain and the 'coordinate'
+    optimizer, "fit_procs" above 1 splits each sweep over that many processes (see _FFT_Robust_Coordinate),
+    which shortens the fit of a single large galaxy. Neither is possible inside a daemonic process (ie a
+    multiprocessing Pool worker), there a warning is logged and one chain is run in serial. Process_List runs
+    images in non-daemonic workers when these are set, see Isophote_Pipeline._Process_Supervised.
+    The flux samples and FFT coefficients of the final isophotes, as well as the samples at the initial
+    ellip/pa, are returned in "fit samples" so that Check_Fit_IQR does not need to extract them again.
 
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -115,15 +509,18 @@ def Isophote_Fit_FFT_Robust(IMG, pixscale, name, results, **kwargs):
 
     # subtract background from image during processing
     dat = IMG - results['background']
+    polar = results['polar image'] if 'polar image' in results else None
 
     # Determine sampling radii
     ######################################################################
     shrink = 0
     while shrink < 5:
         sample_radii = [3*results['psf fwhm']/2]
+        init_isovals = []
         while sample_radii[-1] < (max(IMG.shape)/2):
             isovals = _iso_extract(dat,sample_radii[-1],results['init ellip'],
-                                   results['init pa'],results['center'], more = True)
+                                   results['init pa'],results['center'], more = True, polar = polar)
+            init_isovals.append(isovals[0])
             if np.median(isovals[0]) < 2*results['background noise']:
                 break
             sample_radii.append(sample_radii[-1]*(1.+scale/(1.+shrink)))
@@ -140,45 +537,47 @@ def Isophote_Fit_FFT_Robust(IMG, pixscale, name, results, **kwargs):
     
     # Fit isophotes
     ######################################################################
-    perturb_scale = np.array([0.03, 0.06])
-
-    N_perturb = 5
-
-    count = 0
-
-    count_nochange = 0
     use_center = copy(results['center'])
-    I = np.array(range(len(sample_radii)))
-    while count < 300 and count_nochange < (3*len(sample_radii)):
-        # Periodically include logging message
-        if count % 10 == 0:
-            logging.debug('%s: count: %i' % (name,count))
-        count += 1
-        
-        np.random.shuffle(I)
-        for i in I:
-            perturbations = []
-            perturbations.append({'ellip': copy(ellip), 'pa': copy(pa)})
-            perturbations[-1]['loss'] = _FFT_Robust_loss(dat, sample_radii, perturbations[-1]['ellip'], perturbations[-1]['pa'], i,
-                                                         use_center, results['background noise'], 1., name = name)
-            for n in range(N_perturb):
-                perturbations.append({'ellip': copy(ellip), 'pa': copy(pa)})
-                if count % 3 in [0,1]:
-                    perturbations[-1]['ellip'][i] = _x_to_eps(_inv_x_to_eps(perturbations[-1]['ellip'][i]) + np.random.normal(loc = 0, scale = perturb_scale[0]))
-                if count % 3 in [1,2]:
-                    perturbations[-1]['pa'][i] = (perturbations[-1]['pa'][i] + np.random.normal(loc = 0, scale = perturb_scale[1])) % np.pi
-                perturbations[-1]['loss'] = _FFT_Robust_loss(dat, sample_radii, perturbations[-1]['ellip'], perturbations[-1]['pa'], i,
-                                                             use_center, results['background noise'], 1., name = name)
-            
-            best = np.argmin(list(p['loss'] for p in perturbations))
-            if best > 0:
-                ellip = copy(perturbations[best]['ellip'])
-                pa = copy(perturbations[best]['pa'])
-                count_nochange = 0
-            else:
-                count_nochange += 1
+    optimizers = {'random': _FFT_Robust_Random, 'coordinate': _FFT_Robust_Coordinate, 'lbfgs': _FFT_Robust_LBFGS}
+    optimizer = kwargs['fit_optimizer'] if 'fit_optimizer' in kwargs else 'random'
+    if not optimizer in optimizers:
+        raise ValueError('Unrecognized fit_optimizer: %s, should be one of: %s' % (optimizer, str(list(optimizers.keys()))))
+    rtol = kwargs['fit_rtol'] if 'fit_rtol' in kwargs else None
+    timelimit = kwargs['fit_timelimit'] if 'fit_timelimit' in kwargs else None
+    chains = kwargs['fit_chains'] if 'fit_chains' in kwargs else 1
+    procs = kwargs['fit_procs'] if 'fit_procs' in kwargs else chains
+    # daemonic processes (ie Pool workers) cannot start a pool of their own
+    if current_process().daemon and (chains > 1 or procs > 1):
+        logging.warning('%s: fit_chains and fit_procs need their own processes, which cannot be started inside a daemonic process, running one chain in serial' % name)
+        chains, procs = 1, 1
+    if chains > 1:
+        # Independent chains, the first starts from the initialization and the rest from a random offset
+        seeds = np.random.randint(2**31, size = chains)
+        args = list((optimizers[optimizer], dat, sample_radii, ellip, pa, use_center, results['background noise'], name, polar,
+                     rtol, timelimit, seeds[c], c > 0) for c in range(chains))
+        procs = min(chains, procs)
+        if procs > 1:
+            with Pool(procs) as pool:
+                fits = pool.starmap(_FFT_Robust_Chain, args)
+        else:
+            fits = list(_FFT_Robust_Chain(*a) for a in args)
+        best = np.argmin(list(f[6] for f in fits))
+        logging.info('%s: isophote fit chain losses: %s, keeping chain %i' % (name, str(list(np.round(f[6],5) for f in fits)), best))
+        ellip, pa, count, evaluations, trace, samples = fits[best][:6]
+        evaluations = sum(f[3] for f in fits)
+    elif procs > 1 and optimizer == 'coordinate':
+        with Pool(procs, initializer = _Set_Fit_Data, initargs = (dat, sample_radii, use_center, results['background noise'], polar)) as pool:
+            ellip, pa, count, evaluations, trace, samples = _FFT_Robust_Coordinate(dat, sample_radii, ellip, pa, use_center, results['background noise'],
+                                                                                   name = name, polar = polar, rtol = rtol, timelimit = timelimit,
+                                                                                   pool = pool, procs = procs)
+    else:
+        if procs > 1:
+            logging.warning('%s: fit_procs with a single chain only applies to the coordinate fit_optimizer, running in serial' % name)
+        ellip, pa, count, evaluations, trace, samples = optimizers[optimizer](dat, sample_radii, ellip, pa, use_center, results['background noise'],
+                                                                              name = name, polar = polar, rtol = rtol, timelimit = timelimit)
+    fitted_ellip, fitted_pa = copy(ellip), copy(pa)
                 
-    logging.info('%s: Completed isohpote fit in %i itterations' % (name, count))
+    logging.info('%s: Completed isohpote fit in %i itterations with %i loss evaluations, stopped by: %s' % (name, count, evaluations, trace['stop']))
     # detect collapsed center
     ######################################################################
     for i in range(5):
@@ -188,9 +587,13 @@ def Isophote_Fit_FFT_Robust(IMG, pixscale, name, results, **kwargs):
 
     # extend to noise floor
     ######################################################################
+    fit_isovals = list(samples['isovals'])
+    fit_coefs = list(samples['coefs'])
     while sample_radii[-1] < (max(IMG.shape)/2):
         isovals = _iso_extract(dat,sample_radii[-1],ellip[-1],
-                               pa[-1],results['center'])
+                               pa[-1],results['center'], polar = polar)
+        if len(fit_isovals) < len(sample_radii):
+            fit_isovals.append(isovals)
         if np.median(isovals) < results['background noise']:
             break
         sample_radii.append(sample_radii[-1]*(1.+scale/(1.+shrink)))
@@ -205,27 +608,28 @@ def Isophote_Fit_FFT_Robust(IMG, pixscale, name, results, **kwargs):
     smooth_ellip = _ellip_smooth(sample_radii, smooth_ellip, 5)
     smooth_pa = _pa_smooth(sample_radii, smooth_pa, 5)
     
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
         ranges = [[max(0,int(use_center['x']-sample_radii[-1]*1.2)), min(dat.shape[1],int(use_center['x']+sample_radii[-1]*1.2))],
                   [max(0,int(use_center['y']-sample_radii[-1]*1.2)), min(dat.shape[0],int(use_center['y']+sample_radii[-1]*1.2))]]
-        plt.imshow(np.clip(dat[ranges[1][0]: ranges[1][1], ranges[0][0]: ranges[0][1]],
-                           a_min = 0,a_max = None), origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch())) 
+        plot = Plot_Spec('%sloss_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 300)
+        Plot_Add(plot, 'imshow', np.clip(dat[ranges[1][0]: ranges[1][1], ranges[0][0]: ranges[0][1]],
+                                         a_min = 0,a_max = None), origin = 'lower', cmap = 'Greys_r', norm = 'log') 
         for i in range(len(sample_radii)):
-            plt.gca().add_patch(Ellipse((use_center['x'] - ranges[0][0],use_center['y'] - ranges[1][0]), 2*sample_radii[i], 2*sample_radii[i]*(1. - ellip[i]),
-                                        pa[i]*180/np.pi, fill = False, linewidth = 0.5, color = 'r'))
-        plt.savefig('%sloss_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 300)
-        plt.close()
+            Plot_Add(plot, 'ellipse', (use_center['x'] - ranges[0][0],use_center['y'] - ranges[1][0]), 2*sample_radii[i], 2*sample_radii[i]*(1. - ellip[i]),
+                                      pa[i]*180/np.pi, fill = False, linewidth = 0.5, color = 'r')
+        plots.append(plot)
         
-        plt.scatter(sample_radii, _inv_x_to_eps(ellip), color = 'r', label = 'ellip')
-        plt.scatter(sample_radii, pa/np.pi, color = 'b', label = 'pa')
+        plot = Plot_Spec('%sisoprof_%s_fin.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'scatter', sample_radii, _inv_x_to_eps(ellip), color = 'r', label = 'ellip')
+        Plot_Add(plot, 'scatter', sample_radii, pa/np.pi, color = 'b', label = 'pa')
         show_ellip = _ellip_smooth(sample_radii, ellip, deg = 5)
         show_pa = _pa_smooth(sample_radii, pa, deg = 5)
-        plt.plot(sample_radii, _inv_x_to_eps(show_ellip), color = 'orange', linewidth = 2, linestyle='--', label = 'huber ellip')
-        plt.plot(sample_radii, show_pa/np.pi, color = 'purple', linewidth = 2, linestyle='--', label = 'huber pa')
-        #plt.xscale('log')
-        plt.legend()
-        plt.savefig('%sisoprof_%s_fin.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        Plot_Add(plot, 'plot', sample_radii, _inv_x_to_eps(show_ellip), color = 'orange', linewidth = 2, linestyle='--', label = 'huber ellip')
+        Plot_Add(plot, 'plot', sample_radii, show_pa/np.pi, color = 'purple', linewidth = 2, linestyle='--', label = 'huber pa')
+        #Plot_Add(plot, 'xscale', 'log')
+        Plot_Add(plot, 'legend')
+        plots.append(plot)
 
     # Compute errors
     ######################################################################
@@ -239,8 +643,19 @@ def Isophote_Fit_FFT_Robust(IMG, pixscale, name, results, **kwargs):
         ellip_err[i] = np.sqrt(np.sum((ellip[i-2:i+2] - smooth_ellip[i-2:i+2])**2)/4)
         pa_err[i] = np.sqrt(np.sum((pa[i-2:i+2] - smooth_pa[i-2:i+2])**2)/4)
 
+    # Flux samples at the final isophotes and the initialization, for use in Check_Fit
+    ######################################################################
+    fit_isovals += [None]*(len(sample_radii) - len(fit_isovals))
+    fit_coefs += [None]*(len(sample_radii) - len(fit_coefs))
+    init_isovals += [None]*(len(sample_radii) - len(init_isovals))
+    for i in range(len(fitted_ellip)):
+        # isophotes adjusted after the optimizer (collapsed center, smoothed core) must be re-sampled
+        if ellip[i] != fitted_ellip[i] or pa[i] != fitted_pa[i]:
+            fit_isovals[i], fit_coefs[i] = None, None
+    fit_samples = {'isovals': fit_isovals, 'coefs': fit_coefs, 'init isovals': init_isovals, 'center': use_center}
+    
     res = {'fit ellip': ellip, 'fit pa': pa, 'fit R': sample_radii,
-           'fit ellip_err': ellip_err, 'fit pa_err': pa_err}
+           'fit ellip_err': ellip_err, 'fit pa_err': pa_err, 'fit trace': trace, 'fit samples': fit_samples, 'diagnostic plots': plots}
     return res
 
 def Isophote_Fit_Forced(IMG, pixscale, name, results, **kwargs):
@@ -265,6 +680,7 @@ def Isophote_Fit_Forced(IMG, pixscale, name, results, **kwargs):
             for d, h in zip(l.split(','), header):
                 force[h].append(float(d.strip()))
                 
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
         dat = IMG - results['background']
         logging.info(results['center'])
@@ -272,17 +688,18 @@ def Isophote_Fit_Forced(IMG, pixscale, name, results, **kwargs):
         logging.info(force['R'])
         ranges = [[max(0,int(results['center']['y'] - (np.array(force['R'])[-1]/pixscale)*1.2)), min(dat.shape[0],int(results['center']['y'] + (np.array(force['R'])[-1]/pixscale)*1.2))],
                   [max(0,int(results['center']['x'] - (np.array(force['R'])[-1]/pixscale)*1.2)), min(dat.shape[1],int(results['center']['x'] + (np.array(force['R'])[-1]/pixscale)*1.2))]]
-        plt.imshow(np.clip(dat[ranges[0][0]: ranges[0][1], ranges[1][0]: ranges[1][1]],
-                           a_min = 0,a_max = None), origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch())) 
+        plot = Plot_Spec('%sloss_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 300)
+        Plot_Add(plot, 'imshow', np.clip(dat[ranges[0][0]: ranges[0][1], ranges[1][0]: ranges[1][1]],
+                                         a_min = 0,a_max = None), origin = 'lower', cmap = 'Greys_r', norm = 'log') 
         for i in range(0,len(np.array(force['R'])),2):
-            plt.gca().add_patch(Ellipse((results['center']['x'] - ranges[0][0],results['center']['y'] - ranges[1][0]), 2*(np.array(force['R'])[i]/pixscale),
-                                        2*(np.array(force['R'])[i]/pixscale)*(1. - force['ellip'][i]),
-                                        force['pa'][i], fill = False, linewidth = 0.5, color = 'r'))
-        plt.savefig('%sloss_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 300)
-        plt.close()                
+            Plot_Add(plot, 'ellipse', (results['center']['x'] - ranges[0][0],results['center']['y'] - ranges[1][0]), 2*(np.array(force['R'])[i]/pixscale),
+                                      2*(np.array(force['R'])[i]/pixscale)*(1. - force['ellip'][i]),
+                                      force['pa'][i], fill = False, linewidth = 0.5, color = 'r')
+        plots.append(plot)
     res = {'fit ellip': np.array(force['ellip']),
            'fit pa': np.array(force['pa'])*np.pi/180,
-           'fit R': list(np.array(force['R'])/pixscale)}
+           'fit R': list(np.array(force['R'])/pixscale),
+           'diagnostic plots': plots}
     if 'ellip_e' in force and 'pa_e' in force:
         res['fit ellip_err'] = np.array(force['ellip_e'])
         res['fit pa_err'] = np.array(force['pa_e'])*np.pi/180
@@ -1,23 +1,21 @@
 import numpy as np
-from scipy.fftpack import fft, ifft, dct, idct
-from scipy.optimize import minimize
+from scipy.fftpack import fft
 from scipy.stats import iqr
 import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
-from autoprofutils.SharedFunctions import _iso_extract, _x_to_eps, _x_to_pa, _inv_x_to_pa, _inv_x_to_eps
+from autoprofutils.SharedFunctions import _iso_extract, _iso_extract_multi, _polar_grid, _polar_extract, _x_to_eps, _inv_x_to_eps
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
 import logging
-from copy import copy
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-import matplotlib.pyplot as plt
-from matplotlib.patches import Ellipse
 from time import time
 
 def Isophote_Initialize_GridSearch(IMG, pixscale, name, results, **kwargs):
     """
     Determine the global pa and ellipticity for a galaxy by sampling a large number
-    of pa/ellip combinations.
+    of pa/ellip combinations. The image is sampled once on a polar grid, then the
+    flux along every ellipse in the (ellip, pa, radius) grid is read from those
+    samples. Rotating an ellipse is just a shift of the polar angle index, so all
+    position angles are evaluated at the cost of a re-indexing.
 
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -25,6 +23,7 @@ def Isophote_Initialize_GridSearch(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    dat = IMG - results['background']
     ######################################################################
     # Find global ellipticity and position angle.
     # Initial attempt to find size of galaxy in image
@@ -33,62 +32,107 @@ def Isophote_Initialize_GridSearch(IMG, pixscale, name, results, **kwargs):
     circ_ellipse_radii = [results['psf fwhm']]
     while circ_ellipse_radii[-1] < (len(IMG)/2):
         circ_ellipse_radii.append(circ_ellipse_radii[-1]*(1+0.3))
-        # Stop when at 10 time background noise
-        if np.quantile(_iso_extract(IMG - results['background'],circ_ellipse_radii[-1],0.,0.,results['center']), 0.6) < (3*results['background noise']) and len(circ_ellipse_radii) > 4:
-            break
-    logging.info('%s: init scale: %f' % (name, circ_ellipse_radii[-1]))
     circ_ellipse_radii = np.array(circ_ellipse_radii)
 
+    # Sample the image once on a polar grid
+    Nphi = 160
+    P, polar_radii, phi = _polar_grid(dat, results['center'], circ_ellipse_radii[-1], Nphi = Nphi)
+
+    # Stop when at 3 times background noise
+    circ_flux = np.quantile(_polar_extract(P, polar_radii, circ_ellipse_radii, 0.)[:,0,:], 0.6, axis = 1)
+    low = np.flatnonzero(np.logical_and(circ_flux < (3*results['background noise']), np.arange(len(circ_ellipse_radii)) >= 4))
+    if len(low) > 0:
+        circ_ellipse_radii = circ_ellipse_radii[:low[0]+1]
+    logging.info('%s: init scale: %f' % (name, circ_ellipse_radii[-1]))
+
     ######################################################################
     # Large scale fit with constant pa and ellipticity via grid search.
     # simultaneously fits at all scales as rough galaxy radius is not
     # very accurate yet.
 
-    # Make list of pa and ellipticity values to use for grid search
-    initializations = []
-    N_e, N_pa = 10, 20
-    for e in np.linspace(_inv_x_to_eps(0.2),_inv_x_to_eps(0.8),N_e): 
-        for p in np.linspace(0., (N_pa-1)*np.pi/N_pa,N_pa): 
-            initializations.append((e,p))
-
-    # Cycle through pa and ellipticity values and compute loss
-    best = [np.inf, -1, []]
-    loss_results = []
-    logging.info('%s: Initializing' % name)
-    for e,p in initializations:
-        logging.debug('%s: %.2f, %.2f' % (name,e,p))
-        loss_results.append(_Fit_Isophotes_Loss([[e,p]]*len(circ_ellipse_radii), IMG,
-                                                circ_ellipse_radii, results['center'],
-                                                range(len(circ_ellipse_radii)),
-                                                iso_norms = [], fftlim = 7))
-        # Track best pa/ellipticity combination so far
-        if loss_results[-1] < best[0]:
-            best[0] = loss_results[-1]
-            best[1] = int(len(loss_results)-1)
-            best[2] = copy([e,p])
-            logging.debug('%s: best: %f %s' % (name,best[0], str(best[2][0])))
+    # Grid of ellipticity values, pa values are rotations of the polar samples up to pi
+    N_e, N_pa = 10, 40
+    test_x = np.linspace(_inv_x_to_eps(0.2),_inv_x_to_eps(0.8),N_e)
+    shifts = np.arange(N_pa)*int(Nphi/(2*N_pa))
+    EE, RR = np.meshgrid(_x_to_eps(test_x), circ_ellipse_radii, indexing = 'ij')
+    isovals = _polar_extract(P, polar_radii, RR.ravel(), EE.ravel(), shifts)
+    loss = np.sum(_CircfitEllip_loss_multi(isovals, results['background noise']).reshape(N_e, len(circ_ellipse_radii), len(shifts)), axis = 1)
+    best_e, best_p = np.unravel_index(np.argmin(loss), loss.shape)
+
+    # Refine the minimum with a parabola in each direction, pa is periodic
+    ellip = _x_to_eps(_Parabola_Refine(test_x, loss[:,best_p][None,:])[0])
+    pa_row = np.roll(loss[best_e], int(len(shifts)/2) - best_p)
+    pa_grid = (np.arange(len(shifts)) - int(len(shifts)/2) + best_p)*np.pi/N_pa
+    pa = _Parabola_Refine(pa_grid, pa_row[None,:], np.array([int(len(shifts)/2)]))[0] % np.pi
+    
+    plots = []
     if name != '' and 'doplot' in kwargs and kwargs['doplot']:
-        plt.imshow(np.clip(IMG,a_min = 0, a_max = None), origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch())) 
-        plt.gca().add_patch(Ellipse((results['center']['x'],results['center']['y']), 2*circ_ellipse_radii[-1], 2*circ_ellipse_radii[-1]*(1. - _x_to_eps(best[2][0])),
-                                    _x_to_pa(best[2][1])*180/np.pi, fill = False, linewidth = 1, color = 'y'))
-        plt.plot([results['center']['x']],[results['center']['y']], marker = 'x', markersize = 10, color = 'y')
-        plt.savefig('%sinitialize_ellipse_%s.png' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        plot = Plot_Spec('%sinitialize_ellipse_%s.png' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(IMG,a_min = 0, a_max = None), origin = 'lower', cmap = 'Greys_r', norm = 'log') 
+        Plot_Add(plot, 'ellipse', (results['center']['x'],results['center']['y']), 2*circ_ellipse_radii[-1], 2*circ_ellipse_radii[-1]*(1. - ellip),
+                                  pa*180/np.pi, fill = False, linewidth = 1, color = 'y')
+        Plot_Add(plot, 'plot', [results['center']['x']],[results['center']['y']], marker = 'x', markersize = 10, color = 'y')
+        plots.append(plot)
 
-    logging.info('%s: best initialization: %s' % (name, str(best[2][0])))
-    return {'init ellip': best[2][0], 'init pa': best[2][1]}
+    logging.info('%s: best initialization: %.3f, %.3f' % (name, ellip, pa))
+    return {'init ellip': ellip, 'init pa': pa, 'init R': circ_ellipse_radii[-2], 'diagnostic plots': plots}
 
 def _CircfitEllip_loss(e, dat, r, p, c, n):
     isovals = _iso_extract(dat,r,e,p,c)
     coefs = fft(np.clip(isovals, a_max = np.quantile(isovals,0.85), a_min = None))
     return np.abs(coefs[2]) / (len(isovals)*(np.abs(np.median(isovals))+n))
 
+def _CircfitEllip_loss_multi(isovals, n):
+    """
+    Internal, batched version of _CircfitEllip_loss. The last axis of
+    isovals runs along each isophote, the loss is computed for all
+    isophotes at once.
+    """
+    coefs = fft(np.clip(isovals, a_max = np.quantile(isovals,0.85, axis = -1)[...,None], a_min = None), axis = -1)
+    return np.abs(coefs[...,2]) / (isovals.shape[-1]*(np.abs(np.median(isovals, axis = -1))+n))
+
+def _Grid_Descend(f, start):
+    """
+    Internal, for each row of f walk downhill from the grid index start
+    until reaching a local minimum, like a local optimizer would.
+    """
+    rows = np.arange(f.shape[0])
+    i = np.full(f.shape[0], start, dtype = int)
+    for step in range(f.shape[1]):
+        left = f[rows, np.clip(i-1, a_min = 0, a_max = None)]
+        right = f[rows, np.clip(i+1, a_min = None, a_max = f.shape[1]-1)]
+        move = np.where(left < right, -1, 1) * (np.minimum(left, right) < f[rows,i])
+        if np.all(move == 0):
+            break
+        i += move
+    return i
+
+def _Parabola_Refine(x, f, i = None):
+    """
+    Internal, locate the minimum of each row of f (evaluated at the
+    grid points x) by fitting a parabola through the grid point i
+    (by default the lowest) and its two neighbours. Falls back to the
+    grid point when the three points are not convex.
+    """
+    f = np.atleast_2d(f)
+    if i is None:
+        i = np.argmin(f, axis = 1)
+    rows = np.arange(f.shape[0])
+    best = x[i]
+    i = np.clip(i, a_min = 1, a_max = len(x)-2)
+    fl, fc, fr = f[rows,i-1], f[rows,i], f[rows,i+1]
+    h = x[1] - x[0]
+    curve = fl - 2*fc + fr
+    shift = 0.5*h*(fl - fr)/np.where(curve > 0, curve, 1.)
+    return np.where(curve > 0, x[i] + np.clip(shift, a_min = -h, a_max = h), best)
+
 def Isophote_Initialize_CircFit(IMG, pixscale, name, results, **kwargs):
     """
     Determine the global pa and ellipticity for a galaxy. First grow circular isophotes
     until reaching near the noise floor, then evaluate the phase of the second FFT
     coefficients and determine the average direction. Then fit an ellipticity for one
-    of the outer isophotes.
+    of the outer isophotes. The ellipticity search and error estimate sample all of their
+    trial ellipses in a single batch, then refine the minimum with a parabola.
 
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -106,10 +150,11 @@ def Isophote_Initialize_CircFit(IMG, pixscale, name, results, **kwargs):
     phasekeep = []
     allphase = []
     dat = IMG - results['background']
+    polar = results['polar image'] if 'polar image' in results else None
 
     while circ_ellipse_radii[-1] < (len(IMG)/2):
         circ_ellipse_radii.append(circ_ellipse_radii[-1]*(1+0.2))
-        isovals = _iso_extract(dat,circ_ellipse_radii[-1],0.,0.,results['center'], more = True)
+        isovals = _iso_extract(dat,circ_ellipse_radii[-1],0.,0.,results['center'], more = True, polar = polar)
         coefs = fft(np.clip(isovals[0], a_max = np.quantile(isovals[0],0.85), a_min = None))
         allphase.append(coefs[2])
         if np.abs(coefs[2]) > np.abs(coefs[1]) and np.abs(coefs[2]) > np.abs(coefs[3]):
@@ -124,33 +169,37 @@ def Isophote_Initialize_CircFit(IMG, pixscale, name, results, **kwargs):
         phase = (-np.angle(np.mean(allphase[int(len(allphase)/2):]))/2) % np.pi
     logging.info('%s: circ ellipse radii %i, allphase %i' % (name, len(circ_ellipse_radii), len(allphase)))
     start = time()
+    # Evaluate every (ellipticity, radius) combination in a single batch
     test_ellip = np.linspace(0.05,0.95,15)
-    test_f2 = []
-    for e in test_ellip:
-        test_f2.append(sum(list(_CircfitEllip_loss(e, dat, circ_ellipse_radii[-2]*m, phase, results['center'], results['background noise']) for m in np.linspace(0.8,1.2,5))))
+    test_mult = np.linspace(0.8,1.2,5)
+    EE, MM = np.meshgrid(test_ellip, test_mult, indexing = 'ij')
+    isovals, _ = _iso_extract_multi(dat, circ_ellipse_radii[-2]*MM.ravel(), EE.ravel(), phase, results['center'], polar = polar)
+    test_f2 = np.sum(_CircfitEllip_loss_multi(isovals, results['background noise']).reshape(EE.shape), axis = 1)
     ellip = test_ellip[np.argmin(test_f2)]
-    res = minimize(lambda e,d,r,p,c,n: sum(list(_CircfitEllip_loss(_x_to_eps(e[0]),d,r*m,p,c,n) for m in np.linspace(0.8,1.2,5))),
-                   x0 = _inv_x_to_eps(ellip), args = (dat, circ_ellipse_radii[-2],
-                                                      phase, results['center'],results['background noise']),
-                   method = 'Nelder-Mead',options = {'initial_simplex': [[_inv_x_to_eps(ellip)-1/15], [_inv_x_to_eps(ellip)+1/15]]})
-    if res.success:
-        logging.debug('%s: using optimal ellipticity %.3f over grid ellipticity %.3f' % (name, _x_to_eps(res.x[0]), ellip))
-        ellip = _x_to_eps(res.x[0])
+
+    # Refine the ellipticity on a fine grid around the best grid point
+    fine_ellip = np.linspace(max(0.02, ellip - (test_ellip[1] - test_ellip[0])), min(0.98, ellip + (test_ellip[1] - test_ellip[0])), 21)
+    EE, MM = np.meshgrid(fine_ellip, test_mult, indexing = 'ij')
+    isovals, _ = _iso_extract_multi(dat, circ_ellipse_radii[-2]*MM.ravel(), EE.ravel(), phase, results['center'], polar = polar)
+    fine_f2 = np.sum(_CircfitEllip_loss_multi(isovals, results['background noise']).reshape(EE.shape), axis = 1)
+    logging.debug('%s: using optimal ellipticity %.3f over grid ellipticity %.3f' % (name, _Parabola_Refine(fine_ellip, fine_f2)[0], ellip))
+    ellip = _Parabola_Refine(fine_ellip, fine_f2)[0]
 
     # Compute the error on the parameters
     ######################################################################
     RR = np.linspace(circ_ellipse_radii[-2] - results['psf fwhm'], circ_ellipse_radii[-2] + results['psf fwhm'], 10)
-    errallphase = []
-    for rr in RR:
-        isovals = _iso_extract(dat,rr,0.,0.,results['center'], more = True)
-        coefs = fft(np.clip(isovals[0], a_max = np.quantile(isovals[0],0.85), a_min = None))
-        errallphase.append(coefs[2])
+    isovals, _ = _iso_extract_multi(dat, RR, 0., 0., results['center'], polar = polar)
+    errallphase = fft(np.clip(isovals, a_max = np.quantile(isovals, 0.85, axis = 1)[:,None], a_min = None), axis = 1)[:,2]
     sample_pas = (-np.angle(1j*np.array(errallphase)/np.mean(errallphase))/2) % np.pi
     pa_err = iqr(sample_pas, rng = [16,84])/2
-    res_multi = map(lambda rrp: minimize(lambda e,d,r,p,c,n: _CircfitEllip_loss(_x_to_eps(e[0]),d,r,p,c,n),
-                                        x0 = _inv_x_to_eps(ellip), args = (dat, rrp[0], rrp[1], results['center'],results['background noise']),
-                                         method = 'Nelder-Mead',options = {'initial_simplex': [[_inv_x_to_eps(ellip)-1/15], [_inv_x_to_eps(ellip)+1/15]]}), zip(RR,sample_pas))
-    ellip_err = iqr(list(_x_to_eps(rm.x[0]) for rm in res_multi),rng = [16,84])/2
+    # Fit the ellipticity at each radius with one scan over an ellipticity grid,
+    # then follow each radius downhill from the global ellipticity
+    err_ellip = np.linspace(0.02,0.98,49)
+    EE, RP = np.meshgrid(err_ellip, np.arange(len(RR)), indexing = 'ij')
+    isovals, _ = _iso_extract_multi(dat, RR[RP.ravel()], EE.ravel(), sample_pas[RP.ravel()], results['center'], polar = polar)
+    err_f2 = _CircfitEllip_loss_multi(isovals, results['background noise']).reshape(EE.shape)
+    start_i = _Grid_Descend(err_f2.T, np.argmin(np.abs(err_ellip - ellip)))
+    ellip_err = iqr(_Parabola_Refine(err_ellip, err_f2.T, start_i), rng = [16,84])/2
     # logging.info('%s: ellipticity time: %f' % (name, time() - start))
     # plt.plot(test_ellip, np.array(test_iqr) - np.mean(test_iqr) , label = 'iqr', color = 'r')
     # plt.plot(test_ellip, np.array(test_f2) - np.mean(test_f2), label = 'f2', color = 'b')
@@ -165,18 +214,18 @@ def Isophote_Initialize_CircFit(IMG, pixscale, name, results, **kwargs):
     # plt.close()
         
     circ_ellipse_radii = np.array(circ_ellipse_radii)
+    plots = []
     if name != '' and 'doplot' in kwargs and kwargs['doplot']:
-
         ranges = [[max(0,int(results['center']['x']-circ_ellipse_radii[-1]*2)), min(dat.shape[1],int(results['center']['x']+circ_ellipse_radii[-1]*2))],
                   [max(0,int(results['center']['y']-circ_ellipse_radii[-1]*2)), min(dat.shape[0],int(results['center']['y']+circ_ellipse_radii[-1]*2))]]
         
-        plt.imshow(np.clip(dat[ranges[1][0]: ranges[1][1], ranges[0][0]: ranges[0][1]],a_min = 0, a_max = None),
-                   origin = 'lower', cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch())) 
-        plt.gca().add_patch(Ellipse((results['center']['x'] - ranges[0][0],results['center']['y'] - ranges[1][0]), 2*circ_ellipse_radii[-1], 2*circ_ellipse_radii[-1]*(1. - ellip),
-                                    phase*180/np.pi, fill = False, linewidth = 1, color = 'y'))
-        plt.plot([results['center']['x'] - ranges[0][0]],[results['center']['y'] - ranges[1][0]], marker = 'x', markersize = 3, color = 'r')
-        plt.savefig('%sinitialize_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        plot = Plot_Spec('%sinitialize_ellipse_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(dat[ranges[1][0]: ranges[1][1], ranges[0][0]: ranges[0][1]],a_min = 0, a_max = None),
+                                 origin = 'lower', cmap = 'Greys_r', norm = 'log') 
+        Plot_Add(plot, 'ellipse', (results['center']['x'] - ranges[0][0],results['center']['y'] - ranges[1][0]), 2*circ_ellipse_radii[-1], 2*circ_ellipse_radii[-1]*(1. - ellip),
+                                  phase*180/np.pi, fill = False, linewidth = 1, color = 'y')
+        Plot_Add(plot, 'plot', [results['center']['x'] - ranges[0][0]],[results['center']['y'] - ranges[1][0]], marker = 'x', markersize = 3, color = 'r')
+        plots.append(plot)
 
         # paper plot
         # fig, ax = plt.subplots(2,1)
@@ -196,4 +245,36 @@ def Isophote_Initialize_CircFit(IMG, pixscale, name, results, **kwargs):
         # plt.savefig('%sinitialize_ellipse_optimize_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
         # plt.close()
         
-    return {'init ellip': ellip, 'init ellip_err': ellip_err, 'init pa': phase, 'init pa_err': pa_err, 'init R': circ_ellipse_radii[-2]}
+    return {'init ellip': ellip, 'init ellip_err': ellip_err, 'init pa': phase, 'init pa_err': pa_err, 'init R': circ_ellipse_radii[-2],
+            'diagnostic plots': plots}
+
+def Isophote_Initialize_All(IMG, pixscale, name, results, **kwargs):
+    """
+    Run all the isophote initialization algorithms and compare the results.
+    The CircFit result is returned, with the diagnostic plots of both
+    algorithms, and one line is logged for each image with
+    "|" separated values: INITIALIZETEST|name|circfit ellip|grid ellip|circfit pa|grid pa|
+    ellip difference|pa difference (radians)|circfit time (s)|grid time (s)
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    name: string name of galaxy in image, used for log files to make searching easier
+    results: dictionary contianing results from past steps in the pipeline
+    kwargs: user specified arguments
+    """
+
+    start = time()
+    circfit = Isophote_Initialize_CircFit(IMG, pixscale, name, results, **kwargs)
+    circfit_time = time() - start
+    start = time()
+    gridsearch = Isophote_Initialize_GridSearch(IMG, pixscale, name, results, **kwargs)
+    gridsearch_time = time() - start
+
+    dpa = abs(circfit['init pa'] - gridsearch['init pa']) % np.pi
+    logging.info('INITIALIZETEST|%s|%f|%f|%f|%f|%f|%f|%.3f|%.3f' % (name, circfit['init ellip'], gridsearch['init ellip'],
+                                                                     circfit['init pa'], gridsearch['init pa'],
+                                                                     abs(circfit['init ellip'] - gridsearch['init ellip']),
+                                                                     min(dpa, np.pi - dpa), circfit_time, gridsearch_time))
+
+    circfit['diagnostic plots'] = circfit['diagnostic plots'] + gridsearch['diagnostic plots']
+    return circfit
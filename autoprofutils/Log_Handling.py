@@ -0,0 +1,196 @@
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import multiprocessing
+import threading
+import atexit
+import json
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+
+# Log records from every process are put on one multiprocessing queue, a listener
+# thread in the main process is the only writer to the log file. Worker processes
+# forked from the main process inherit the queue handler on the root logger, spawned
+# ones are given the queue and levels with Log_Settings and install it with Log_To_Queue.
+
+_stage = threading.local()
+_listener = None
+_log_queue = None
+
+def _Level(level):
+    """
+    Internal, convert a level name ('DEBUG', 'info', ...) or number to a logging level number.
+    """
+    if type(level) == str:
+        return getattr(logging, level.upper())
+    return int(level)
+
+class _Stage_Filter(logging.Filter):
+    """
+    Internal, label each record with the pipeline step running in the current
+    thread and drop records below the level set for that step.
+    """
+    def __init__(self):
+        super().__init__()
+        self.level = logging.INFO
+        self.stage_levels = {}
+
+    def filter(self, record):
+        record.stage = getattr(_stage, 'name', None)
+        if record.stage in self.stage_levels:
+            return record.levelno >= self.stage_levels[record.stage]
+        return record.levelno >= self.level
+
+class _JSON_Formatter(logging.Formatter):
+    """
+    Internal, write each record as one line of json.
+    """
+    def format(self, record):
+        entry = {'time': record.created, 'level': record.levelname, 'process': record.process,
+                 'stage': getattr(record, 'stage', None), 'message': record.getMessage()}
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+class _Pipe_Handler(QueueHandler):
+    """
+    Internal, send records over a multiprocessing connection instead of a queue.
+    """
+    def enqueue(self, record):
+        self.queue.send(('log', record))
+
+def Set_Log_Stage(stage):
+    """
+    Set the pipeline step running in the current thread, log records are labelled
+    with it and filtered by its level from "log_levels". None for no step.
+    """
+    _stage.name = stage
+
+def Start_Logging(logfile = 'AutoProf.log'):
+    """
+    Send all log messages to a listener thread which writes them to "logfile".
+    Replaces any handlers on the root logger, and any listener from a previous call.
+
+    logfile: path to the log file, overwritten if it exists
+    """
+    global _listener, _log_queue
+    Stop_Logging()
+    handler = logging.FileHandler(logfile, mode = 'w')
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    _log_queue = multiprocessing.Queue()
+    _listener = QueueListener(_log_queue, handler)
+    _listener.start()
+    queue_handler = QueueHandler(_log_queue)
+    queue_handler.addFilter(_Stage_Filter())
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+
+def Stop_Logging():
+    """
+    Write any queued log messages and stop the listener thread.
+    """
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+atexit.register(Stop_Logging)
+
+def _Stage_Filters():
+    """
+    Internal, stage filters on the root logger handlers.
+    """
+    return list(f for handler in logging.getLogger().handlers for f in handler.filters if isinstance(f, _Stage_Filter))
+
+def Configure_Logging(**kwargs):
+    """
+    Apply the user logging settings: "log_level" the lowest level written to the
+    log file, "log_levels" a dictionary of levels for individual pipeline steps,
+    and "log_format" 'text' or 'json'. Settings which are not given are left as
+    they are.
+    """
+    root = logging.getLogger()
+    for stage_filter in _Stage_Filters():
+        if 'log_level' in kwargs:
+            stage_filter.level = _Level(kwargs['log_level'])
+        if 'log_levels' in kwargs:
+            stage_filter.stage_levels = dict((s, _Level(kwargs['log_levels'][s])) for s in kwargs['log_levels'])
+        # The filters do the work, the root logger just needs to let everything through to them
+        root.setLevel(min([stage_filter.level] + list(stage_filter.stage_levels.values())))
+    if 'log_format' in kwargs and not _listener is None:
+        for handler in _listener.handlers:
+            handler.setFormatter(_JSON_Formatter() if kwargs['log_format'] == 'json' else logging.Formatter(logging.BASIC_FORMAT))
+
+def Log_Settings():
+    """
+    The log queue and the levels set by Configure_Logging, to pass to worker
+    processes (for example as a Pool initializer argument) for Log_To_Queue.
+
+    returns: tuple of the queue, the default level and the per step levels, the queue is None if logging was not started
+    """
+    stage_filters = _Stage_Filters()
+    if len(stage_filters) == 0:
+        return (_log_queue, logging.INFO, {})
+    return (_log_queue, stage_filters[0].level, dict(stage_filters[0].stage_levels))
+
+def Log_To_Queue(settings):
+    """
+    In a worker process, send all log records to the shared queue of the main
+    process. Spawned and forkserver workers do not inherit the logging setup,
+    forked workers get a fresh copy of the one they inherited.
+
+    settings: tuple from Log_Settings in the main process
+    """
+    log_queue, level, stage_levels = settings
+    if log_queue is None:
+        return
+    queue_handler = QueueHandler(log_queue)
+    stage_filter = _Stage_Filter()
+    stage_filter.level = level
+    stage_filter.stage_levels = stage_levels
+    queue_handler.addFilter(stage_filter)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(queue_handler)
+    root.setLevel(min([level] + list(stage_levels.values())))
+
+def Log_To_Pipe(conn):
+    """
+    In a worker process, send all log records over a multiprocessing connection
+    instead of the shared queue, see Handle_Log_Record. A worker which may be
+    killed should use this, a process killed while writing to the shared queue
+    can leave it locked for every other process.
+
+    conn: sending end of a multiprocessing Pipe
+
+    returns: the new handler, hold its lock to send anything else on the connection
+    """
+    handler = _Pipe_Handler(conn)
+    stage_filters = _Stage_Filters()
+    # A spawned worker does not inherit the logging setup of the main process
+    if len(stage_filters) == 0:
+        stage_filters = [_Stage_Filter()]
+        logging.getLogger().setLevel(logging.INFO)
+    for stage_filter in stage_filters:
+        handler.addFilter(stage_filter)
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    return handler
+
+def Handle_Log_Record(record):
+    """
+    Write a log record received from a worker process, see Log_To_Pipe.
+    """
+    if _listener is None:
+        logging.getLogger().handle(record)
+    else:
+        _listener.handle(record)
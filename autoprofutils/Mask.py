@@ -1,14 +1,20 @@
-from photutils import DAOStarFinder, IRAFStarFinder
 import numpy as np
-import matplotlib.pyplot as plt
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
 from scipy.stats import mode
 import logging
 import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
 from autoprofutils.SharedFunctions import Read_Image
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
+
+def _Cutout_Mask(mask, results):
+    """
+    Internal, add the zero padding of a stamp cut from near the edge of
+    a mosaic to a star mask so it is not used as data.
+    """
+    if not 'cutout mask' in results:
+        return mask
+    return np.logical_or(mask, results['cutout mask'])
 
 def Overflow_Mask(IMG, pixscale, name, results, **kwargs):
     """
@@ -56,11 +62,11 @@ def Overflow_Mask(IMG, pixscale, name, results, **kwargs):
 
 def Star_Mask_Given(IMG, pixscale, name, results, **kwargs):
 
-    mask = np.zeros(IMG.shape) if kwargs['mask_file'] is None else Read_Image(kwargs['mask_file'], **kwargs)
+    mask = Read_Image(kwargs['mask_file'], **kwargs) if 'mask_file' in kwargs and not kwargs['mask_file'] is None else np.zeros(IMG.shape)
     # Run separate code to find overflow pixels from very bright stars
     overflow_mask = Overflow_Mask(IMG, pixscale, name, results, **kwargs)
 
-    return {'mask': mask, 'overflow mask': overflow_mask}
+    return {'mask': _Cutout_Mask(mask, results), 'overflow mask': overflow_mask}
 
 def Star_Mask_IRAF(IMG, pixscale, name, results, **kwargs):
     """
@@ -79,6 +85,7 @@ def Star_Mask_IRAF(IMG, pixscale, name, results, **kwargs):
 
     returns: collection of mask information
     """
+    from photutils import IRAFStarFinder
 
     fwhm = results['psf fwhm']
     use_center = results['center']
@@ -117,20 +124,22 @@ def Star_Mask_IRAF(IMG, pixscale, name, results, **kwargs):
     overflow_mask = Overflow_Mask(IMG, pixscale, name, results, **kwargs)
     
     # Plot star mask for diagnostic purposes
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
-        plt.imshow(np.clip(IMG[max(0,int(use_center['y']-smaj*1.2)): min(IMG.shape[0],int(use_center['y']+smaj*1.2)),
-                               max(0,int(use_center['x']-smaj*1.2)): min(IMG.shape[1],int(use_center['x']+smaj*1.2))],
-                           a_min = 0, a_max = None), origin = 'lower',
-                   cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+        plot = Plot_Spec('%sMask_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(IMG[max(0,int(use_center['y']-smaj*1.2)): min(IMG.shape[0],int(use_center['y']+smaj*1.2)),
+                                             max(0,int(use_center['x']-smaj*1.2)): min(IMG.shape[1],int(use_center['x']+smaj*1.2))],
+                                         a_min = 0, a_max = None), origin = 'lower',
+                                 cmap = 'Greys_r', norm = 'log')
         dat = np.logical_or(mask, overflow_mask).astype(float)[max(0,int(use_center['y']-smaj*1.2)): min(IMG.shape[0],int(use_center['y']+smaj*1.2)),
                                                                max(0,int(use_center['x']-smaj*1.2)): min(IMG.shape[1],int(use_center['x']+smaj*1.2))]
         dat[dat == 0] = np.nan
-        plt.imshow(dat, origin = 'lower', cmap = 'Reds_r', alpha = 0.7)
-        plt.savefig('%sMask_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        Plot_Add(plot, 'imshow', dat, origin = 'lower', cmap = 'Reds_r', alpha = 0.7)
+        plots.append(plot)
     
-    return {'mask':mask,
-            'overflow mask': overflow_mask}
+    return {'mask': _Cutout_Mask(mask, results),
+            'overflow mask': overflow_mask,
+            'diagnostic plots': plots}
     
 
 def Star_Mask_DAO(IMG, pixscale, name, results, **kwargs):
@@ -146,6 +155,7 @@ def Star_Mask_DAO(IMG, pixscale, name, results, **kwargs):
 
     returns: empty collection of mask information
     """
+    from photutils import DAOStarFinder
 
     fwhm = results['psf fwhm'] 
     
@@ -176,17 +186,19 @@ def Star_Mask_DAO(IMG, pixscale, name, results, **kwargs):
     overflow_mask = Overflow_Mask(IMG, pixscale, name, results, **kwargs)
     
     # Plot star mask for diagnostic purposes
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
-        plt.imshow(np.clip(IMG,a_min = 0, a_max = None), origin = 'lower',
-                   cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+        plot = Plot_Spec('%sMask_%s.pdf' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
+        Plot_Add(plot, 'imshow', np.clip(IMG,a_min = 0, a_max = None), origin = 'lower',
+                                 cmap = 'Greys_r', norm = 'log')
         dat = np.logical_or(mask, overflow_mask).astype(float)
         dat[dat == 0] = np.nan
-        plt.imshow(dat, origin = 'lower', cmap = 'Reds_r', alpha = 0.7)
-        plt.savefig('%sMask_%s.pdf' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name))
-        plt.close()
+        Plot_Add(plot, 'imshow', dat, origin = 'lower', cmap = 'Reds_r', alpha = 0.7)
+        plots.append(plot)
     
-    return {'mask':mask,
-            'overflow mask': overflow_mask}
+    return {'mask': _Cutout_Mask(mask, results),
+            'overflow mask': overflow_mask,
+            'diagnostic plots': plots}
 
 
 def NoMask(IMG, pixscale, name, results, **kwargs):
@@ -201,6 +213,6 @@ def NoMask(IMG, pixscale, name, results, **kwargs):
     else:
         mask = np.zeros(IMG.shape,dtype = bool)
         
-    return {'mask': mask,
+    return {'mask': _Cutout_Mask(mask, results),
             'overflow mask': overflow_mask}
     
@@ -1,41 +1,51 @@
-from photutils import DAOStarFinder, IRAFStarFinder
 import numpy as np
-from scipy.stats import iqr
-import matplotlib.pyplot as plt
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-from matplotlib.patches import Ellipse
 import logging
-from itertools import product
+import zlib
+from time import time
 from scipy.optimize import minimize
-from scipy.stats import norm, multivariate_normal
-from scipy.fftpack import fft, ifft
+from scipy.stats import norm
+from scipy.fftpack import fft
+from scipy.ndimage import map_coordinates
 import sys
 import os
 sys.path.append(os.environ['AUTOPROF'])
-from autoprofutils.SharedFunctions import _iso_extract, StarFind
-from copy import deepcopy
-
-def _2DGaussFit(x, dat, xx, yy, noise, fwhm_guess):
-
-    loss = []
-    for i in range(len(xx)):
-        coords = np.array(list(product(range(max(0,int(xx[i] - 6*fwhm_guess)), min(dat.shape[0]-1,int(xx[i] + 6*fwhm_guess))),
-                                       range(max(0,int(yy[i] - 6*fwhm_guess)), min(dat.shape[1]-1,int(yy[i] + 6*fwhm_guess))))))
-        chunk = dat[coords[:,1], coords[:,0]]
-        CHOOSE = chunk > 3*noise
-        if np.sum(CHOOSE) < 10:
-            continue
-        fluxsum = np.sum(chunk)
-        model_vals = fluxsum*multivariate_normal.pdf(coords[CHOOSE], mean = [xx[i],yy[i]], cov = [[x[0],0.],[0.,x[0]]]) + noise
-        loss.append(np.sum(np.abs((model_vals - chunk[CHOOSE])**2/chunk[CHOOSE])))
-    
-    return np.mean(sorted(loss)[:-5])
+from autoprofutils.SharedFunctions import _stamp_stack, StarFind
+from autoprofutils.Diagnostic_Plots import Plot_Spec, Plot_Add
+
+def _2DGaussFit(x, stamps, R2, use, fluxsum, noise):
+    """
+    Internal, loss and gradient for fitting a circular 2D gaussian to a stack of
+    star stamps. The gaussian variance is the only free parameter, it is shared by
+    all stars. Each star contributes a chi^2 like term over its pixels which are
+    above 3 times the noise, the 5 worst fitting stars are ignored.
+
+    x: single element array with the gaussian variance (pixels^2)
+    stamps: star stamps (N stars, width, width)
+    R2: squared distance of each stamp pixel from the star center
+    use: boolean array of pixels to include in the loss for each star
+    fluxsum: total flux in each stamp
+    noise: background noise level
+
+    returns: loss, gradient of the loss with respect to the variance
+    """
+    gauss = np.exp(-R2/(2*x[0])) / (2*np.pi*x[0])
+    model = fluxsum[:,None,None]*gauss + noise
+    chunk = np.where(use, stamps, 1.)
+    residual = np.where(use, (model - chunk)/chunk, 0.)
+    loss = np.sum(residual*(model - chunk), axis = (1,2))
+    dmodel = fluxsum[:,None,None]*gauss*(R2/(2*x[0]**2) - 1/x[0])
+    grad = np.sum(2*residual*dmodel, axis = (1,2))
+
+    keep = np.argsort(loss)[:-5]
+    return np.mean(loss[keep]), np.array([np.mean(grad[keep])])
 
 def PSF_2DGaussFit(IMG, pixscale, name, results, **kwargs):
     """
     Identify 20 bright stars and simultaneously fit a 2D gaussian to all of the stars.
     The standard deivation of the fitted gaussian is then turned into a FWHM.
+    Stamps around the stars are extracted once, the gaussian model and its
+    gradient are then evaluated over the whole stack of stamps at each step
+    of the optimizer.
     
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -43,6 +53,9 @@ def PSF_2DGaussFit(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils import IRAFStarFinder
+    if 'psf_set' in kwargs:
+        return {'psf fwhm': kwargs['psf_set']}
     fwhm_guess = max(1. / pixscale, 1)
     edge_mask = np.zeros(IMG.shape, dtype = bool)
     edge_mask[int(IMG.shape[0]/5.):int(4.*IMG.shape[0]/5.),
@@ -58,26 +71,121 @@ def PSF_2DGaussFit(IMG, pixscale, name, results, **kwargs):
             break
         count += 1
         
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
-                   cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+        plot = Plot_Spec('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
+                                 cmap = 'Greys_r', norm = 'log')
         for i in range(len(irafsources['fwhm'])):
-            plt.gca().add_patch(Ellipse((irafsources['xcentroid'][i],irafsources['ycentroid'][i]), 16/pixscale, 16/pixscale,
-                                        0, fill = False, linewidth = 0.5, color = 'y'))
-        plt.savefig('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
-        plt.close()
+            Plot_Add(plot, 'ellipse', (irafsources['xcentroid'][i],irafsources['ycentroid'][i]), 16/pixscale, 16/pixscale,
+                                      0, fill = False, linewidth = 0.5, color = 'y')
+        plots.append(plot)
 
-    res = minimize(_2DGaussFit, x0 = [(fwhm_guess/2.355)**2], args = (IMG - results['background'], irafsources['xcentroid'], irafsources['ycentroid'], results['background noise'], fwhm_guess))
+    # Cut out every star once, the loss is then evaluated on the whole stack at once
+    xx = np.array(irafsources['xcentroid'])
+    yy = np.array(irafsources['ycentroid'])
+    stamps, valid, x0, y0 = _stamp_stack(IMG - results['background'], xx, yy, int(6*fwhm_guess))
+    offsets = np.arange(stamps.shape[1])
+    R2 = ((y0[:,None] + offsets - yy[:,None])**2)[:,:,None] + ((x0[:,None] + offsets - xx[:,None])**2)[:,None,:]
+    use = np.logical_and(valid, stamps > 3*results['background noise'])
+    # stars with too few bright pixels are not used
+    CHOOSE = np.sum(use, axis = (1,2)) >= 10
+    fluxsum = np.sum(np.where(valid, stamps, 0.), axis = (1,2))
+    res = minimize(_2DGaussFit, x0 = [(fwhm_guess/2.355)**2], jac = True, method = 'L-BFGS-B', bounds = [(1e-2, None)],
+                   args = (stamps[CHOOSE], R2[CHOOSE], use[CHOOSE], fluxsum[CHOOSE], results['background noise']))
     logging.info('%s: found psf: %f' % (name,np.sqrt(res.x[0])*2.355))
-    return {'psf fwhm': np.sqrt(res.x[0])*2.355}
+    return {'psf fwhm': np.sqrt(res.x[0])*2.355, 'diagnostic plots': plots}
+
+def _PSF_Radial_Profiles(dat, x, y, radii, noise):
+    """
+    Internal, extract circular isophote profiles for a set of stars on a fixed
+    grid of radii. A stamp is cut out around every star and the stack is sampled
+    with a single cubic spline interpolation call. For each radius the number of
+    points along the isophote matches _iso_extract.
+
+    dat: background subtracted image as numpy 2D array
+    x: x coordinates of the stars (pixels)
+    y: y coordinates of the stars (pixels)
+    radii: 1D array of radii (pixels) at which to sample every star
+    noise: background noise level, the profile of each star is used up to the first radius below 2*noise
+
+    Points beyond the edge of the image are left out of the isophotes, a
+    profile ends at the first radius with half its isophote off the image.
+
+    returns: median flux (N stars, N radii), flags for non circular isophotes (N stars, N radii), boolean array of radii to use for each star,
+             boolean array flagging the stars whose profile ended (below the noise or at the image edge) within the radii
+    """
+    width = int(np.ceil(radii[-1])) + 3
+    stamps, valid, x0, y0 = _stamp_stack(dat, x, y, width)
+    N = list((int(np.clip(7*r, a_min = 13, a_max = 50)) if r < 20 else int(r*0.5 + 40)) for r in radii)
+    theta = np.concatenate(list(np.linspace(0, 2*np.pi - 1./n, n) for n in N))
+    R = np.repeat(radii, N)
+    X = (np.array(x) - x0)[:,None] + R*np.cos(theta)
+    Y = (np.array(y) - y0)[:,None] + R*np.sin(theta)
+    S = np.repeat(np.arange(len(x)), len(theta))
+    flux = map_coordinates(stamps, [S, Y.flatten(), X.flatten()], order = 3, mode = 'nearest').reshape(X.shape)
+    inside = map_coordinates(valid.astype(np.float32), [S, Y.flatten(), X.flatten()], order = 0, mode = 'nearest').reshape(X.shape) > 0.5
+
+    medflux = np.zeros((len(x), len(radii)))
+    badcoefs = np.zeros((len(x), len(radii)), dtype = bool)
+    offimage = np.zeros((len(x), len(radii)), dtype = bool)
+    start = 0
+    for k, n in enumerate(N):
+        isovals = flux[:,start:start+n]
+        offimage[:,k] = np.sum(inside[:,start:start+n], axis = 1) < n/2.
+        # isophotes mostly off the image are not used, so they are left whole to avoid all NaN rows
+        isovals = np.where(np.logical_or(inside[:,start:start+n], offimage[:,k][:,None]), isovals, np.nan)
+        start += n
+        medflux[:,k] = np.nanmedian(isovals, axis = 1)
+        isovals = np.where(np.isnan(isovals), medflux[:,k][:,None], isovals)
+        coefs = fft(np.clip(isovals, a_max = np.quantile(isovals, 0.85, axis = 1)[:,None], a_min = None), axis = 1)
+        limit = np.sqrt(np.clip(coefs[:,0].real, a_min = 0, a_max = None))
+        badcoefs[:,k] = np.logical_or(np.abs(coefs[:,1]) > limit, np.abs(coefs[:,2]) > limit)
+
+    # Each profile is used out to the first radius which reaches the noise floor or runs off the image
+    ended = np.logical_or(medflux <= 2*noise, offimage)
+    done = np.any(ended, axis = 1)
+    stop = np.where(done, np.argmax(ended, axis = 1), len(radii) - 1)
+    use = np.logical_and(np.arange(len(radii)) <= stop[:,None], np.logical_not(offimage))
+    return medflux, badcoefs, use, done
+
+def _GaussFit(sr, sf, use, sigma_limits):
+    """
+    Internal, least squares fit of a 1D gaussian (amplitude and sigma) to many radial
+    profiles at once. For a given sigma the best amplitude has a closed form, so
+    the residuals are evaluated on a dense grid of sigma values for every profile
+    simultaneously and the minimum is refined with a parabola in log(sigma).
+
+    sr: radii of the profiles (pixels)
+    sf: flux profiles (N stars, N radii)
+    use: boolean array indicating which radii to include for each star
+    sigma_limits: range of sigma values to search
+
+    returns: best fit sigma for each profile
+    """
+    sigmas = np.logspace(np.log10(sigma_limits[0]), np.log10(sigma_limits[1]), 200)
+    G = norm.pdf(sr[None,:], loc = 0, scale = sigmas[:,None])
+    w = use.astype(float)
+    Sfg = (w*sf) @ G.T
+    Sgg = w @ (G**2).T
+    Sff = np.sum(w*sf**2, axis = 1)
+    loss = Sff[:,None] - Sfg**2/Sgg
 
-def _GaussFit(x, sr, sf):
-    return np.mean((sf - x[1]*norm.pdf(sr, loc = 0, scale = x[0]))**2)
+    best = np.clip(np.argmin(loss, axis = 1), a_min = 1, a_max = len(sigmas) - 2)
+    S = np.arange(len(sf))
+    l0, l1, l2 = loss[S,best-1], loss[S,best], loss[S,best+1]
+    denom = l0 - 2*l1 + l2
+    shift = np.where(denom > 0, 0.5*(l0 - l2)/np.where(denom > 0, denom, 1.), 0.)
+    logstep = np.log(sigmas[1]/sigmas[0])
+    return sigmas[best]*np.exp(np.clip(shift, a_min = -1, a_max = 1)*logstep)
 
 def PSF_GaussFit(IMG, pixscale, name, results, **kwargs):
     """
     Identify 20 bright stars and simultaneously fit a 2D gaussian to all of the stars.
     The standard deivation of the fitted gaussian is then turned into a FWHM.
+    Radial profiles for all the stars are extracted at once on a fixed grid of
+    radii and fit together, so repeated passes with a looser cut on non-circular
+    stars do not need to resample the image.
     
     IMG: 2d ndarray with flux values for the image
     pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
@@ -85,6 +193,9 @@ def PSF_GaussFit(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils import IRAFStarFinder
+    if 'psf_set' in kwargs:
+        return {'psf fwhm': kwargs['psf_set']}
     fwhm_guess = max(1. / pixscale, 1)
     edge_mask = np.zeros(IMG.shape, dtype = bool)
     edge_mask[int(IMG.shape[0]/4.):int(3.*IMG.shape[0]/4.),
@@ -111,57 +222,170 @@ def PSF_GaussFit(IMG, pixscale, name, results, **kwargs):
         return {'psf fwhm': fwhm_guess}
     if len(irafsources) < 5:
         return {'psf fwhm': fwhm_guess}
+    sources = len(irafsources['fwhm'])
     
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
-                   cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+        plot = Plot_Spec('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
+                                 cmap = 'Greys_r', norm = 'log')
         for i in range(len(irafsources['fwhm'])):
-            plt.gca().add_patch(Ellipse((irafsources['xcentroid'][i],irafsources['ycentroid'][i]), 16/pixscale, 16/pixscale,
-                                        0, fill = False, linewidth = 0.5, color = 'y'))
-        plt.savefig('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
-        plt.close()
+            Plot_Add(plot, 'ellipse', (irafsources['xcentroid'][i],irafsources['ycentroid'][i]), 16/pixscale, 16/pixscale,
+                                      0, fill = False, linewidth = 0.5, color = 'y')
+        plots.append(plot)
 
-    # Get set of stars
+    # Extract and fit the radial profile of every star once. Most stars reach the noise
+    # floor within 10 times the fwhm guess, the radii are doubled for the stars which do not
+    # until every profile reaches the noise or the edge of the image.
+    xx = np.array(irafsources['xcentroid'])
+    yy = np.array(irafsources['ycentroid'])
+    sr = 1.1**np.arange(int(np.ceil(np.log(max(10*fwhm_guess, 5.))/np.log(1.1))) + 1)
+    sf, badcoefs, use, done = _PSF_Radial_Profiles(dat, xx, yy, sr, results['background noise'])
+    while not np.all(done):
+        redo = np.logical_not(done)
+        sr = 1.1**np.arange(len(sr) + int(np.ceil(np.log(2.)/np.log(1.1))))
+        extend = ((0,0), (0, len(sr) - sf.shape[1]))
+        sf, badcoefs, use = np.pad(sf, extend), np.pad(badcoefs, extend), np.pad(use, extend)
+        sf[redo], badcoefs[redo], use[redo], done[redo] = _PSF_Radial_Profiles(dat, xx[redo], yy[redo], sr, results['background noise'])
+    count_badcoefs = np.sum(np.logical_and(badcoefs, use), axis = 1)
+    star_fwhm = _GaussFit(sr, sf, use, [0.1, sr[-1]])*2.355
+
+    # Get set of stars, allowing progressively more non-circular isophotes
     psf_estimates = []
     minbadcount = 0
     while len(psf_estimates) <= 5 and minbadcount < 5:
         for i in range(sources):
-            sf = []
-            sr = []
-            count_badcoefs = 0
-            medflux = np.inf
-            while medflux > 2*results['background noise']:
-                sr.append(sr[-1]*1.1 if len(sr) > 0 else 1)
-                isovals = _iso_extract(dat,sr[-1],0.,0.,{'x': irafsources['xcentroid'][i], 'y': irafsources['ycentroid'][i]})
-                medflux = np.median(isovals)
-                sf.append(np.median(isovals))
-                coefs = fft(np.clip(isovals, a_max = np.quantile(isovals,0.85), a_min = None))
-                if np.abs(coefs[1]) > np.sqrt(coefs[0]) or np.abs(coefs[2]) > np.sqrt(coefs[0]):
-                    count_badcoefs += 1
-            if count_badcoefs <= minbadcount:
-                res = minimize(_GaussFit, x0 = [fwhm_guess/2.355, sf[0]/norm.pdf(0,loc = 0,scale = fwhm_guess/2.355)], args = (np.array(sr), np.array(sf)), method = 'Nelder-Mead')
-                # Paper plot
-                # plt.scatter(sr,sf,color = 'k', label = 'star data')
-                # plt.plot(np.linspace(0,sr[-1]*1.1, 100), res.x[1]*norm.pdf(np.linspace(0,sr[-1]*1.1, 100), loc = 0, scale = res.x[0]), color = 'r', label = 'PSF model')
-                # plt.ylabel('flux')
-                # plt.xlabel('radius [pix]')
-                # plt.legend()
-                # plt.savefig('%sPSF_Fit_%s_%i.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name,i))
-                # plt.close()
-                psf_estimates.append(res.x[0]*2.355)
+            if count_badcoefs[i] <= minbadcount:
+                psf_estimates.append(star_fwhm[i])
             if len(psf_estimates) > 30:
                 break
         minbadcount += 1
         
     logging.info('%s: found psf: %f' % (name,np.median(psf_estimates)))
-    return {'psf fwhm': np.median(psf_estimates) if len(psf_estimates) >= 5 else fwhm_guess}
+    return {'psf fwhm': np.median(psf_estimates) if len(psf_estimates) >= 5 else fwhm_guess, 'diagnostic plots': plots}
 
 
+def _PSF_Cache_Lookup(pixscale, **kwargs):
+    """
+    Internal, look for a previously computed psf for the exposure given by
+    "psf_cache_key" in the psf cache file. Entries are ignored if they were
+    computed with a different pixel scale or are older than "psf_cache_maxage"
+    seconds. The cache file holds one line per entry with the format:
+    key|psf fwhm|pixscale|time, later entries take precedence. The file is
+    locked with fcntl, which is only available on POSIX systems.
+
+    returns: cached psf fwhm, or None if no valid entry exists
+    """
+    import fcntl
+    cache_file = kwargs['psf_cache_file'] if 'psf_cache_file' in kwargs else 'AutoProf_PSF.cache'
+    if not os.path.isfile(cache_file):
+        return None
+    with open(cache_file, 'r') as f:
+        fcntl.flock(f, fcntl.LOCK_SH)
+        lines = f.readlines()
+        fcntl.flock(f, fcntl.LOCK_UN)
+    fwhm = None
+    for line in lines:
+        entry = line.strip().split('|')
+        if len(entry) != 4 or entry[0] != str(kwargs['psf_cache_key']):
+            continue
+        if abs(float(entry[2]) - pixscale) > 1e-6*pixscale:
+            continue
+        if 'psf_cache_maxage' in kwargs and (time() - float(entry[3])) > kwargs['psf_cache_maxage']:
+            continue
+        fwhm = float(entry[1])
+    return fwhm
+
+def _PSF_Cache_Store(pixscale, fwhm, **kwargs):
+    """
+    Internal, append a psf measurement to the psf cache file. The file is locked
+    while writing so that many processes may share one cache.
+    """
+    import fcntl
+    cache_file = kwargs['psf_cache_file'] if 'psf_cache_file' in kwargs else 'AutoProf_PSF.cache'
+    with open(cache_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write('%s|%.6e|%.6e|%.3f\n' % (str(kwargs['psf_cache_key']), fwhm, pixscale, time()))
+        f.flush()
+        fcntl.flock(f, fcntl.LOCK_UN)
+
+class _PSF_Cache_Key_Lock:
+    """
+    Internal, exclusive lock for one "psf_cache_key", held while a process looks
+    up, measures and stores the psf for that key. Each key locks one byte of a
+    lock file next to the cache file (chosen by a hash of the key), so processes
+    working on different exposures rarely wait for each other. Uses fcntl record
+    locks, which are only available on POSIX systems, locks are released if the
+    process dies.
+    """
+    def __init__(self, **kwargs):
+        cache_file = kwargs['psf_cache_file'] if 'psf_cache_file' in kwargs else 'AutoProf_PSF.cache'
+        self.lock_file = cache_file + '.lock'
+        self.offset = zlib.crc32(str(kwargs['psf_cache_key']).encode()) % 65536
+
+    def __enter__(self):
+        import fcntl
+        self.f = open(self.lock_file, 'a')
+        fcntl.lockf(self.f, fcntl.LOCK_EX, 1, self.offset)
+        return self
+
+    def __exit__(self, *args):
+        import fcntl
+        fcntl.lockf(self.f, fcntl.LOCK_UN, 1, self.offset)
+        self.f.close()
+
+def Clear_PSF_Cache(cache_file = 'AutoProf_PSF.cache'):
+    """
+    Remove all entries from a psf cache file.
+    
+    cache_file: path to the psf cache file
+    """
+    import fcntl
+    if not os.path.isfile(cache_file):
+        return
+    with open(cache_file, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.truncate(0)
+        fcntl.flock(f, fcntl.LOCK_UN)
+    
 def PSF_StarFind(IMG, pixscale, name, results, **kwargs):
+    """
+    Find stars in the image and take the median of their fwhm values. If a
+    "psf_cache_key" is given (typically an exposure or CCD identifier), the
+    result is stored in a cache file shared by all processes and reused for
+    any other image with the same key.
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    name: string name of galaxy in image, used for log files to make searching easier
+    results: dictionary contianing results from past steps in the pipeline
+    kwargs: user specified arguments
+    """
 
     if 'psf_set' in kwargs:
         return {'psf fwhm': kwargs['psf_set']}
-    elif 'psf_guess' in kwargs:
+    if 'psf_cache_key' in kwargs and not kwargs['psf_cache_key'] is None:
+        # Only one process measures the psf for a key, the others wait and then read it from the cache
+        with _PSF_Cache_Key_Lock(**kwargs):
+            fwhm = _PSF_Cache_Lookup(pixscale, **kwargs)
+            if not fwhm is None:
+                logging.info('%s: using cached psf: %f for %s' % (name, fwhm, str(kwargs['psf_cache_key'])))
+                return {'psf fwhm': fwhm}
+            psf, measured = _PSF_StarFind(IMG, pixscale, name, results, **kwargs)
+            # A fallback guess is not stored, it would be used for every other image of the exposure
+            if measured:
+                _PSF_Cache_Store(pixscale, psf['psf fwhm'], **kwargs)
+            return psf
+    return _PSF_StarFind(IMG, pixscale, name, results, **kwargs)[0]
+
+def _PSF_StarFind(IMG, pixscale, name, results, **kwargs):
+    """
+    Internal, measure the psf from the stars in an image, see PSF_StarFind.
+
+    returns: psf results dictionary, True if the psf was measured or False if too few stars were found and the guess is returned
+    """
+    
+    if 'psf_guess' in kwargs:
         fwhm_guess = kwargs['psf_guess']
     else:
         fwhm_guess = max(1., 1./pixscale)
@@ -172,21 +396,23 @@ def PSF_StarFind(IMG, pixscale, name, results, **kwargs):
     stars = StarFind(IMG - results['background'], fwhm_guess, results['background noise'],
                      edge_mask, peakmax = (kwargs['overflowval']-results['background'])*0.95 if 'overflowval' in kwargs else None)
     if len(stars['fwhm']) <= 10:
-        return {'psf fwhm': fwhm_guess}
+        logging.warning('%s: only %i stars found, using psf guess: %f' % (name, len(stars['fwhm']), fwhm_guess))
+        return {'psf fwhm': fwhm_guess}, False
     def_clip = 0.1
     while np.sum(stars['deformity'] < def_clip) < max(10,2*len(stars['fwhm'])/3):
         def_clip += 0.1
+    plots = []
     if 'doplot' in kwargs and kwargs['doplot']:
-        plt.imshow(np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
-                   cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+        plot = Plot_Spec('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
+                                 cmap = 'Greys_r', norm = 'log')
         for i in range(len(stars['fwhm'])):
-            plt.gca().add_patch(Ellipse((stars['x'][i],stars['y'][i]), 16/pixscale, 16/pixscale,
-                                        0, fill = False, linewidth = 0.5, color = 'r' if stars['deformity'][i] >= def_clip else 'y'))
-        plt.savefig('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
-        plt.close()
+            Plot_Add(plot, 'ellipse', (stars['x'][i],stars['y'][i]), 16/pixscale, 16/pixscale,
+                                      0, fill = False, linewidth = 0.5, color = 'r' if stars['deformity'][i] >= def_clip else 'y')
+        plots.append(plot)
 
     logging.info('%s: found psf: %f with deformity clip of: %f' % (name,np.median(stars['fwhm'][stars['deformity'] < def_clip]), def_clip))
-    return {'psf fwhm': np.median(stars['fwhm'][stars['deformity'] < def_clip])}
+    return {'psf fwhm': np.median(stars['fwhm'][stars['deformity'] < def_clip]), 'diagnostic plots': plots}, True
 
 def Calculate_PSF(IMG, pixscale, name, results, **kwargs):
     """
@@ -199,6 +425,7 @@ def Calculate_PSF(IMG, pixscale, name, results, **kwargs):
     results: dictionary contianing results from past steps in the pipeline
     kwargs: user specified arguments
     """
+    from photutils import IRAFStarFinder
     
     # Guess for PSF based on user provided seeing value
     fwhm_guess = max(1. / pixscale, 1)
@@ -208,31 +435,35 @@ def Calculate_PSF(IMG, pixscale, name, results, **kwargs):
 
     # photutils wrapper for IRAF star finder
     count = 0
+    plots = []
     while count < 5:
         iraffind = IRAFStarFinder(fwhm = fwhm_guess, threshold = 6.*results['background noise'], roundlo = 0.01)
         irafsources = iraffind.find_stars(IMG - results['background'], edge_mask)
         logging.info('%s: psf found %i objects (min sharpness %.2e, med sherp %.2e, max sharp %.2e)' % (name, len(irafsources['fwhm']), np.min(irafsources['sharpness']), np.median(irafsources['sharpness']), np.max(irafsources['sharpness'])))
         fwhm_guess = np.median(irafsources['fwhm'])
-        hist,bins = np.histogram(irafsources['fwhm'], bins = 25)
-        plt.bar(bins[:-1], hist, width = bins[1] - bins[0], align = 'edge')
-        plt.savefig('plots/psftest_%s_%i.png' % (name,count))
-        plt.close()
+        if 'doplot' in kwargs and kwargs['doplot']:
+            # histogram of star fwhm values for each pass of the star finder
+            hist,bins = np.histogram(irafsources['fwhm'], bins = 25)
+            plot = Plot_Spec('%sPSF_FWHM_Hist_%s_%i.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name, count))
+            Plot_Add(plot, 'bar', bins[:-1], hist, width = bins[1] - bins[0], align = 'edge')
+            Plot_Add(plot, 'xlabel', 'FWHM [pix]')
+            plots.append(plot)
         if np.median(irafsources['sharpness']) >= 0.95:
             break
         count += 1
     if 'doplot' in kwargs and kwargs['doplot']:    
-        plt.imshow(np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
-                   cmap = 'Greys_r', norm = ImageNormalize(stretch=LogStretch()))
+        plot = Plot_Spec('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
+        Plot_Add(plot, 'imshow', np.clip(IMG - results['background'], a_min = 0, a_max = None), origin = 'lower',
+                                 cmap = 'Greys_r', norm = 'log')
         for i in range(len(irafsources['fwhm'])):
-            plt.gca().add_patch(Ellipse((irafsources['xcentroid'][i],irafsources['ycentroid'][i]), 16/pixscale, 16/pixscale,
-                                    0, fill = False, linewidth = 0.5, color = 'y'))
-        plt.savefig('%sPSF_Stars_%s.jpg' % (kwargs['plotpath'] if 'plotpath' in kwargs else '', name), dpi = 600)
-        plt.close()                
+            Plot_Add(plot, 'ellipse', (irafsources['xcentroid'][i],irafsources['ycentroid'][i]), 16/pixscale, 16/pixscale,
+                                  0, fill = False, linewidth = 0.5, color = 'y')
+        plots.append(plot)
     
     logging.info('%s: found psf: %f' % (name,np.median(irafsources['fwhm'])))
     
     # Return PSF statistics
-    return {'psf fwhm': fwhm_guess}
+    return {'psf fwhm': fwhm_guess, 'diagnostic plots': plots}
     
 def Given_PSF(IMG, pixscale, name, results, **kwargs):
     """
@@ -0,0 +1,39 @@
+import numpy as np
+import logging
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+from autoprofutils.SharedFunctions import _polar_grid
+from copy import copy
+
+def Polar_Resample(IMG, pixscale, name, results, **kwargs):
+    """
+    Resample the background subtracted image on a polar (log-r, theta) grid
+    around the galaxy center. Later steps read small isophotes (sma < 30 pixels)
+    from this grid with a bilinear lookup instead of building a new 2D spline
+    every time an ellipse is sampled. The grid is only used while the center
+    is unchanged, so steps which move the center fall back to the image.
+
+    The grid is built with cubic spline interpolation, its spacing is at most
+    "polar_tolerance" pixels (default 0.5) in both the radial and tangential
+    directions everywhere it is used. The error of the bilinear lookup
+    relative to evaluating the cubic spline directly scales with the square
+    of the tolerance, at the default it is a small fraction of the pixel
+    noise for typical images.
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    name: string name of galaxy in image, used for log files to make searching easier
+    results: dictionary contianing results from past steps in the pipeline
+    kwargs: user specified arguments
+    """
+
+    tolerance = kwargs['polar_tolerance'] if 'polar_tolerance' in kwargs else 0.5
+    # Isophotes beyond 30 pixels are sampled at the nearest pixel, so they are not included
+    rmax = 30.
+    Nphi = int(np.ceil(2*np.pi*rmax/tolerance))
+    P, radii, phi = _polar_grid(IMG - results['background'], results['center'], rmax, Nphi = Nphi, rmin = 0.1)
+    logging.info('%s: polar resampling with %i angles and %i radii' % (name, len(phi), len(radii)))
+
+    return {'polar image': {'image': P, 'radii': radii, 'logstep': 2*np.pi/Nphi,
+                            'center': copy(results['center'])}}
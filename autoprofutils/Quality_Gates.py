@@ -0,0 +1,69 @@
+import numpy as np
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+
+def Gate_Overflow_Fraction(IMG, pixscale, name, results, **kwargs):
+    """
+    Fail images where too large a fraction of the pixels have overflowed. Runs
+    after the background step, checks the fraction of pixels with the value
+    "overflowval" against "gate_max_overflow". Does nothing unless both are set.
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    name: string name of galaxy in image, used for log files to make searching easier
+    results: dictionary contianing results from past steps in the pipeline
+    kwargs: user specified arguments
+
+    returns: None if the image passes, else dictionary with the reason for failing
+    """
+    if not 'gate_max_overflow' in kwargs or not 'overflowval' in kwargs or kwargs['overflowval'] is None:
+        return None
+    fraction = np.mean(np.logical_and(IMG > (kwargs['overflowval'] - 1e-3), IMG < (kwargs['overflowval'] + 1e-3)))
+    if fraction > kwargs['gate_max_overflow']:
+        return {'fail': 'overflow fraction %.3f is above %.3f' % (fraction, kwargs['gate_max_overflow'])}
+    return None
+
+def Gate_Center_Offset(IMG, pixscale, name, results, **kwargs):
+    """
+    Fail images where the center ends up far from the middle of the image,
+    usually a sign that the center finder locked on to a star or an edge. The
+    offset limit is "gate_center_offset" as a fraction of half the smaller
+    image dimension. Does nothing unless "gate_center_offset" is set.
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    name: string name of galaxy in image, used for log files to make searching easier
+    results: dictionary contianing results from past steps in the pipeline
+    kwargs: user specified arguments
+
+    returns: None if the image passes, else dictionary with the reason for failing
+    """
+    if not 'gate_center_offset' in kwargs:
+        return None
+    offset = np.sqrt((results['center']['x'] - IMG.shape[1]/2.)**2 + (results['center']['y'] - IMG.shape[0]/2.)**2)
+    limit = kwargs['gate_center_offset']*min(IMG.shape)/2.
+    if offset > limit:
+        return {'fail': 'center is %.1f pix from the image center, limit %.1f pix' % (offset, limit)}
+    return None
+
+def Gate_Init_Size(IMG, pixscale, name, results, **kwargs):
+    """
+    Fail images where the galaxy is too small to fit isophotes. Runs after
+    the isophote initialization and compares the radius used to fit the
+    global ellipticity and position angle ("init R") with "gate_min_init_R"
+    times the psf fwhm. Does nothing unless "gate_min_init_R" is set.
+
+    IMG: 2d ndarray with flux values for the image
+    pixscale: conversion factor between pixels and arcseconds (arcsec / pixel)
+    name: string name of galaxy in image, used for log files to make searching easier
+    results: dictionary contianing results from past steps in the pipeline
+    kwargs: user specified arguments
+
+    returns: None if the image passes, else dictionary with the reason for failing
+    """
+    if not 'gate_min_init_R' in kwargs or not 'init R' in results:
+        return None
+    if results['init R'] < kwargs['gate_min_init_R']*results['psf fwhm']:
+        return {'fail': 'initialization radius %.1f pix is below %.1f psf fwhm' % (results['init R'], kwargs['gate_min_init_R'])}
+    return None
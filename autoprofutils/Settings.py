@@ -0,0 +1,174 @@
+import numpy as np
+from dataclasses import dataclass, field
+import importlib.util
+import logging
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+
+_number = (int, float, np.number)
+_count = (int, np.integer)
+_text = (str,)
+_flag = (bool, np.bool_, int)
+_table = (dict,)
+_any = (object,)
+# Types allowed for each argument AutoProf reads from a config file, see the
+# README for what they do. None is allowed for all of them.
+_argument_types = {'saveto': _text, 'name': _text, 'n_procs': _count, 'mask_file': _text, 'savemask': _flag,
+                   'background_block': _number, 'polar_tolerance': _number, 'fit_optimizer': _text,
+                   'fit_rtol': _number, 'fit_timelimit': _number, 'fit_chains': _count, 'fit_procs': _count,
+                   'psf_guess': _number, 'psf_set': _number, 'background_set': _number, 'background_noise_set': _number,
+                   'header_keys': _table, 'psf_cache_key': _any, 'psf_cache_header': _text, 'psf_cache_file': _text,
+                   'psf_cache_maxage': _number, 'psf_cache_reset': _flag, 'autodetectoverflow': _flag,
+                   'overflowval': _number, 'forcing_profile': _text, 'plotpath': _text, 'doplot': _flag,
+                   'plot_every': _count, 'plot_failed': _flag, 'hdulelement': _number, 'given_center': _table,
+                   'fit_center': _flag, 'scale': _number, 'samplegeometricscale': _number, 'samplelinearscale': _number,
+                   'samplestyle': _text, 'sampleinitR': _number, 'sampleendR': _number, 'sampleerrorlim': _number,
+                   'zeropoint': _number, 'delimiter': _text, 'isoband_width': _number, 'isoband_start': _number,
+                   'image_timeout': _number, 'step_budgets': _table, 'batch_cost': _text + _number, 'verbose': _flag,
+                   'log_level': _text + _number, 'log_levels': _table, 'log_format': _text, 'queue_file': _text,
+                   'queue_batch': _count, 'queue_stale': _number, 'queue_retries': _count, 'step_threads': _count,
+                   'gate_max_overflow': _number, 'gate_center_offset': _number, 'gate_min_init_R': _number,
+                   'catalogue_file': _text, 'catalogue_columns': _table, 'catalogue_delimiter': _text, 'catalogue_hdu': _text + _number,
+                   'catalogue_buffer': _count, 'mosaic_file': _text, 'cutout_center': _table, 'cutout_size': _number,
+                   'mosaic_tile': _number, 'mosaic_group': _count}
+# Arguments which are always passed to the pipeline, with these values when not given
+_argument_defaults = {'saveto': None, 'name': None, 'n_procs': 1, 'mask_file': None}
+# Arguments which change the pipeline itself rather than being passed to the pipeline functions
+_pipeline_arguments = ['new_pipeline_functions', 'new_pipeline_steps', 'new_pipeline_io', 'preprocess', 'new_quality_gates']
+_process_modes = ['image', 'image list', 'forced image', 'forced image list', 'catalogue', 'forced catalogue']
+
+@dataclass(frozen = True)
+class Settings:
+    """
+    Settings for one AutoProf run, read from a config file and checked once
+    before any image is processed (see Read_Settings). The arguments for the
+    pipeline functions are in "kwargs", in batch mode arguments given as a
+    list have one value per image. "pipeline" holds the arguments which change
+    the pipeline itself, see Isophote_Pipeline.UpdatePipeline.
+    """
+    process_mode: str
+    image_file: object
+    pixscale: object
+    kwargs: dict = field(default_factory = dict)
+    pipeline: dict = field(default_factory = dict)
+    config_file: str = None
+
+def _Check_Value(key, value, allowed, batch, source = ''):
+    """
+    Internal, raise a ValueError if a setting does not have one of the allowed types.
+    """
+    if value is None or allowed is _any:
+        return
+    if batch and type(value) == list:
+        for v in value:
+            _Check_Value(key, v, allowed, False, source)
+        return
+    # bool is a subclass of int, only accept it where a flag is expected
+    if not isinstance(value, allowed) or (isinstance(value, (bool, np.bool_)) and not bool in allowed):
+        raise ValueError('%s%s should be of type %s, got %s' % (key, source, ' or '.join(a.__name__ for a in allowed), repr(value)))
+    # a flag given as a number must be 0 or 1
+    if allowed is _flag and not isinstance(value, (bool, np.bool_)) and not value in [0, 1]:
+        raise ValueError('%s%s should be True or False (or 0 or 1), got %s' % (key, source, repr(value)))
+
+def Make_Settings(values, config_file = None, strict = False):
+    """
+    Check config values and collect them in a Settings object.
+
+    values: dictionary of config values
+    config_file: path of the file the values came from, used for error messages
+    strict: if True, warn about names which are not AutoProf arguments. Python config
+            files are not strict since they may hold other variables used to build the arguments.
+
+    returns: Settings
+    """
+    source = '' if config_file is None else ' in %s' % config_file
+    if not 'process_mode' in values:
+        raise ValueError('process_mode must be given%s' % source)
+    if not values['process_mode'] in _process_modes:
+        raise ValueError('process_mode%s should be one of %s, got %s' % (source, str(_process_modes), repr(values['process_mode'])))
+    catalogue = 'catalogue' in values['process_mode']
+    # In catalogue mode the images and pixel scales may come from the catalogue columns
+    for key in ['catalogue_file'] if catalogue else ['image_file', 'pixscale']:
+        if not key in values:
+            raise ValueError('%s must be given%s for process_mode %s' % (key, source, values['process_mode']))
+    batch = 'list' in values['process_mode']
+    if batch:
+        if type(values['image_file']) != list:
+            raise ValueError('image_file%s should be a list of files for process_mode %s' % (source, values['process_mode']))
+        for key in values:
+            if key in _argument_types and type(values[key]) == list and len(values[key]) != len(values['image_file']):
+                raise ValueError('%s%s has %i values for %i images' % (key, source, len(values[key]), len(values['image_file'])))
+    if 'forced' in values['process_mode'] and not catalogue and not 'forcing_profile' in values:
+        raise ValueError('forcing_profile must be given%s for process_mode %s' % (source, values['process_mode']))
+    kwargs = dict(_argument_defaults)
+    for key in values:
+        if key in _argument_types:
+            _Check_Value(key, values[key], _argument_types[key], batch, source)
+            kwargs[key] = values[key]
+        elif strict and not key in _pipeline_arguments + ['process_mode', 'image_file', 'pixscale']:
+            logging.warning('%s%s is not an AutoProf argument and will be ignored' % (key, source))
+    return Settings(process_mode = values['process_mode'], image_file = values['image_file'] if 'image_file' in values else None,
+                    pixscale = values['pixscale'] if 'pixscale' in values else None,
+                    kwargs = kwargs, pipeline = dict((k, values[k]) for k in _pipeline_arguments if k in values),
+                    config_file = config_file)
+
+def _Read_Python(config_file):
+    """
+    Internal, run a python config file and return its variables. The directory of the config
+    file is importable while it runs, so it may import other config files next to it.
+    """
+    config_dir = os.path.dirname(os.path.abspath(config_file))
+    # not the bare file name, which could hide a real module of the same name (ie a config called "logging.py")
+    spec = importlib.util.spec_from_file_location('autoprof_config_' + os.path.splitext(os.path.basename(config_file))[0], config_file)
+    c = importlib.util.module_from_spec(spec)
+    # registered like an imported module, so functions defined in the config can be sent to worker processes
+    sys.modules[spec.name] = c
+    sys.path.insert(0, config_dir)
+    try:
+        spec.loader.exec_module(c)
+    finally:
+        sys.path.remove(config_dir)
+    return dict((k, v) for k, v in vars(c).items() if not k.startswith('__'))
+
+def Read_Settings(config_file):
+    """
+    Read an AutoProf config file, which can be a python file (.py) with a
+    variable for each argument, or a YAML (.yaml, .yml) or TOML (.toml) file
+    with a key for each argument. In YAML and TOML files, functions for the
+    pipeline are given by name as "module.function" strings.
+
+    config_file: path to the config file
+
+    returns: Settings
+    """
+    extension = os.path.splitext(config_file)[1].lower()
+    if extension in ['.yaml', '.yml']:
+        import yaml
+        with open(config_file, 'r') as f:
+            values = yaml.safe_load(f)
+    elif extension == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(config_file, 'rb') as f:
+            values = tomllib.load(f)
+    else:
+        # Config files were imported by module name before, so the .py may have been left off
+        if extension != '.py' and not os.path.isfile(config_file):
+            config_file += '.py'
+        return Make_Settings(_Read_Python(config_file), config_file)
+    return Make_Settings(values, config_file, strict = True)
+
+def Settings_From_Module(c):
+    """
+    Collect the AutoProf arguments set as variables on an object, usually an imported config module.
+
+    returns: dictionary of arguments for the pipeline functions
+    """
+    kwargs = dict(_argument_defaults)
+    for key in _argument_types:
+        if hasattr(c, key):
+            kwargs[key] = getattr(c, key)
+    return kwargs
@@ -1,21 +1,16 @@
-import sys
-import os
 from scipy.integrate import trapz
-from scipy.stats import iqr, norm
-from scipy.interpolate import interp2d, SmoothBivariateSpline, Rbf, RectBivariateSpline
-from scipy.fftpack import fft, ifft
-from scipy.optimize import minimize
+from scipy.stats import iqr
+from scipy.interpolate import RectBivariateSpline
+from scipy.fftpack import fft
 from scipy.signal import convolve2d
-from astropy.visualization import SqrtStretch, LogStretch
-from astropy.visualization.mpl_normalize import ImageNormalize
-import matplotlib.pyplot as plt
+from scipy.ndimage import map_coordinates
 from astropy.io import fits
 import numpy as np
-from photutils.isophote import EllipseSample, EllipseGeometry, Isophote, IsophoteList
-from photutils.isophote import Ellipse as Photutils_Ellipse
-import logging
 from copy import deepcopy
-from time import time
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+from autoprofutils.Settings import Settings_From_Module
 
 Abs_Mag_Sun = {'u': 6.39,
                'g': 5.11,
@@ -204,9 +199,52 @@ def L_to_mag(L, band, Le = None, zeropoint = None):
         mage = np.abs(2.5 * Le / (L * np.log(10)))
         return mag, mage
 
-def _iso_extract(IMG, sma, eps, pa, c, more = False):
-    """
-    Internal, basic function for extracting the pixel fluxes along and isophote
+def _polar_usable(polar, sma, eps, c):
+    """
+    Internal, check if a polar resampled image (see Polar_Resample) can be
+    used to evaluate an isophote. It must have been made at the same center
+    and the isophote must lie within its range of radii.
+    """
+    if polar is None:
+        return False
+    if abs(polar['center']['x'] - c['x']) > 1e-6 or abs(polar['center']['y'] - c['y']) > 1e-6:
+        return False
+    return sma <= polar['radii'][-1] and sma*(1-eps) >= polar['radii'][0]
+
+def _polar_lookup(polar, X, Y):
+    """
+    Internal, bilinear interpolation in a polar resampled image at the given
+    offsets from its center.
+
+    polar: polar resampled image dictionary, see Polar_Resample
+    X: x offsets from the center (pixels)
+    Y: y offsets from the center (pixels)
+
+    returns: interpolated flux values with the same shape as X
+    """
+    P = polar['image']
+    Nphi, Nr = P.shape
+    # fractional angle index, negative indices wrap around in the flattened grid
+    fk = np.arctan2(Y, X)*(Nphi/(2*np.pi))
+    k = np.floor(fk)
+    wk = fk - k
+    # fractional log radius index
+    u = np.clip(np.log(X**2 + Y**2)*(0.5/polar['logstep']) - np.log(polar['radii'][0])/polar['logstep'], a_min = 0, a_max = Nr - 1.001)
+    j = u.astype(int)
+    wj = u - j
+    idx = k.astype(int)*Nr + j
+    f00 = P.take(idx, mode = 'wrap')
+    f01 = P.take(idx + 1, mode = 'wrap')
+    f10 = P.take(idx + Nr, mode = 'wrap')
+    f11 = P.take(idx + Nr + 1, mode = 'wrap')
+    return (1-wk)*(f00 + wj*(f01 - f00)) + wk*(f10 + wj*(f11 - f10))
+
+def _iso_extract(IMG, sma, eps, pa, c, more = False, polar = None):
+    """
+    Internal, basic function for extracting the pixel fluxes along and isophote.
+    If a polar resampling of the image is given (see Polar_Resample) and it was
+    made at the same center, small isophotes are read from it rather than
+    building a new spline.
     """
     
     if type(sma) == list:
@@ -243,7 +281,9 @@ def _iso_extract(IMG, sma, eps, pa, c, more = False):
     X,Y = (X*np.cos(pa) - Y*np.sin(pa), X*np.sin(pa) + Y*np.cos(pa))
     theta = (theta + pa) % (2*np.pi)
     
-    if sma < 30: 
+    if sma < 30 and _polar_usable(polar, sma, eps, c):
+        flux = _polar_lookup(polar, X, Y)
+    elif sma < 30: 
         box = [[max(0,int(c['x']-sma-2)), min(IMG.shape[1],int(c['x']+sma+2))],
                [max(0,int(c['y']-sma-2)), min(IMG.shape[0],int(c['y']+sma+2))]]
         f_interp = RectBivariateSpline(np.arange(box[1][1] - box[1][0], dtype = np.float32),
@@ -260,6 +300,117 @@ def _iso_extract(IMG, sma, eps, pa, c, more = False):
     else:
         return flux
 
+def _iso_extract_multi(IMG, sma, eps, pa, c, N = None, polar = None):
+    """
+    Internal, extract the pixel fluxes along many isophotes at once. The sma,
+    eps and pa arrays are broadcast against each other, every isophote is
+    sampled with the same number of points so the results can be stacked and
+    FFTs or statistics computed along the last axis. Interpolation follows
+    _iso_extract, cubic spline for small isophotes and nearest pixel otherwise.
+
+    IMG: image data as numpy 2D array
+    sma: semi-major axis values (pixels)
+    eps: ellipticity values
+    pa: position angle values (radians)
+    c: center dictionary with 'x' and 'y' keys
+    N: number of samples per isophote, by default chosen from the largest sma
+    polar: optional polar resampling of IMG, used in place of the spline when possible (see Polar_Resample)
+
+    returns: flux values (number of isophotes, N), angle of each sample point (number of isophotes, N)
+    """
+    sma, eps, pa = np.broadcast_arrays(np.atleast_1d(np.asarray(sma, dtype = float)),
+                                       np.atleast_1d(np.asarray(eps, dtype = float)),
+                                       np.atleast_1d(np.asarray(pa, dtype = float)))
+    maxsma = np.max(sma)
+    if N is None:
+        N = int(np.clip(7*maxsma, a_min = 13, a_max = 50)) if maxsma < 20 else int(maxsma*0.5 + 40)
+    # points along ellipse to evaluate
+    theta = np.linspace(0, 2*np.pi - 1./N, N)
+    # Define ellipses
+    X = sma[:,None]*np.cos(theta)
+    Y = sma[:,None]*(1-eps[:,None])*np.sin(theta)
+    # rotate ellipses by PA
+    cpa, spa = np.cos(pa)[:,None], np.sin(pa)[:,None]
+    X,Y = (X*cpa - Y*spa, X*spa + Y*cpa)
+    theta = (theta + pa[:,None]) % (2*np.pi)
+
+    # the smallest minor axis is passed as an ellipticity of the largest isophote
+    if maxsma < 30 and _polar_usable(polar, maxsma, np.max(1 - (1-eps)*sma/maxsma), c):
+        return _polar_lookup(polar, X, Y), theta
+    X, Y = X + c['x'], Y + c['y']
+    if maxsma < 30:
+        box = [[max(0,int(c['x']-maxsma-2)), min(IMG.shape[1],int(c['x']+maxsma+2))],
+               [max(0,int(c['y']-maxsma-2)), min(IMG.shape[0],int(c['y']+maxsma+2))]]
+        flux = map_coordinates(IMG[box[1][0]:box[1][1],box[0][0]:box[0][1]].astype(float),
+                               [Y - box[1][0], X - box[0][0]], order = 3, mode = 'nearest')
+    else:
+        flux = IMG[np.clip(np.rint(Y), a_min = 0, a_max = IMG.shape[0]-1).astype(int),
+                   np.clip(np.rint(X), a_min = 0, a_max = IMG.shape[1]-1).astype(int)]
+    return flux, theta
+
+def _polar_grid(IMG, c, rmax, Nphi = 160, rmin = 0.5):
+    """
+    Internal, sample an image on a polar grid around a center. Angles are
+    uniformly spaced and radii are logarithmically spaced with the same
+    relative step as the angles, so the resolution is similar in both
+    directions. Samples beyond the image take the value of the nearest
+    edge pixel.
+
+    IMG: image data as numpy 2D array
+    c: center dictionary with 'x' and 'y' keys
+    rmax: largest radius to sample (pixels)
+    Nphi: number of angles to sample
+    rmin: smallest radius to sample (pixels)
+
+    returns: polar samples (Nphi, number of radii), radii, angles
+    """
+    rstep = 2*np.pi/Nphi
+    radii = rmin*np.exp(np.arange(int(np.ceil(np.log(rmax/rmin)/rstep)) + 2)*rstep)
+    phi = np.arange(Nphi)*2*np.pi/Nphi
+    P = np.zeros((Nphi, len(radii)))
+    # Cubic spline interpolation for small radii, linear beyond 30 pixels (like _iso_extract)
+    for use, order in [(radii < 30, 3), (radii >= 30, 1)]:
+        if not np.any(use):
+            continue
+        rlim = np.max(radii[use])
+        box = [[max(0,int(c['x']-rlim-2)), min(IMG.shape[1],int(c['x']+rlim+2))],
+               [max(0,int(c['y']-rlim-2)), min(IMG.shape[0],int(c['y']+rlim+2))]]
+        X = c['x'] - box[0][0] + radii[use][None,:]*np.cos(phi)[:,None]
+        Y = c['y'] - box[1][0] + radii[use][None,:]*np.sin(phi)[:,None]
+        P[:,use] = map_coordinates(IMG[box[1][0]:box[1][1],box[0][0]:box[0][1]].astype(float), [Y, X], order = order, mode = 'nearest')
+    return P, radii, phi
+
+def _polar_extract(P, radii, sma, eps, shift = 0):
+    """
+    Internal, extract the flux along ellipses from polar samples made by
+    _polar_grid. Each ellipse is sampled at the polar grid angles, so only
+    an interpolation in radius is needed. Rotating an ellipse by a
+    multiple of the angular step is just a shift of the angle index, the
+    position angle for a shift is shift*2*pi/Nphi.
+
+    P: polar samples from _polar_grid
+    radii: radii of the polar samples
+    sma: semi-major axis values (pixels)
+    eps: ellipticity values, broadcast against sma
+    shift: integer rotations of the ellipses (in units of the angular step)
+
+    returns: flux values (number of ellipses, number of shifts, Nphi)
+    """
+    sma, eps = np.broadcast_arrays(np.atleast_1d(np.asarray(sma, dtype = float)),
+                                   np.atleast_1d(np.asarray(eps, dtype = float)))
+    shift = np.atleast_1d(shift).astype(int)
+    Nphi = P.shape[0]
+    phi = np.arange(Nphi)*2*np.pi/Nphi
+    # radius of each ellipse along each grid angle, relative to the major axis
+    q = (1. - eps)[:,None]
+    R = sma[:,None]*q/np.sqrt((q*np.cos(phi))**2 + np.sin(phi)**2)
+    # linear interpolation weights in log radius
+    u = np.log(R/radii[0])/np.log(radii[1]/radii[0])
+    j = np.clip(np.floor(u).astype(int), a_min = 0, a_max = len(radii)-2)
+    w = np.clip(u - j, a_min = 0, a_max = 1)[:,None,:]
+    rows = ((np.arange(Nphi)[None,:] + shift[:,None]) % Nphi)[None,:,:]
+    return (1-w)*P[rows, j[:,None,:]] + w*P[rows, j[:,None,:]+1]
+
 def _iso_within(IMG, sma, eps, pa, c):
 
     ranges = [[max(0,int(c['x']-sma-2)), min(IMG.shape[1],int(c['x']+sma+2))],
@@ -284,6 +435,68 @@ def _iso_between(IMG, sma_low, sma_high, eps, pa, c):
     RR = XX**2 + YY**2
     return IMG[ranges[1][0]:ranges[1][1],ranges[0][0]:ranges[0][1]][np.logical_and(RR < sma_high**2, RR > sma_low**2)]
 
+
+def _stamp_stack(IMG, x, y, width):
+    """
+    Internal, cut out a square stamp around each of a list of positions and
+    stack them into a single 3D array. Pixels beyond the edge of the image
+    take the value of the nearest edge pixel and are flagged in the
+    returned validity array.
+
+    IMG: image data as numpy 2D array
+    x: array of x coordinates (pixels) for the stamp centers
+    y: array of y coordinates (pixels) for the stamp centers
+    width: half width of the stamps in pixels, stamps are 2*width+1 on a side
+
+    returns: stamps (N, 2*width+1, 2*width+1), valid pixel mask with the same shape, x and y pixel index of the stamp origins
+    """
+    x0 = np.rint(np.array(x)).astype(int) - width
+    y0 = np.rint(np.array(y)).astype(int) - width
+    offsets = np.arange(2*width + 1)
+    XX = x0[:,None] + offsets
+    YY = y0[:,None] + offsets
+    valid = np.logical_and(np.logical_and(YY >= 0, YY < IMG.shape[0])[:,:,None],
+                           np.logical_and(XX >= 0, XX < IMG.shape[1])[:,None,:])
+    stamps = IMG[np.clip(YY, a_min = 0, a_max = IMG.shape[0]-1)[:,:,None],
+                 np.clip(XX, a_min = 0, a_max = IMG.shape[1]-1)[:,None,:]]
+    return stamps, valid, x0, y0
+        
+def _huber_polyfit(x, y, deg, epsilon = 1.35, alpha = 1e-4, iters = 100):
+    """
+    Internal, robust polynomial fit of a 1D profile with the Huber loss. Solved by
+    iteratively reweighted least squares: residuals larger than epsilon times the
+    robust (median absolute deviation) scale are down weighted by their size. A
+    small ridge penalty alpha on the non constant terms stabilizes high degree fits.
+
+    x: independent variable (1D array)
+    y: values to fit (1D array)
+    deg: degree of the polynomial
+    epsilon: residual threshold, in units of the scale, beyond which the loss is linear
+    alpha: ridge penalty on the polynomial coefficients
+    iters: maximum number of reweighting iterations
+
+    returns: polynomial coefficients, highest power first as used by np.polyval
+    """
+    X = np.vander(np.array(x, dtype = float), deg + 1)
+    y = np.array(y, dtype = float)
+    reg = np.diag(np.concatenate((np.ones(deg)*alpha, [0.])))
+    w = np.ones(len(y))
+    coefs = np.zeros(deg + 1)
+    for it in range(iters):
+        Xw = X*w.reshape(-1,1)
+        new_coefs = np.linalg.lstsq(X.T @ Xw + reg, Xw.T @ y, rcond = None)[0]
+        converged = np.allclose(new_coefs, coefs, rtol = 1e-6, atol = 1e-10)
+        coefs = new_coefs
+        if converged:
+            break
+        r = np.abs(y - X @ coefs)
+        scale = 1.4826*np.median(r)
+        if scale <= 0:
+            break
+        w = np.ones(len(y))
+        CHOOSE = r > epsilon*scale
+        w[CHOOSE] = epsilon*scale/r[CHOOSE]
+    return coefs
         
 def StarFind(IMG, fwhm_guess, background_noise, mask = None, peakmax = None, detect_threshold = 20., minsep = 10., reject_size = 10., maxstars = np.inf):
     """
@@ -405,6 +618,9 @@ def StarFind(IMG, fwhm_guess, background_noise, mask = None, peakmax = None, det
         # plt.savefig('test/PSF_test_%i_center.jpg' % randid)
         # plt.close()
         
+    # no stars found
+    if len(centers) == 0:
+        centers = np.zeros((0,2))
     return {'x': centers[:,0], 'y': centers[:,1], 'fwhm': np.array(fwhms), 'peak': np.array(peaks), 'deformity': np.array(deformities)}
 
 
@@ -436,33 +652,127 @@ def _inv_x_to_eps(eps):
     return 0.5 + np.tan(np.pi*((eps - 0.02)/0.96 - 0.5)) #0.5 - np.log(0.96/(eps - 0.02) - 1.) 
 
 
-def Read_Image(filename, **kwargs):
+def Read_Image(filename, return_header = False, **kwargs):
     """
     Reads a galaxy image given a file name. In a fits image the data is assumed to exist in the
     primary HDU unless given 'hdulelement'. In a numpy file, it is assumed that only one image
     is in the file.
     
     filename: A string containing the full path to an image file
+    return_header: if True, also return the header for the image (an empty dictionary for numpy files)
 
-    returns: Extracted image data as numpy 2D array
+    returns: Extracted image data as numpy 2D array, and the header if requested
     """
 
+    header = {}
     # Read a fits file
     if filename[filename.rfind('.')+1:].lower() == 'fits':
         hdul = fits.open(filename)
         dat = hdul[kwargs['hdulelement'] if 'hdulelement' in kwargs else 0].data
+        header = hdul[kwargs['hdulelement'] if 'hdulelement' in kwargs else 0].header
     # Read a numpy array file
     if filename[filename.rfind('.')+1:].lower() == 'npy':
         dat = np.load(filename)
-            
+
+    if return_header:
+        return dat, header
     return dat
 
+# Mosaics opened by Read_Cutout in this process, by file name
+_mosaics = {}
+
+def Read_Cutout(filename, center, size, return_header = False, return_valid = False, **kwargs):
+    """
+    Cut a square stamp out of a large mosaic image. The mosaic is memory mapped
+    the first time it is used in a process and kept open, so only the pages
+    holding each stamp are read from disk. Parts of the stamp beyond the edge
+    of the mosaic are filled with zeros so the requested center is always the
+    center of the stamp. The zeros are not data, use return_valid to get the
+    map of pixels which came from the mosaic so the padding can be masked.
+    FITS mosaics with scaled integer data (BSCALE/BZERO) cannot be memory
+    mapped and are read a section at a time instead.
+
+    filename: path to a fits or numpy mosaic
+    center: dictionary with the 'x' and 'y' pixel coordinates of the stamp center in the mosaic
+    size: width of the stamp in pixels
+    return_header: if True, also return the mosaic header
+    return_valid: if True, also return a boolean 2D array, True for pixels inside the mosaic
+
+    returns: stamp as numpy 2D array, then the mosaic header and the valid pixel map if requested
+    """
+    key = (filename, os.getpid())
+    if not key in _mosaics:
+        if filename[filename.rfind('.')+1:].lower() == 'npy':
+            _mosaics[key] = (np.load(filename, mmap_mode = 'r'), {}, None)
+        else:
+            # the file is kept open with the mosaic, it is read from for every stamp
+            hdul = fits.open(filename, memmap = True)
+            hdu = hdul[kwargs['hdulelement'] if 'hdulelement' in kwargs else 0]
+            scaled = ('BSCALE' in hdu.header and hdu.header['BSCALE'] != 1) or ('BZERO' in hdu.header and hdu.header['BZERO'] != 0)
+            _mosaics[key] = (hdu.section if scaled else hdu.data, hdu.header, hdul)
+    data, header = _mosaics[key][:2]
+    size = int(np.ceil(size))
+    x0 = int(np.round(center['x'])) - size // 2
+    y0 = int(np.round(center['y'])) - size // 2
+    shape = data.shape
+    stamp = np.zeros((size, size))
+    valid = np.zeros((size, size), dtype = bool)
+    xs, xe = max(0, x0), min(shape[1], x0 + size)
+    ys, ye = max(0, y0), min(shape[0], y0 + size)
+    if xe > xs and ye > ys:
+        stamp[ys - y0:ye - y0, xs - x0:xe - x0] = data[ys:ye, xs:xe]
+        valid[ys - y0:ye - y0, xs - x0:xe - x0] = True
+    returns = (stamp,) + ((header,) if return_header else ()) + ((valid,) if return_valid else ())
+    return returns if len(returns) > 1 else stamp
+
+def Image_Pixels(filename, **kwargs):
+    """
+    Number of pixels in an image file, found from the fits header (or the numpy
+    file header) without reading the image data.
+
+    filename: A string containing the full path to an image file
+
+    returns: number of pixels in the image, or None if it could not be determined
+    """
+    if filename[filename.rfind('.')+1:].lower() == 'fits':
+        header = fits.getheader(filename, kwargs['hdulelement'] if 'hdulelement' in kwargs else 0)
+        return int(np.prod(list(header['NAXIS%i' % (i+1)] for i in range(header['NAXIS']))))
+    if filename[filename.rfind('.')+1:].lower() == 'npy':
+        return int(np.prod(np.load(filename, mmap_mode = 'r').shape))
+    return None
+
+def Header_Values(header, header_keys):
+    """
+    Reads trusted values (seeing, sky level, pixel scale) from an image header.
+    Each entry in header_keys maps a quantity to a header keyword, or to a tuple
+    of (keyword, factor) where the header value is multiplied by factor. For example
+    {'psf fwhm': ('SEEING', 1/0.262), 'background': 'SKYLEVEL', 'pixscale': 'PIXSCALE'}.
+    Quantities which are not found in the header are left out.
+
+    header: fits header, or any dictionary like object
+    header_keys: dictionary mapping quantities to header keywords
+
+    returns: dictionary of values for quantities found in the header
+    """
+
+    values = {}
+    for quantity in header_keys:
+        if type(header_keys[quantity]) in [tuple, list]:
+            key, factor = header_keys[quantity]
+        else:
+            key, factor = header_keys[quantity], 1.
+        try:
+            values[quantity] = float(header[key]) * factor
+        except:
+            continue
+    return values
+
 def Angle_TwoAngles(a1, a2):
     """
     Compute the angle between two vectors at angles a1 and a2
     """
 
-    return np.arccos(np.sin(a1)*np.sin(a2) + np.cos(a1)*np.cos(a2))
+    return np.arccos(np.clip(np.sin(a1)*np.sin(a2) + np.cos(a1)*np.cos(a2), a_min = -1, a_max = 1))
     
 
 def Angle_Average(a):
@@ -485,117 +795,13 @@ def Angle_Scatter(a):
 
 
 def GetKwargs(c):
+    """
+    Collect the AutoProf arguments set in an imported config module, see Settings.Read_Settings
+    for reading and checking a config file.
 
-    newkwargs = {}
-
-    try:
-        newkwargs['saveto'] = c.saveto
-    except:
-        newkwargs['saveto'] = None
-    try:
-        newkwargs['name'] = c.name
-    except:
-        newkwargs['name'] = None
-    try:
-        newkwargs['n_procs'] = c.n_procs
-    except:
-        newkwargs['n_procs'] = 1
-    try:
-        newkwargs['mask_file'] = c.mask_file
-    except:
-        newkwargs['mask_file'] = None
-    try:
-        newkwargs['savemask'] = c.savemask
-    except:
-        pass
-    try:
-        newkwargs['psf_guess'] = c.psf_guess
-    except:
-        pass
-    try:
-        newkwargs['psf_set'] = c.psf_set
-    except:
-        pass
-    try:
-        newkwargs['autodetectoverflow'] = c.autodetectoverflow
-    except:
-        pass
-    try:
-        newkwargs['overflowval'] = c.overflowval
-    except:
-        pass
-    try:
-        newkwargs['forcing_profile'] = c.forcing_profile
-    except:
-        pass
-    try:
-        newkwargs['plotpath'] = c.plotpath
-    except:
-        pass
-    try:
-        newkwargs['doplot'] = c.doplot
-    except:
-        pass
-    try:
-        newkwargs['hdulelement'] = c.hdulelement
-    except:
-        pass
-    try:
-        newkwargs['given_center'] = c.given_center
-    except:
-        pass
-    try:
-        newkwargs['fit_center'] = c.fit_center
-    except:
-        pass
-    try:
-        newkwargs['scale'] = c.scale
-    except:
-        pass
-    try:
-        newkwargs['samplegeometricscale'] = c.samplegeometricscale
-    except:
-        pass
-    try:
-        newkwargs['samplelinearscale'] = c.samplelinearscale
-    except:
-        pass
-    try:
-        newkwargs['samplestyle'] = c.samplestyle
-    except:
-        pass
-    try:
-        newkwargs['sampleinitR'] = c.sampleinitR
-    except:
-        pass
-    try:
-        newkwargs['sampleendR'] = c.sampleendR
-    except:
-        pass
-    try:
-        newkwargs['sampleerrorlim'] = c.sampleerrorlim
-    except:
-        pass
-    try:
-        newkwargs['zeropoint'] = c.zeropoint
-    except:
-        pass
-    try:
-        newkwargs['delimiter'] = c.delimiter
-    except:
-        pass
-    try:
-        newkwargs['isoband_width'] = c.isoband_width
-    except:
-        pass
-    try:
-        newkwargs['isoband_start'] = c.isoband_start
-    except:
-        pass
-        
-    return newkwargs
-
-
+    returns: dictionary of arguments for the pipeline functions
+    """
+    return Settings_From_Module(c)
 
 def SBprof_to_COG(R, SB, axisratio, method = 0):
     """
@@ -0,0 +1,217 @@
+import sqlite3
+import json
+import socket
+from time import time
+import sys
+import os
+sys.path.append(os.environ['AUTOPROF'])
+
+# Work queue for running one image list on many machines which share a filesystem.
+# The queue is a SQLite file with three tables:
+#   meta: settings for the whole queue (config file, working directory)
+#   tasks: one row per image with its index in the image list, image file, status, claiming worker, result and
+#          the last heartbeat from the worker running it
+#   journal: one row per event (claim, finish, reclaim, worker start/stop) for following a run
+# Task status is one of: pending, running, done, failed, timeout
+
+def _Queue_Connect(queue_file):
+    """
+    Internal, open the queue file. Transactions are managed explicitly so
+    that claiming tasks can lock the database for the whole read/update.
+    """
+    conn = sqlite3.connect(queue_file, timeout = 120, isolation_level = None)
+    conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS tasks (id INTEGER PRIMARY KEY, name TEXT, status TEXT, worker TEXT, '
+                 'claimed REAL, attempts INTEGER, result TEXT, heartbeat REAL)')
+    conn.execute('CREATE TABLE IF NOT EXISTS journal (time REAL, worker TEXT, task INTEGER, event TEXT, message TEXT)')
+    # queues made before heartbeats were recorded
+    if not 'heartbeat' in list(c[1] for c in conn.execute('PRAGMA table_info(tasks)').fetchall()):
+        try:
+            conn.execute('ALTER TABLE tasks ADD COLUMN heartbeat REAL')
+        except sqlite3.OperationalError:
+            # another worker added it first
+            pass
+    return conn
+
+def Queue_Worker_ID():
+    """
+    Identifier for the current worker in the queue tables, host name and process id.
+    """
+    return '%s:%i' % (socket.gethostname(), os.getpid())
+
+def Queue_Journal(queue_file, event, task = None, message = '', worker = None):
+    """
+    Add an entry to the queue journal.
+
+    queue_file: path to the queue file
+    event: short label for the event
+    task: index of the image the event refers to, if any
+    message: free text details
+    worker: worker id, defaults to the current process
+    """
+    conn = _Queue_Connect(queue_file)
+    conn.execute('INSERT INTO journal VALUES (?,?,?,?,?)', (time(), Queue_Worker_ID() if worker is None else worker, task, event, message))
+    conn.close()
+
+def Queue_Create(queue_file, config_file, images):
+    """
+    Create a work queue for an image list, or add to an existing one. Images
+    are identified by their index in the image list, indices already in the
+    queue are left as they are, so resubmitting a config file does not
+    repeat finished images. The image file of each task is stored so that
+    workers can check they built the same image list (see Queue_Check_Images).
+
+    queue_file: path to the queue file, should be on a filesystem all workers can reach
+    config_file: path to the AutoProf config file which the workers will run
+    images: list with the image file of each task
+
+    returns: number of new tasks added to the queue
+    """
+    images = list(str(image) for image in images)
+    conn = _Queue_Connect(queue_file)
+    conn.execute('BEGIN IMMEDIATE')
+    for i, name in conn.execute('SELECT id, name FROM tasks ORDER BY id').fetchall():
+        if i < len(images) and name != images[i]:
+            conn.execute('ROLLBACK')
+            conn.close()
+            raise ValueError('image %i of the queue is %s, but the image list gives %s' % (i, name, images[i]))
+    conn.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', ('config file', os.path.abspath(config_file)))
+    conn.execute('INSERT OR REPLACE INTO meta VALUES (?,?)', ('working directory', os.getcwd()))
+    added = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+    conn.executemany('INSERT OR IGNORE INTO tasks (id, name, status, attempts) VALUES (?,?,?,0)', list((i, n, 'pending') for i, n in enumerate(images)))
+    added = conn.execute('SELECT COUNT(*) FROM tasks').fetchone()[0] - added
+    conn.execute('INSERT INTO journal VALUES (?,?,?,?,?)', (time(), Queue_Worker_ID(), None, 'create', 'added %i tasks from %s' % (added, config_file)))
+    conn.execute('COMMIT')
+    conn.close()
+    return added
+
+def Queue_Meta(queue_file):
+    """
+    Return the queue settings (config file, working directory) as a dictionary.
+    """
+    conn = _Queue_Connect(queue_file)
+    meta = dict(conn.execute('SELECT key, value FROM meta').fetchall())
+    conn.close()
+    return meta
+
+def Queue_Check_Images(queue_file, images):
+    """
+    Check that an image list matches the images in the queue, tasks are
+    identified by their index so a worker which built its image list in a
+    different order (ie from a directory listing) would process the wrong images.
+
+    queue_file: path to the queue file
+    images: list with the image file of each task, as built by this worker
+
+    returns: None if the lists match, otherwise a message describing the first difference
+    """
+    conn = _Queue_Connect(queue_file)
+    queued = list(r[0] for r in conn.execute('SELECT name FROM tasks ORDER BY id').fetchall())
+    conn.close()
+    images = list(str(image) for image in images)
+    if len(queued) != len(images):
+        return 'the queue has %i images but the image list has %i' % (len(queued), len(images))
+    for i in range(len(images)):
+        if queued[i] != images[i]:
+            return 'image %i of the queue is %s, but the image list gives %s' % (i, queued[i], images[i])
+    return None
+
+def Queue_Claim(queue_file, batch = 1, stale = 3600., retries = 2):
+    """
+    Atomically claim up to "batch" pending tasks for this worker. Running tasks
+    which have had no heartbeat (see Queue_Heartbeat) for "stale" seconds are
+    assumed to belong to a worker which has died, they are put back in the
+    queue first, unless they have already been claimed "retries" times in
+    which case they are marked as failed.
+
+    queue_file: path to the queue file
+    batch: maximum number of tasks to claim
+    stale: seconds without a heartbeat after which a running task may be reclaimed
+    retries: maximum number of times a task is claimed
+
+    returns: list of image indices claimed, empty once no work is left
+    """
+    worker = Queue_Worker_ID()
+    conn = _Queue_Connect(queue_file)
+    # BEGIN IMMEDIATE takes the write lock, no other worker can claim until the commit
+    conn.execute('BEGIN IMMEDIATE')
+    now = time()
+    for i, old_worker, attempts in conn.execute('SELECT id, worker, attempts FROM tasks WHERE status = ? AND COALESCE(heartbeat, claimed) < ?',
+                                                ('running', now - stale)).fetchall():
+        status = 'pending' if attempts < retries else 'failed'
+        conn.execute('UPDATE tasks SET status = ?, worker = NULL WHERE id = ?', (status, i))
+        conn.execute('INSERT INTO journal VALUES (?,?,?,?,?)', (now, worker, i, 'reclaim', 'stale task from %s set to %s' % (old_worker, status)))
+    claim = list(r[0] for r in conn.execute('SELECT id FROM tasks WHERE status = ? ORDER BY id LIMIT ?', ('pending', int(batch))).fetchall())
+    for i in claim:
+        conn.execute('UPDATE tasks SET status = ?, worker = ?, claimed = ?, heartbeat = ?, attempts = attempts + 1 WHERE id = ?', ('running', worker, now, now, i))
+        conn.execute('INSERT INTO journal VALUES (?,?,?,?,?)', (now, worker, i, 'claim', ''))
+    conn.execute('COMMIT')
+    conn.close()
+    return claim
+
+def Queue_Heartbeat(queue_file, tasks):
+    """
+    Mark tasks claimed by this worker as still running, so that they are not
+    reclaimed while they take longer than the "stale" time of Queue_Claim.
+
+    queue_file: path to the queue file
+    tasks: list of image indices claimed by this worker
+
+    returns: list of the tasks which this worker still owns, tasks reclaimed by another worker are left out
+    """
+    worker = Queue_Worker_ID()
+    conn = _Queue_Connect(queue_file)
+    conn.execute('BEGIN IMMEDIATE')
+    now = time()
+    owned = list(i for i in tasks if conn.execute('UPDATE tasks SET heartbeat = ? WHERE id = ? AND worker = ? AND status = ?',
+                                                  (now, int(i), worker, 'running')).rowcount > 0)
+    conn.execute('COMMIT')
+    conn.close()
+    return owned
+
+def Queue_Finish(queue_file, results):
+    """
+    Record the results for tasks claimed by this worker. Results follow
+    Process_List: a dictionary of step timers for a finished image, 1 for a
+    failed image, 'timeout' for an image that ran out of time. Tasks which
+    were reclaimed by another worker in the mean time are not changed.
+
+    queue_file: path to the queue file
+    results: dictionary with image index as key and result as value
+    """
+    worker = Queue_Worker_ID()
+    conn = _Queue_Connect(queue_file)
+    conn.execute('BEGIN IMMEDIATE')
+    for i in results:
+        if type(results[i]) == dict:
+            status = 'done'
+        elif results[i] == 'timeout':
+            status = 'timeout'
+        else:
+            status = 'failed'
+        updated = conn.execute('UPDATE tasks SET status = ?, result = ? WHERE id = ? AND worker = ? AND status = ?',
+                               (status, json.dumps(results[i]), int(i), worker, 'running')).rowcount
+        conn.execute('INSERT INTO journal VALUES (?,?,?,?,?)', (time(), worker, int(i), status if updated > 0 else 'discarded', ''))
+    conn.execute('COMMIT')
+    conn.close()
+
+def Queue_Status(queue_file):
+    """
+    Count the tasks in each state.
+
+    returns: dictionary with status as key and number of tasks as value
+    """
+    conn = _Queue_Connect(queue_file)
+    counts = dict(conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall())
+    conn.close()
+    return counts
+
+def Queue_Results(queue_file):
+    """
+    Results of all tasks in image list order, in the same format as returned
+    by Process_List. Tasks which are not finished are given as None.
+    """
+    conn = _Queue_Connect(queue_file)
+    rows = conn.execute('SELECT id, result FROM tasks ORDER BY id').fetchall()
+    conn.close()
+    return list(None if r[1] is None else json.loads(r[1]) for r in rows)
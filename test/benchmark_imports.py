@@ -0,0 +1,46 @@
+#!/usr/bin/python3
+# Measure the time to import AutoProf, each run uses a fresh python interpreter.
+# Usage: python3 benchmark_imports.py [number of repeats]
+
+import os
+import sys
+import subprocess
+import numpy as np
+
+repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+targets = ['Pipeline',
+           'autoprofutils.SharedFunctions',
+           'autoprofutils.Background',
+           'autoprofutils.PSF',
+           'autoprofutils.Center',
+           'autoprofutils.Isophote_Initialize',
+           'autoprofutils.Isophote_Fit',
+           'autoprofutils.Mask',
+           'autoprofutils.Isophote_Extract',
+           'autoprofutils.Check_Fit']
+heavy = ['matplotlib', 'photutils', 'sklearn', 'astropy.visualization']
+
+code = '''
+import sys
+from time import time
+sys.path.append("%s")
+start = time()
+import %s
+print(time() - start)
+print(",".join(m for m in %s if m in sys.modules))
+'''
+
+for target in targets:
+    times = []
+    for r in range(repeats):
+        out = subprocess.run([sys.executable, '-c', code % (os.environ['AUTOPROF'], target, str(heavy))],
+                             capture_output = True, text = True, env = os.environ)
+        if out.returncode != 0:
+            print('%s: failed to import\n%s' % (target, out.stderr))
+            break
+        lines = out.stdout.strip().split('\n')
+        times.append(float(lines[0]))
+    else:
+        print('%-36s %6.3f +- %.3f s   heavy modules loaded: %s' % (target, np.median(times), np.std(times),
+                                                                   lines[1] if len(lines) > 1 and lines[1] else 'none'))